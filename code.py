@@ -33,9 +33,18 @@ import board
 print('////102///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 import os
 print('////103///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+import struct
+print('////104///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+from array import array
+print('////105///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
 def addr_to_hex(addr):
     return ''.join('{:02x}:'.format(x) for x in reversed(addr))[:-1]
+def fnv1a32(data, h=0x811c9dc5):
+    # FNV-1a, 32 bit: a cheap, well-spread hash for short byte strings
+    for b in data:
+        h = ((h ^ b) * 0x01000193) & 0xffffffff
+    return h
 def addrs_to_hex(addrs):
     return [addr_to_hex(addr) for addr in addrs]
 def btprint(text):
@@ -46,6 +55,14 @@ def btprint(text):
 def get_file_size(filename):
     return os.stat(filename)[6]
 
+def get_reset_reason():
+    # why the chip last reset: 'POWER_ON', 'BROWNOUT', 'WATCHDOG', ... or 'UNKNOWN'
+    try:
+        import microcontroller
+        return str(microcontroller.cpu.reset_reason).split('.')[-1]
+    except Exception:
+        return 'UNKNOWN'
+
 def make_thumbprint(contact):
     keys = sorted(list(contact.data_dict.keys()))
     sizes = [len(contact.data_dict[k]) for k in keys]
@@ -66,16 +83,23 @@ def main():
     neo_module = NeopixelModule()
     eink_module = EInkModule(contact_counter)
     buttons = ButtonsModule()
+    governor = MemoryGovernor()
+    gc_policy = GcPolicy()
+    bt_module.gc_policy = gc_policy
 
     while True:
-        contact_counter.periodic_update(buttons, neo_module, eink_module)
-        bt_module.periodic_update(contact_counter, buttons)
-        gc.collect()
-        neo_module.periodic_update(contact_counter, buttons)
-        eink_module.periodic_update(contact_counter, buttons)
-        contact_counter.debug_print(buttons)
-        gc.collect()
-        time.sleep(0.25)
+        try:
+            contact_counter.periodic_update(buttons, neo_module, eink_module)
+            bt_module.periodic_update(contact_counter, buttons)
+            gc_policy.idle() # right after a scan
+            governor.periodic_update(contact_counter, bt_module)
+            neo_module.periodic_update(contact_counter, buttons)
+            eink_module.periodic_update(contact_counter, buttons)
+            contact_counter.debug_print(buttons)
+        except MemoryError:
+            governor.out_of_memory(contact_counter, bt_module)
+        gc_policy.idle(eink_module.refreshing())
+        time.sleep(max(0, 0.25 - gc_policy.take_loop_pause()))
 print('////1020///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
 ##################################################################
@@ -86,6 +110,24 @@ print('////1020///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 setting_bt_rssi = -80 # -80 is good, -20 is very close, -120 is very far away
 setting_bt_timeout = 1.0 # scan for this many seconds each time
 setting_end_encounter_time = 5 * 60 # End an encounter after this many seconds of not seeing the device
+setting_bloom_bytes = 24 * 1024 # memory for the bloom "seen before" filter; see tools/bloom_calc.py
+setting_bloom_hashes = 5 # bits set per address: fewer writes to flash, more false "seen before"
+setting_seen_filter = 'bloom' # or 'cuckoo': can forget home devices, fewer false "seen before"; see tools/filter_bench.py
+setting_cuckoo_bytes = 24 * 1024 # memory for the cuckoo filter, 2 bytes per address (plus ~5% spare)
+setting_home_count_minutes = 2 # after startup or reset, devices seen for this long are home devices and don't count
+setting_home_devices_max = 128 # home devices remembered (10 bytes each); past that, the longest unseen is forgotten
+setting_home_keep_on_reset = True # False: a count reset forgets the home devices too
+setting_uart_mtu = 244 # bytes per BLE notification; each export frame fits in one
+setting_uart_frames_per_loop = 8 # export frames sent per main loop, so scanning keeps going
+setting_scan_capture = False # record every scan result to /data_scan0.bin and /data_scan1.bin
+setting_scan_capture_bytes = 64 * 1024 # flash the two capture files may use together
+setting_scan_capture_raw = False # store whole advertisements instead of a 4 byte hash of the thumbprint
+setting_scan_capture_rssi = -100 # capture scans down to this rssi; counting still uses setting_bt_rssi
+setting_mem_low_water = 12 * 1024 # free memory under this starts saving memory, a step per loop (see MemoryGovernor)
+setting_mem_critical = 6 * 1024 # free memory under this takes every step at once
+setting_mem_high_water = 20 * 1024 # free memory over this (for a minute) undoes a step
+setting_snapshot_seconds = 120 # save the active encounters this often, so a reset picks them up again (0 = off)
+setting_gc_alloc_bytes = 16 * 1024 # collect garbage once this much was allocated since the last time (see GcPolicy)
 
 
 ##################################################################
@@ -104,16 +146,38 @@ class Encounter:
         self.is_new_device = is_new_device  # First contact for this device
         self.thumbprint = hopper_thumbprint # to help identify hopper-buddies
         self.is_home_device = False         # These devices don't get counted
+        self.rssi = -128                    # signal strength when last seen
 print('////1030///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
 class Bloom:
     '''
-    The bloom is a structure which tracks whether or not we've seen an address before
+    The bloom is a structure which tracks whether or not we've seen an address before.
+    It's one of the "seen before" filters ContactCounts can use (setting_seen_filter):
+    add() returns True for a new address, contains(), remove(), clear(), save().
+    k bit positions come from double hashing, fnv1a32 of the address and its type
+    twice with different seeds, so structured addresses (same vendor prefix,
+    counters) still spread over all m bits. tools/bloom_calc.py gives the
+    false positive rate for m, k and the number of devices you expect.
+    File: b'BLM2', '<IB3x' m (bits) and k, then the m/8 bytes of bits.
+    The old layout (three 8k tables indexed by raw address bytes) is renamed
+    to /data_bloom_v1.bin and still consulted, a few bytes at a time, so
+    devices seen before the change aren't counted again.
     '''
-    def __init__(self, filename):
+    MAGIC = b'BLM2'
+    HEADER_SIZE = 12
+    CAN_FORGET = False
+    LEGACY_SIZE = 24 * 1024
+
+    def __init__(self, filename, m_bits=None, k=None):
         self.filename = filename
+        self.legacy_filename = filename.replace('.bin', '_v1.bin')
         self.do_verify = False
-        self.bits = bytearray(24 * 1024)
+        self.config_m = m_bits or setting_bloom_bytes * 8
+        self.config_k = k or setting_bloom_hashes
+        self.m = self.config_m
+        self.k = self.config_k
+        self.bits = bytearray(self.m >> 3)
+        self.legacy = False
         self.clear()
         self.load_at_startup()
 
@@ -121,23 +185,34 @@ class Bloom:
         # try to load the data
         try:
             size0 = get_file_size(self.filename)
-            assert size0 == len(self.bits), 'bad file size = {}'.format(size0)
+            if size0 == self.LEGACY_SIZE:
+                os.rename(self.filename, self.legacy_filename)
+                raise ValueError('moved old-style bloom file to {}'.format(self.legacy_filename))
             with open(self.filename,'rb') as f:
-                rsize = 256
-                pos = 0
-                while pos < len(self.bits):
-                    data = f.read(rsize)
-                    self.bits[pos:pos+rsize] = data
-                    pos += rsize
+                magic, m, k = struct.unpack('<4sIB3x', f.read(self.HEADER_SIZE))
+                assert magic == self.MAGIC and size0 == self.HEADER_SIZE + (m >> 3), 'bad bloom file'
+                if m != self.m or k != self.k:
+                    # the bits only mean something with the m and k they were made with;
+                    # the settings take effect at the next count reset
+                    btprint('bloom file has m={} k={}, keeping those'.format(m, k))
+                    self.m = m
+                    self.k = k
+                    self.bits = bytearray(m >> 3)
+                f.readinto(self.bits)
             btprint('Loaded bloom file ok')
         except Exception as ex:
             btprint('Unable to load bloom file, creating new: {}'.format(ex))
             self.save()
+        try:
+            self.legacy = get_file_size(self.legacy_filename) == self.LEGACY_SIZE
+        except OSError:
+            self.legacy = False
 
     def save(self, byte_list=None):
         if byte_list is None:
             try:
                 with open(self.filename,'wb') as f:
+                    f.write(struct.pack('<4sIB3x', self.MAGIC, self.m, self.k))
                     f.write(self.bits)
                 btprint('Saved complete bloom file')
             except Exception as ex:
@@ -146,7 +221,7 @@ class Bloom:
             try:
                 with open(self.filename,'rb+') as f:
                     for pos in byte_list:
-                        f.seek(pos)
+                        f.seek(self.HEADER_SIZE + pos)
                         f.write(self.bits[pos:pos+1])
                 btprint('Saved bloom bytes: {}'.format(byte_list))
             except Exception as ex:
@@ -159,6 +234,7 @@ class Bloom:
                 test_size = 256
                 test_offset = 0
                 with open(self.filename,'rb') as f:
+                    f.seek(self.HEADER_SIZE)
                     while test_offset < len(self.bits):
                         chk = f.read(test_size)
                         assert chk == self.bits[test_offset:test_offset+test_size],'verify mismatch'
@@ -168,35 +244,270 @@ class Bloom:
                 btprint('Unable to verify bloom file: {}'.format(ex))
 
     def clear(self):
-        for i in range(len(self.bits)):
-            self.bits[i] = 0
+        m = self.config_m
+        k = self.config_k
+        if m != self.m:
+            self.bits = None
+            gc.collect()
+            self.bits = bytearray(m >> 3)
+        else:
+            for i in range(len(self.bits)):
+                self.bits[i] = 0
+        self.m = m
+        self.k = k
+        if self.legacy:
+            try:
+                os.remove(self.legacy_filename)
+            except OSError:
+                pass
+            self.legacy = False
+
+    def positions(self, addr, addr_type):
+        key = bytes(addr) + bytes([addr_type])
+        h1 = fnv1a32(key)
+        h2 = fnv1a32(key, 0x5bd1e995) | 1 # odd, so the k positions differ
+        m = self.m
+        for i in range(self.k):
+            yield ((h1 + i * h2) & 0xffffffff) % m
+
+    def in_legacy(self, addr):
+        '''was addr in the old-style filter? reads 3 bytes of the file'''
+        try:
+            with open(self.legacy_filename, 'rb') as f:
+                for field in range(3):
+                    bit_index = (addr[field * 2] << 8) | addr[field * 2 + 1]
+                    f.seek((bit_index >> 3) + field * 8192)
+                    if (f.read(1)[0] & (1 << (bit_index & 7))) == 0:
+                        return False
+            return True
+        except Exception as ex:
+            btprint('Unable to read old bloom file: {}'.format(ex))
+            self.legacy = False
+            return False
 
-    def add(self, addr):
+    def contains(self, addr, addr_type=0):
+        for bit_index in self.positions(addr, addr_type):
+            if (self.bits[bit_index >> 3] & (1 << (bit_index & 7))) == 0:
+                return False
+        return True
+
+    def remove(self, addr, addr_type=0):
+        return False # bits are shared between addresses, so a bloom can't forget
+
+    def add(self, addr, addr_type=0):
         update_bytes = []
-        is_new = False
-        for field in range(3):
-            bit_index = (addr[field * 2] << 8) | addr[field * 2 + 1]
-            pos = (bit_index >> 3) + field * 8192
+        for bit_index in self.positions(addr, addr_type):
+            pos = bit_index >> 3
             mask = 1 << (bit_index & 7)
             if (self.bits[pos] & mask) == 0:
                 self.bits[pos] |= mask
                 update_bytes.append(pos)
-                is_new = True
-        if is_new:
+        is_new = len(update_bytes) > 0
+        if is_new and self.legacy and self.in_legacy(addr):
+            is_new = False
+        if update_bytes:
             self.save(update_bytes)
         return is_new
 print('////1040///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
+class CuckooFilter:
+    '''
+    A "seen before" filter like Bloom, but it can forget addresses, which
+    home devices and "143.forget" need, and at low false positive rates it
+    takes fewer bytes per address (tools/filter_bench.py compares them).
+    Each address keeps a 16 bit fingerprint in one of two buckets of 4
+    slots; when both are full, fingerprints are moved to their other bucket
+    to make room. Only the buckets that changed are written back to flash.
+    It holds about 0.95 * 4 * buckets addresses; past that, new addresses
+    still count but aren't remembered until the next count reset.
+    File: b'CKO1', '<IB3x' number of buckets and slots per bucket, then the
+    buckets, 2 bytes (little endian) per slot, 0 = empty.
+    '''
+    MAGIC = b'CKO1'
+    HEADER_SIZE = 12
+    SLOTS = 4
+    BUCKET_BYTES = 2 * SLOTS
+    MAX_KICKS = 250
+    CAN_FORGET = True
+
+    def __init__(self, filename, num_bytes=None):
+        self.filename = filename
+        self.do_verify = False
+        self.config_buckets = (num_bytes or setting_cuckoo_bytes) // self.BUCKET_BYTES
+        self.num_buckets = self.config_buckets
+        self.bits = bytearray(self.num_buckets * self.BUCKET_BYTES)
+        self.count = 0
+        self.victim = None # (bucket, fingerprint) that found no room
+        self.load_at_startup()
+
+    def load_at_startup(self):
+        try:
+            size0 = get_file_size(self.filename)
+            with open(self.filename,'rb') as f:
+                magic, num_buckets, slots = struct.unpack('<4sIB3x', f.read(self.HEADER_SIZE))
+                assert magic == self.MAGIC and slots == self.SLOTS, 'bad cuckoo file'
+                assert size0 == self.HEADER_SIZE + num_buckets * self.BUCKET_BYTES, 'bad cuckoo file size'
+                if num_buckets != self.num_buckets:
+                    # a fingerprint's buckets depend on the number of buckets;
+                    # setting_cuckoo_bytes takes effect at the next count reset
+                    btprint('cuckoo file has {} buckets, keeping those'.format(num_buckets))
+                    self.num_buckets = num_buckets
+                    self.bits = None
+                    gc.collect()
+                    self.bits = bytearray(num_buckets * self.BUCKET_BYTES)
+                f.readinto(self.bits)
+            bits = self.bits
+            self.count = sum(1 for i in range(0, len(bits), 2) if bits[i] or bits[i + 1])
+            btprint('Loaded cuckoo file ok, {} addresses'.format(self.count))
+        except Exception as ex:
+            btprint('Unable to load cuckoo file, creating new: {}'.format(ex))
+            self.clear()
+            self.save()
+
+    def save(self, bucket_list=None):
+        if bucket_list is None:
+            try:
+                with open(self.filename,'wb') as f:
+                    f.write(struct.pack('<4sIB3x', self.MAGIC, self.num_buckets, self.SLOTS))
+                    f.write(self.bits)
+                btprint('Saved complete cuckoo file')
+            except Exception as ex:
+                btprint('Unable to save full cuckoo file: {}'.format(ex))
+        else:
+            try:
+                bb = self.BUCKET_BYTES
+                with open(self.filename,'rb+') as f:
+                    for b in bucket_list:
+                        f.seek(self.HEADER_SIZE + b * bb)
+                        f.write(self.bits[b * bb:(b + 1) * bb])
+                btprint('Saved cuckoo buckets: {}'.format(bucket_list))
+            except Exception as ex:
+                btprint('Unable to save partial cuckoo file: {}'.format(ex))
+        self.verify()
+
+    def verify(self):
+        if self.do_verify:
+            try:
+                with open(self.filename,'rb') as f:
+                    f.seek(self.HEADER_SIZE)
+                    assert f.read() == self.bits, 'verify mismatch'
+                btprint('Verified cuckoo file ok')
+            except Exception as ex:
+                btprint('Unable to verify cuckoo file: {}'.format(ex))
+
+    def clear(self):
+        if self.num_buckets != self.config_buckets:
+            self.num_buckets = self.config_buckets
+            self.bits = None
+            gc.collect()
+            self.bits = bytearray(self.num_buckets * self.BUCKET_BYTES)
+        else:
+            for i in range(len(self.bits)):
+                self.bits[i] = 0
+        self.count = 0
+        self.victim = None
+
+    def locate(self, addr, addr_type):
+        '''(fingerprint, first bucket) of an address'''
+        key = bytes(addr) + bytes([addr_type])
+        return (fnv1a32(key) >> 16) or 1, fnv1a32(key, 0x5bd1e995) % self.num_buckets
+
+    def other_bucket(self, b, fp):
+        # (h - b) mod n: from either bucket this gives the other one, for any n
+        return (((fp * 0x5bd1e995) & 0xffffffff) - b) % self.num_buckets
+
+    def find(self, b, fp):
+        '''byte offset of fp in bucket b, or -1'''
+        bits = self.bits
+        for pos in range(b * self.BUCKET_BYTES, (b + 1) * self.BUCKET_BYTES, 2):
+            if bits[pos] | (bits[pos + 1] << 8) == fp:
+                return pos
+        return -1
+
+    def put(self, pos, fp):
+        self.bits[pos] = fp & 0xff
+        self.bits[pos + 1] = fp >> 8
+
+    def is_victim(self, b, fp):
+        return self.victim is not None and self.victim[1] == fp and self.victim[0] in (b, self.other_bucket(b, fp))
+
+    def contains(self, addr, addr_type=0):
+        fp, b = self.locate(addr, addr_type)
+        return self.find(b, fp) >= 0 or self.find(self.other_bucket(b, fp), fp) >= 0 or self.is_victim(b, fp)
+
+    def insert(self, b, fp):
+        '''store fp in bucket b or its other bucket, moving others if needed; returns the changed buckets'''
+        self.count += 1
+        for bucket in (b, self.other_bucket(b, fp)):
+            pos = self.find(bucket, 0)
+            if pos >= 0:
+                self.put(pos, fp)
+                return [bucket]
+        changed = []
+        for kick in range(self.MAX_KICKS):
+            # swap fp for one of this bucket's, then try to place that one in its other bucket
+            pos = b * self.BUCKET_BYTES + 2 * ((fp + kick) % self.SLOTS)
+            old = self.bits[pos] | (self.bits[pos + 1] << 8)
+            self.put(pos, fp)
+            if b not in changed:
+                changed.append(b)
+            fp = old
+            b = self.other_bucket(b, fp)
+            pos = self.find(b, 0)
+            if pos >= 0:
+                self.put(pos, fp)
+                if b not in changed:
+                    changed.append(b)
+                return changed
+        # no room: keep the last one aside, the filter is full
+        self.victim = (b, fp)
+        btprint('cuckoo filter is full ({} addresses)'.format(self.count))
+        return changed
+
+    def add(self, addr, addr_type=0):
+        if self.contains(addr, addr_type):
+            return False
+        if self.victim is None:
+            fp, b = self.locate(addr, addr_type)
+            changed = self.insert(b, fp)
+            if changed:
+                self.save(changed)
+        return True
+
+    def remove(self, addr, addr_type=0):
+        fp, b = self.locate(addr, addr_type)
+        if self.is_victim(b, fp):
+            self.victim = None
+            self.count -= 1
+            return True
+        for bucket in (b, self.other_bucket(b, fp)):
+            pos = self.find(bucket, fp)
+            if pos >= 0:
+                self.put(pos, 0)
+                self.count -= 1
+                changed = [bucket]
+                if self.victim is not None:
+                    # now there's room for the one that was left out
+                    vb, vfp = self.victim
+                    self.victim = None
+                    self.count -= 1
+                    changed += [x for x in self.insert(vb, vfp) if x != bucket]
+                self.save(changed)
+                return True
+        return False
+print('////1045///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+
 class HistoryBar:
     def __init__(self, filename):
         self.filename = filename
         self.num_columns = 8 * 15 # one column every 4 minutes for 8 hours
-        self.data = bytearray(self.num_columns * 2)
+        self.data = array('H', [0] * self.num_columns)
         self.update_period = 60#4 * 60
         self.draw_period = 4*60#4 * 60
         self.start_index = 0
         self.last_update_time = time.monotonic()
         self.last_draw_time = time.monotonic()
+        self.drawn_digest = 0 # fnv1a32 of the columns, oldest first, the bar was last drawn with
         self.load_at_startup()
 
     def periodic_update(self, cc):
@@ -219,6 +530,10 @@ class HistoryBar:
         btprint('drawing historybar...')
         t = time.monotonic()
         self.last_draw_time = t
+        # in display order, the same order save() writes: a reload starts at
+        # index 0 but draws the same bar, so it has to get the same digest
+        si = self.start_index
+        self.drawn_digest = fnv1a32(bytes(self.data[:si]), fnv1a32(bytes(self.data[si:])))
         x = (eink.width - self.num_columns) >> 1
         y = 16
         w = self.num_columns
@@ -229,24 +544,58 @@ class HistoryBar:
         d = eink.display
         d.fill_rect(x, y, w, h, Adafruit_EPD.WHITE)
         d.fill_rect(x-1, basey, w+2, 1, Adafruit_EPD.BLACK)
-        maxval = 0
-        for i in range(self.num_columns):
-            maxval = max(maxval, self.get_value(i))
+        maxval = max(self.data)
         if maxval > 0:
             if maxval < 10:
                 maxval = 10
             scale = h / maxval
             if scale < 1.0:
                 scale = 1.0
-            for i in range(self.num_columns):
-                dx = (i + self.num_columns - self.start_index) % self.num_columns
-                dsize = int(scale * self.get_value(i))
-                if dsize:
-                    d.fill_rect(x+dx, basey - dsize, 1, dsize, Adafruit_EPD.BLACK)
+            self.blit_columns(eink, x, basey, scale)
         maxtext = '{}'.format(int(maxval))
         d.text(maxtext, x+w-tw*len(maxtext), y, Adafruit_EPD.BLACK)
         d.text('2 hours', x, y + h + 1, Adafruit_EPD.BLACK)
-        eink.add_dirty_rect((x-1,y,w+2,h + th + 1))
+        eink.add_dirty_rect((x-1,y,w+2,h + th + 1), 'history')
+
+    def blit_columns(self, eink, x, basey, scale):
+        '''
+        Rasterize the bars straight into the framebuffer as vertical spans:
+        each byte column is written once per row, from the base up, with the
+        bits of the bars still taller than that row (black cleared, red set).
+        On a monochrome panel both planes are one buffer, so only black is drawn.
+        '''
+        n = self.num_columns
+        bx0 = x >> 3
+        nbytes = ((x + n + 7) >> 3) - bx0
+        heights = bytearray(nbytes * 8) # per pixel column, from the start of byte bx0
+        lead = x & 7
+        data = self.data
+        start = self.start_index
+        for dx in range(n):
+            dsize = int(scale * data[(dx + start) % n])
+            heights[lead + dx] = dsize if dsize < basey else basey
+        black = eink.framebuf[0]
+        red = eink.framebuf[1]
+        mono = red is black
+        stride = eink.stride
+        for b in range(nbytes):
+            cols = heights[b << 3:(b << 3) + 8]
+            mask = 0
+            for bit in range(8):
+                if cols[bit]:
+                    mask |= 0x80 >> bit
+            i = (basey - 1) * stride + bx0 + b
+            row = 0
+            for top in sorted(set(cols)):
+                while row < top:
+                    black[i] &= ~mask
+                    if not mono:
+                        red[i] |= mask
+                    i -= stride
+                    row += 1
+                for bit in range(8):
+                    if cols[bit] == top:
+                        mask &= ~(0x80 >> bit)
 
     def draw_update(self, eink):
         t = time.monotonic()
@@ -254,29 +603,24 @@ class HistoryBar:
             self.draw(eink)
 
     def set_value(self, index, value):
-        i = index << 1
-        self.data[i] = value & 0xff
-        self.data[i + 1] = (value >> 8) & 0xff
+        self.data[index] = value
 
     def get_value(self, index):
-        i = index << 1
-        return self.data[i] | (self.data[i + 1] << 8)
+        return self.data[index]
 
     def load_at_startup(self):
         # try to load the data
         try:
-            with open(self.filename,'rb') as f:
-                in_bytes = f.read()
-                if len(in_bytes) == len(self.data):
-                    for i in range(len(self.data)):
-                        self.data[i] = in_bytes[i]
+            if get_file_size(self.filename) == len(self.data) * 2:
+                with open(self.filename,'rb') as f:
+                    f.readinto(self.data)
             btprint('Loaded historybar file ok')
         except Exception as ex:
             btprint('Unable to load historybar file: {}'.format(ex))
 
     def save(self, index_list=None):
         try:
-            si = self.start_index << 1
+            si = self.start_index
             with open(self.filename,'wb') as f:
                 f.write(self.data[si:])
                 if si > 0:
@@ -286,11 +630,367 @@ class HistoryBar:
             btprint('Unable to save full historybar file: {}'.format(ex))
 print('////1050///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
+class HomeRegistry:
+    '''
+    Home devices: addresses seen in the first minutes after startup or a
+    count reset, which never count. Kept in flash so a reboot doesn't count
+    them again, in one fixed bytearray so a busy home or office can't use
+    up memory: up to setting_home_devices_max records of a 6 byte address
+    and '<I' last seen, sorted by address for a binary search. When it's
+    full, the device not seen for longest makes room.
+    Last seen is in registry seconds, which only run while the badge is on:
+    the file keeps the time it was saved and the clock carries on from there.
+    File: b'HOM1', '<HHI' record count, spare, registry seconds, then the records.
+    '''
+    MAGIC = b'HOM1'
+    HEADER_SIZE = 12
+    RECORD_SIZE = 10
+    SAVE_PERIOD = 10 * 60 # last seen times are saved this often, new devices right away
+
+    def __init__(self, filename, max_devices=None):
+        self.filename = filename
+        self.max_devices = max_devices or setting_home_devices_max
+        self.data = bytearray(self.max_devices * self.RECORD_SIZE)
+        self.count = 0
+        self.clock_base = -int(time.monotonic())
+        self.need_save = False
+        self.last_save = time.monotonic()
+        self.load_at_startup()
+
+    def now(self):
+        return self.clock_base + int(time.monotonic())
+
+    def load_at_startup(self):
+        try:
+            with open(self.filename,'rb') as f:
+                magic, count, spare, saved_now = struct.unpack('<4sHHI', f.read(self.HEADER_SIZE))
+                assert magic == self.MAGIC, 'bad home device file'
+                records = f.read(count * self.RECORD_SIZE)
+            self.clock_base = saved_now - int(time.monotonic())
+            rs = self.RECORD_SIZE
+            self.count = 0
+            # with a smaller setting_home_devices_max, drop the ones not seen for longest
+            order = sorted(range(count), key=lambda i: -struct.unpack_from('<I', records, i * rs + 6)[0])
+            for i in sorted(order[:self.max_devices]):
+                self.data[self.count * rs:(self.count + 1) * rs] = records[i * rs:(i + 1) * rs]
+                self.count += 1
+            btprint('Loaded {} home devices'.format(self.count))
+        except Exception as ex:
+            btprint('Unable to load home device file, creating new: {}'.format(ex))
+            self.save()
+
+    def save(self):
+        try:
+            with open(self.filename,'wb') as f:
+                f.write(struct.pack('<4sHHI', self.MAGIC, self.count, 0, self.now()))
+                f.write(memoryview(self.data)[:self.count * self.RECORD_SIZE])
+            self.need_save = False
+            self.last_save = time.monotonic()
+        except Exception as ex:
+            btprint('Unable to save home device file: {}'.format(ex))
+
+    def periodic_update(self):
+        if self.need_save and time.monotonic() > self.last_save + self.SAVE_PERIOD:
+            self.save()
+
+    def clear(self):
+        self.count = 0
+        self.need_save = True
+
+    def find(self, addr):
+        '''index of addr, or where it would go'''
+        lo = 0
+        hi = self.count
+        rs = self.RECORD_SIZE
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if bytes(self.data[mid * rs:mid * rs + 6]) < addr:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def has(self, i, addr):
+        return i < self.count and self.data[i * self.RECORD_SIZE:i * self.RECORD_SIZE + 6] == addr
+
+    def __contains__(self, addr):
+        return self.has(self.find(addr), addr)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield bytes(self.data[i * self.RECORD_SIZE:i * self.RECORD_SIZE + 6])
+
+    def touch(self, addr):
+        '''note that a home device is still around'''
+        i = self.find(addr)
+        if self.has(i, addr):
+            pos = i * self.RECORD_SIZE + 6
+            now = self.now()
+            if now - struct.unpack_from('<I', self.data, pos)[0] >= 60:
+                struct.pack_into('<I', self.data, pos, now)
+                self.need_save = True
+
+    def remove_at(self, i):
+        rs = self.RECORD_SIZE
+        self.data[i * rs:(self.count - 1) * rs] = self.data[(i + 1) * rs:self.count * rs]
+        self.count -= 1
+
+    def add(self, addr):
+        i = self.find(addr)
+        if self.has(i, addr):
+            self.touch(addr)
+            return
+        if self.count >= self.max_devices:
+            rs = self.RECORD_SIZE
+            oldest = min(range(self.count), key=lambda j: struct.unpack_from('<I', self.data, j * rs + 6)[0])
+            btprint('home devices full, forgetting {}'.format(addr_to_hex(self.data[oldest * rs:oldest * rs + 6])))
+            self.remove_at(oldest)
+            if oldest < i:
+                i -= 1
+        rs = self.RECORD_SIZE
+        self.data[(i + 1) * rs:(self.count + 1) * rs] = self.data[i * rs:self.count * rs]
+        self.data[i * rs:i * rs + 6] = addr
+        struct.pack_into('<I', self.data, i * rs + 6, self.now())
+        self.count += 1
+        self.save()
+
+    def discard(self, addr):
+        i = self.find(addr)
+        if self.has(i, addr):
+            self.remove_at(i)
+            self.save()
+print('////1055///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+
+class Histogram:
+    '''
+    How long encounters last, from seconds to hours, in a fixed 264 bytes
+    instead of a scan of the del lines in the logs. Buckets are log scale
+    with 4 steps per doubling (like HDR histograms): 0-3 seconds get one
+    bucket each, then [4,5), [5,6), [6,7), [7,8), [8,10) ... up to a day and a
+    half; longer ones go in the last bucket. Adding a duration is one bucket
+    increment; the file is written at most once a minute.
+    File: b'HST1', '<B3x' number of buckets, then '<I' counts.
+    '''
+    MAGIC = b'HST1'
+    HEADER_SIZE = 8
+    NUM_BUCKETS = 64
+    SAVE_PERIOD = 60
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.counts = array('I', [0] * self.NUM_BUCKETS)
+        self.total = 0
+        self.version = 0 # goes up with every change, so the display knows when to redraw
+        self.need_save = False
+        self.last_save = time.monotonic()
+        self.load_at_startup()
+
+    def load_at_startup(self):
+        try:
+            with open(self.filename,'rb') as f:
+                magic, n = struct.unpack('<4sB3x', f.read(self.HEADER_SIZE))
+                assert magic == self.MAGIC and n == self.NUM_BUCKETS, 'bad histogram file'
+                f.readinto(self.counts)
+            self.total = sum(self.counts)
+            btprint('Loaded histogram, {} encounters'.format(self.total))
+        except Exception as ex:
+            btprint('Unable to load histogram file, creating new: {}'.format(ex))
+            self.save()
+
+    def save(self):
+        try:
+            with open(self.filename,'wb') as f:
+                f.write(struct.pack('<4sB3x', self.MAGIC, self.NUM_BUCKETS))
+                f.write(self.counts)
+            self.need_save = False
+            self.last_save = time.monotonic()
+        except Exception as ex:
+            btprint('Unable to save histogram file: {}'.format(ex))
+
+    def periodic_update(self):
+        if self.need_save and time.monotonic() > self.last_save + self.SAVE_PERIOD:
+            self.save()
+
+    def clear(self):
+        for i in range(self.NUM_BUCKETS):
+            self.counts[i] = 0
+        self.total = 0
+        self.version += 1
+        self.save()
+
+    @staticmethod
+    def bucket(seconds):
+        d = int(seconds)
+        if d < 4:
+            return max(0, d)
+        e = 2
+        while d >> (e + 1):
+            e += 1
+        return min(4 * (e - 1) + ((d >> (e - 2)) & 3), Histogram.NUM_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_start(b):
+        if b < 4:
+            return b
+        return (4 + (b & 3)) << ((b >> 2) - 1)
+
+    def add(self, seconds):
+        self.counts[self.bucket(seconds)] += 1
+        self.total += 1
+        self.version += 1
+        self.need_save = True
+
+    def percentile(self, pct):
+        '''start of the bucket holding the pct'th percent duration'''
+        target = self.total * pct / 100
+        seen = 0
+        for b in range(self.NUM_BUCKETS):
+            seen += self.counts[b]
+            if seen >= target and seen:
+                return self.bucket_start(b)
+        return 0
+
+    @staticmethod
+    def duration_text(seconds):
+        if seconds < 60:
+            return '{}s'.format(seconds)
+        if seconds < 3600:
+            return '{}m'.format(seconds // 60)
+        if seconds < 36000:
+            return '{:.1f}h'.format(seconds / 3600)
+        return '{}h'.format(seconds // 3600)
+
+    def summary_text(self):
+        '''a few characters for the e-ink: the median encounter length'''
+        if not self.total:
+            return ''
+        return 'p50 ' + self.duration_text(self.percentile(50))
+
+    def report(self):
+        '''"143.hist": every bucket in use, then the percentiles'''
+        btprint('encounter lengths, {} encounters'.format(self.total))
+        for b in range(self.NUM_BUCKETS):
+            if self.counts[b]:
+                btprint('{:>6}+ {}'.format(self.duration_text(self.bucket_start(b)), self.counts[b]))
+        btprint('p50 {} p90 {} p99 {}'.format(*[self.duration_text(self.percentile(p)) for p in (50, 90, 99)]))
+print('////1057///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+
+class EncounterSnapshot:
+    '''
+    Every setting_snapshot_seconds the active encounters are written to
+    flash, so a reset or brown-out doesn't start them all over (new add
+    lines, dials from zero, everyone nearby marked as a home device).
+    Times are seconds before the snapshot's epoch, the time.monotonic() it
+    was taken at. At boot, if the clock is still running past that epoch
+    (a soft reload) the gap is exact; after a hard reset it's the time
+    since boot plus half a snapshot period. That's only trusted after a
+    reset that doesn't cut the power (WARM_RESETS): after a power-on reset
+    (the switch, a flat battery), or one whose reason we can't tell, nobody
+    knows how long we were off, so nothing is restored. Encounters that would have ended during the gap are
+    dropped. A snapshot is only read once: it's removed at boot whether it
+    was restored or not, so a second reset can't bring back older
+    encounters or measure its gap from the old epoch. The next periodic
+    save writes a new one.
+    File: b'ENC1', '<fH2x' epoch and count, then per encounter
+    '<6sBbIIIB' address, flags (1 new, 2 home, 4 hopper), rssi, seconds
+    since first seen, since last seen, contact seconds, thumbprint length,
+    then the thumbprint.
+    '''
+    MAGIC = b'ENC1'
+    HEADER = '<4sfH2x'
+    RECORD = '<6sBbIIIB'
+    RECORD_SIZE = 21
+    WARM_RESETS = ('SOFTWARE', 'WATCHDOG', 'RESET_PIN', 'BROWNOUT')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.next_save_time = time.monotonic() + setting_snapshot_seconds
+        self.saved_empty = False
+
+    def periodic_update(self, cc):
+        t = time.monotonic()
+        if setting_snapshot_seconds <= 0 or t < self.next_save_time:
+            return
+        self.next_save_time = t + setting_snapshot_seconds
+        if cc.current_encounters or not self.saved_empty:
+            self.save(cc)
+
+    def save(self, cc):
+        t = time.monotonic()
+        try:
+            with open(self.filename, 'wb') as f:
+                f.write(struct.pack(self.HEADER, self.MAGIC, t, len(cc.current_encounters)))
+                for addr, enc in cc.current_encounters.items():
+                    flags = int(enc.is_new_device) | (int(enc.is_home_device) << 1) | (4 if enc.thumbprint else 0)
+                    thumbprint = enc.thumbprint or b''
+                    f.write(struct.pack(self.RECORD, addr, flags, max(-128, min(127, enc.rssi)),
+                                        int(t - enc.first_seen), int(t - enc.last_seen),
+                                        int(enc.contact_duration), len(thumbprint)) + thumbprint)
+            self.saved_empty = not cc.current_encounters
+        except Exception as ex:
+            btprint('Unable to save encounter snapshot: {}'.format(ex))
+
+    def restore(self, cc):
+        '''put the snapshot's encounters back; returns how many, or -1 for no usable snapshot'''
+        reason = get_reset_reason()
+        t = time.monotonic()
+        restored = -1
+        try:
+            with open(self.filename, 'rb') as f:
+                magic, epoch, count = struct.unpack(self.HEADER, f.read(12))
+                assert magic == self.MAGIC, 'bad snapshot file'
+                restored = 0
+                if t >= epoch:
+                    gap = t - epoch # the clock kept running: a soft reload
+                elif reason in self.WARM_RESETS:
+                    gap = t + setting_snapshot_seconds / 2
+                else:
+                    restored = -1 # no idea how long we were off: skip the records
+                    count = 0
+                for i in range(count):
+                    addr, flags, rssi, first_ago, last_ago, duration, tlen = struct.unpack(
+                        self.RECORD, f.read(self.RECORD_SIZE))
+                    thumbprint = f.read(tlen) if tlen else None
+                    if last_ago + gap > setting_end_encounter_time:
+                        continue
+                    enc = Encounter(bool(flags & 1), thumbprint if flags & 4 else None)
+                    enc.first_seen = t - gap - first_ago
+                    enc.last_seen = t - gap - last_ago
+                    enc.dial_time = enc.last_seen - enc.first_seen
+                    enc.contact_duration = duration
+                    enc.is_home_device = bool(flags & 2)
+                    enc.rssi = rssi
+                    cc.current_encounters[addr] = enc
+                    restored += 1
+        except Exception as ex:
+            btprint('No encounter snapshot: {}'.format(ex))
+            self.remove()
+            return -1
+        self.remove()
+        if restored < 0:
+            btprint('{} reset, not restoring encounters'.format(reason))
+            return -1
+        btprint('Restored {} of {} encounters ({} reset, {}s gap)'.format(restored, count, reason, int(gap)))
+        cc.lager.log_str('restore,{},{},{},{},{}'.format(int(t), cc.get_total_unique(), restored, count, reason))
+        return restored
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+print('////1058///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+
 class DoubleLager:
     def __init__(self):
         self.log_file_max_size = 1024 * 100
         self.filenames = ['/data_log0.txt', '/data_log1.txt']
         self.log_index = 0
+        self.rotations = 0 # each one moves every read_logs() offset, see FrameExporter
+        self.paused = False # set by the MemoryGovernor when memory is short
         try:
             size0 = get_file_size(self.filenames[0])
             if size0 >= self.log_file_max_size:
@@ -326,17 +1026,35 @@ class DoubleLager:
 
     def log_str(self, line):
         '''write a string to the log'''
+        if self.paused:
+            return
         try:
             with open(self.filenames[self.log_index],'a') as f:
                 if f.tell() <= self.log_file_max_size:
                     f.write(line+'\n')
                 else:
                     self.log_index = (self.log_index + 1) & 1
+                    self.rotations += 1
                     with open(self.filenames[self.log_index],'w') as f2:
                         f2.write(line+'\n')
         except Exception as ex:
             btprint('failed to write log: {}'.format(ex))
 
+    def read_logs(self, offset, n):
+        '''up to n bytes of the logs, older file first, as if they were one file'''
+        for i in range(2):
+            filename = self.filenames[(self.log_index + i + 1) & 1]
+            try:
+                size = get_file_size(filename)
+            except OSError:
+                continue
+            if offset < size:
+                with open(filename, 'rb') as f:
+                    f.seek(offset)
+                    return f.read(min(n, size - offset))
+            offset -= size
+        return b''
+
     def log_dump(self, bt=None):
         '''Read the logs out to stdout and bt-connect'''
         for i in range(2):
@@ -350,25 +1068,111 @@ class DoubleLager:
                 btprint('failed to read log: {}'.format(ex))
 print('////1060///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
+class RecentlyEnded:
+    '''
+    Encounters the MemoryGovernor's cap ended while their device may still
+    be around. If the device shows up again it picks its encounter back up
+    instead of counting as new: by address, or for a hopper by its
+    thumbprint, the way a hopper migrates. Each entry is used once.
+    The histogram gets an entry's contact only once it's really over: when
+    it expires (not seen for setting_end_encounter_time, as an encounter
+    would have ended anyway) or is pushed out, so a device that comes back
+    is one contact, not two.
+    A fixed table of RECORDS records, so it costs the same in any crowd:
+    6 byte address, '<I' fnv1a32 of the thumbprint (0: none), '<II' first
+    and last seen (whole seconds), '<B' flags (1: the encounter was a new
+    device, 0x80: in use). New entries go in a free record, or over the
+    oldest when there isn't one.
+    '''
+    RECORDS = 64
+    RECORD_SIZE = 19
+    FLAGS = 18
+    IN_USE = 0x80
+
+    def __init__(self):
+        self.data = bytearray(self.RECORDS * self.RECORD_SIZE)
+        self.next = 0 # the oldest record, when they're all in use
+
+    def end(self, pos, histogram):
+        if histogram is not None:
+            first_seen, last_seen = struct.unpack_from('<II', self.data, pos + 10)
+            histogram.add(last_seen - first_seen)
+        self.data[pos + self.FLAGS] = 0
+
+    def add(self, addr, encounter, histogram):
+        rs = self.RECORD_SIZE
+        i = self.next
+        for j in range(self.RECORDS):
+            if not self.data[j * rs + self.FLAGS] & self.IN_USE:
+                i = j
+                break
+        else:
+            self.next = (self.next + 1) % self.RECORDS
+            self.end(i * rs, histogram) # pushed out, so that contact is over
+        pos = i * rs
+        self.data[pos:pos + 6] = addr
+        thumb = fnv1a32(encounter.thumbprint) if encounter.thumbprint else 0
+        struct.pack_into('<IIIB', self.data, pos + 6, thumb, int(encounter.first_seen), int(encounter.last_seen),
+                         self.IN_USE | int(encounter.is_new_device))
+
+    def take(self, addr, thumbprint=None):
+        '''
+        (flags, first seen) of the entry for addr (or thumbprint), which is
+        used up; None if there isn't one
+        '''
+        thumb = fnv1a32(thumbprint) if thumbprint else 0
+        rs = self.RECORD_SIZE
+        found = None
+        for pos in range(0, self.RECORDS * rs, rs):
+            if not self.data[pos + self.FLAGS] & self.IN_USE:
+                continue
+            if self.data[pos:pos + 6] == addr:
+                found = pos
+                break
+            if thumb and found is None and struct.unpack_from('<I', self.data, pos + 6)[0] == thumb:
+                found = pos # keep looking for the address itself
+        if found is None:
+            return None
+        flags = self.data[found + self.FLAGS]
+        self.data[found + self.FLAGS] = 0
+        return flags, struct.unpack_from('<I', self.data, found + 10)[0]
+
+    def expire(self, t, histogram):
+        '''end the entries not seen for setting_end_encounter_time'''
+        for pos in range(0, self.RECORDS * self.RECORD_SIZE, self.RECORD_SIZE):
+            if (self.data[pos + self.FLAGS] & self.IN_USE and
+                    t > struct.unpack_from('<I', self.data, pos + 14)[0] + setting_end_encounter_time):
+                self.end(pos, histogram)
+print('////1062///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+
 class ContactCounts:
     def __init__(self):
         self.startup_time = time.monotonic()
         self.home_count_begin = time.monotonic()
         self.current_encounters = {}
-        self.homies = set() # addresses of home devices we don't need to count
+        self.homies = HomeRegistry('/data_homies.bin') # addresses of home devices we don't need to count
+        self.max_encounters = 0 # 0: no limit; the MemoryGovernor sets one when memory is short
+        self.recently_ended = RecentlyEnded() # what the cap ended, so it isn't counted again
         self.check_for_hoppers = True
         self.persistent_data = {'unique_counts':0, 'sample_seconds':0, '5min':0, '30min':0, '2hour':0}
         self.count_file_name = '/data_counter.txt'
         self.need_save = False
         self.is_low_power = False
-        self.bloom = Bloom('/data_bloom.bin')
+        if setting_seen_filter == 'cuckoo':
+            self.seen_filter = CuckooFilter('/data_cuckoo.bin')
+        else:
+            self.seen_filter = Bloom('/data_bloom.bin')
         self.reset_counts_to_zero()
         self.load_persistent_counter_data_at_startup()
         self.reset_button_hold_timer = 0
         self.history_bar = HistoryBar('/data_historybar.bin')
         self.lager = DoubleLager()
         self.lager.log_startup(self.get_total_unique())
-        # self.histogram = Histogram('/histogram.bin')
+        self.histogram = Histogram('/histogram.bin')
+        self.snapshot = EncounterSnapshot('/data_encounters.bin')
+        if self.snapshot.restore(self) >= 0:
+            # a warm restart: whoever is around now isn't a home device
+            self.home_count_begin -= 60 * setting_home_count_minutes
 
     def update_dials(self):
         # TODO simplify this
@@ -401,6 +1205,10 @@ class ContactCounts:
         if self.need_save:
             self.save_persistent_data()
             self.need_save = False
+        self.homies.periodic_update()
+        if self.histogram is not None:
+            self.histogram.periodic_update()
+        self.snapshot.periodic_update(self)
 
         # enggage power saver
         if buttons.switch() != self.is_low_power:
@@ -416,9 +1224,14 @@ class ContactCounts:
                     neo_module.set_all((0,0,0))
                 self.reset_counts_to_zero()
                 self.save_persistent_data()
-                if self.bloom:
-                    self.bloom.clear()
-                    self.bloom.save()
+                if self.seen_filter:
+                    self.seen_filter.clear()
+                    self.seen_filter.save()
+                if not setting_home_keep_on_reset:
+                    self.homies.clear()
+                    self.homies.save()
+                if self.histogram is not None:
+                    self.histogram.clear()
                 self.reset_button_hold_timer = 0
         else:
             self.reset_button_hold_timer = 0
@@ -445,15 +1258,22 @@ class ContactCounts:
         self.persistent_data['2hour'] = 0
         self.home_count_begin = time.monotonic()
 
-    def check_if_new(self, addr):
+    def check_if_new(self, addr, addr_type=0):
         is_new = True
-        if self.bloom:
-            is_new = self.bloom.add(addr)
+        if self.seen_filter:
+            if self.in_home_mode() and self.seen_filter.CAN_FORGET:
+                # home devices aren't counted anyway; leave them out so they don't fill the filter
+                is_new = not self.seen_filter.contains(addr, addr_type)
+            else:
+                is_new = self.seen_filter.add(addr, addr_type)
         return is_new
 
+    def forget(self, addr, addr_type):
+        '''take a static address out of the "seen before" filter, so it counts again'''
+        return bool(self.seen_filter) and self.seen_filter.remove(addr, addr_type)
+
     def in_home_mode(self):
-        home_count_minutes = 2 # stay in home mode for this many minutes after startup or reset
-        return time.monotonic() < self.home_count_begin + 60 * home_count_minutes
+        return time.monotonic() < self.home_count_begin + 60 * setting_home_count_minutes
 
     def new_encounter(self, new_bloom, thumbprint):
         if new_bloom and not self.in_home_mode():
@@ -491,18 +1311,25 @@ class ContactCounts:
             encounter = self.current_encounters[addr]
             if addr in new_addrs:
                 encounter.last_seen = this_time
+                encounter.rssi = new_addrs[addr].rssi
                 encounter.contact_duration += delta_time
+                if encounter.is_home_device and not encounter.thumbprint:
+                    self.homies.touch(addr)
                 if encounter.thumbprint:
                     encounter.thumbprint = make_thumbprint(new_addrs[addr])
                 del new_addrs[addr]
             else:
                 if this_time > encounter.last_seen + setting_end_encounter_time:
                     self.lager.log_del_contact(self.get_total_unique(), addr, self.current_encounters[addr])
+                    if self.histogram is not None:
+                        self.histogram.add(encounter.last_seen - encounter.first_seen)
                     del self.current_encounters[addr]
                 else:
                     if encounter.thumbprint:
                         old_hoppers[addr] = encounter
 
+        self.recently_ended.expire(this_time, self.histogram)
+
 #        print('eek',new_contacts)
         # now for any addresses which are new, create/migrate contacts
         for addr,nc in new_addrs.items():
@@ -519,12 +1346,24 @@ class ContactCounts:
                         new_type = 'migrated hopper'
                         break
                 if encounter is None:
-                    new_type = 'new hopper'
-                    encounter = self.new_encounter(True, thumbprint)
+                    ended = self.recently_ended.take(addr, thumbprint)
+                    if ended is not None:
+                        new_type = 'returning hopper'
+                        encounter = Encounter(bool(ended[0] & 1), thumbprint)
+                        encounter.first_seen = ended[1]
+                    else:
+                        new_type = 'new hopper'
+                        encounter = self.new_encounter(True, thumbprint)
             else:
-                new_bloom = self.check_if_new(addr) and not addr in self.homies
-                new_type = 'new static' if new_bloom else 'known static'
-                encounter = self.new_encounter(new_bloom, None)
+                ended = self.recently_ended.take(addr)
+                if ended is not None:
+                    new_type = 'returning static'
+                    encounter = Encounter(bool(ended[0] & 1), None)
+                    encounter.first_seen = ended[1]
+                else:
+                    new_bloom = not addr in self.homies and self.check_if_new(addr, nc.address.type)
+                    new_type = 'new static' if new_bloom else 'known static'
+                    encounter = self.new_encounter(new_bloom, None)
 
             if self.in_home_mode():
                 encounter.is_home_device = True
@@ -537,9 +1376,30 @@ class ContactCounts:
             self.lager.log_add_contact(self.get_total_unique(), addr, encounter, new_type)
             self.current_encounters[addr] = encounter
             encounter.last_seen = this_time
+            encounter.rssi = nc.rssi
             encounter.contact_duration += this_time - self.sample_last_time
 
         self.sample_last_time = this_time
+        if self.max_encounters and len(self.current_encounters) > self.max_encounters:
+            self.limit_encounters()
+
+    def limit_encounters(self):
+        '''
+        end the encounters not seen for longest, then the weakest, to get down
+        to max_encounters. Devices in the latest scan are still here and are
+        never ended; the ones that are go in recently_ended, so they don't
+        count again if they come back.
+        '''
+        extra = len(self.current_encounters) - self.max_encounters
+        if extra <= 0:
+            return 0
+        order = sorted([item for item in self.current_encounters.items() if item[1].last_seen < self.sample_last_time],
+                       key=lambda item: (item[1].last_seen, item[1].rssi))
+        for addr, encounter in order[:extra]:
+            self.lager.log_del_contact(self.get_total_unique(), addr, encounter)
+            self.recently_ended.add(addr, encounter, self.histogram) # the histogram gets it when it's really over
+            del self.current_encounters[addr]
+        return min(extra, len(order))
 
     def load_persistent_counter_data_at_startup(self):
         try:
@@ -579,6 +1439,190 @@ class ContactCounts:
                 print('Right button is down')
             # if buttons.switch():
             #     print('Switch is to the left')
+
+class MemoryGovernor:
+    '''
+    Keeps the counter running in a crowd instead of running out of memory
+    and rebooting. Each loop, after the scan, it compares free memory with
+    setting_mem_low_water and, while it stays under, degrades one step per
+    loop (straight to the last step under setting_mem_critical):
+      1: forget the thumbprints of hoppers not seen for a minute (they
+         can't migrate any more, but still count)
+      2: cap the encounters at what we have now, minus a quarter; the ones
+         not seen for longest, then the weakest, are ended (never ones in
+         the latest scan, and ContactCounts.recently_ended keeps them from
+         counting again). If memory is still short CAP_HOLD_SECONDS later,
+         when the ended ones have been collected, the cap is tightened again
+      3: pause optional writing: the log, the scan capture, UART exports
+    Once free memory is back over setting_mem_high_water for a minute it
+    undoes one step at a time. Every step goes to btprint and the log.
+    '''
+    STEPS = ('normal', 'drop hopper thumbprints', 'cap encounters', 'pause logging')
+    RECOVER_SECONDS = 60
+    CAP_HOLD_SECONDS = 10
+
+    def __init__(self):
+        self.step = 0
+        self.recover_time = None
+        self.cap_time = None # when the cap was last set
+
+    def report(self, cc, free, what):
+        text = 'memory {}k free: {}'.format(free // 1024, what)
+        btprint(text)
+        cc.lager.log_str('mem,{},{},{},{}'.format(int(time.monotonic()), free, self.step, what))
+
+    def periodic_update(self, cc, bt_module=None):
+        free = gc.mem_free()
+        if free < setting_mem_low_water:
+            self.recover_time = None
+            last = len(self.STEPS) - 1 if free < setting_mem_critical else self.step + 1
+            while self.step < min(last, len(self.STEPS) - 1):
+                self.step += 1
+                self.apply(cc, bt_module, free)
+            if self.step >= 2 and time.monotonic() >= self.cap_time + self.CAP_HOLD_SECONDS:
+                # still short with the cap in place, after it had time to free memory: tighten it
+                self.cap_encounters(cc, free)
+        elif self.step and free > setting_mem_high_water:
+            t = time.monotonic()
+            if self.recover_time is None:
+                self.recover_time = t + self.RECOVER_SECONDS
+            elif t >= self.recover_time:
+                self.undo(cc, bt_module, free)
+                self.recover_time = t + self.RECOVER_SECONDS
+
+    def out_of_memory(self, cc, bt_module=None):
+        '''a MemoryError got through: go straight to the last step'''
+        gc.collect()
+        free = gc.mem_free()
+        while self.step < len(self.STEPS) - 1:
+            self.step += 1
+            self.apply(cc, bt_module, free)
+        self.cap_encounters(cc, free)
+
+    def apply(self, cc, bt_module, free):
+        if self.step == 1:
+            t = time.monotonic()
+            n = 0
+            for enc in cc.current_encounters.values():
+                if enc.thumbprint and t > enc.last_seen + 60:
+                    enc.thumbprint = None
+                    n += 1
+            self.report(cc, free, 'step 1, dropped {} hopper thumbprints'.format(n))
+        elif self.step == 2:
+            self.report(cc, free, 'step 2, capping encounters')
+            self.cap_encounters(cc, free)
+        elif self.step == 3:
+            self.report(cc, free, 'step 3, pausing the log, scan capture and exports')
+            cc.lager.paused = True
+            if bt_module is not None:
+                if bt_module.capture:
+                    bt_module.capture.flush()
+                    bt_module.capture.paused = True
+                bt_module.exporter.paused = True
+                # the host can ask again later: log resumes still line up, the
+                # snapshot streams start over with a new generation
+                bt_module.exporter.stream_id = None
+                bt_module.exporter.data = None
+                bt_module.exporter.data_stream = None
+
+    def cap_encounters(self, cc, free):
+        self.cap_time = time.monotonic()
+        n = len(cc.current_encounters)
+        cap = max(8, n - n // 4)
+        if cc.max_encounters == 0 or cap < cc.max_encounters:
+            cc.max_encounters = cap
+            ended = cc.limit_encounters()
+            btprint('memory {}k free: at most {} encounters, ended {}'.format(free // 1024, cap, ended))
+
+    def undo(self, cc, bt_module, free):
+        if self.step == 3:
+            cc.lager.paused = False
+            if bt_module is not None:
+                bt_module.exporter.paused = False
+                if bt_module.capture:
+                    bt_module.capture.paused = False
+            self.report(cc, free, 'resumed the log, scan capture and exports')
+        elif self.step == 2:
+            cc.max_encounters = 0
+            self.report(cc, free, 'no encounter cap')
+        else:
+            self.report(cc, free, 'back to normal')
+        self.step -= 1
+print('////1065///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
+
+class GcPolicy:
+    '''
+    Decides when the main loop runs gc.collect(). A full collection on the
+    ~140k heap takes a while and used to happen twice every loop, right in
+    the scan cadence. Now the loop offers idle points (after a scan, before
+    the sleep) and the policy only collects there once setting_gc_alloc_bytes
+    have been allocated since the last collection, sooner while the e-ink
+    is refreshing (we're waiting on it anyway), and always when free memory
+    is under setting_mem_low_water, so the MemoryGovernor sees real numbers.
+    gc.threshold() (where there is one) is set above the budget as a
+    backstop, so the heap doesn't grow if idle points are missed.
+    Pause times are kept for "143.gc", and the loop's sleep is shortened by
+    the time spent collecting so the loop period stays steady. They're timed
+    with monotonic_ns() where there is one: monotonic() is a float32 on
+    CircuitPython, and after a few hours up it can't see a 10ms pause.
+    '''
+    def __init__(self):
+        self.alloc_budget = setting_gc_alloc_bytes
+        self.collections = 0
+        self.skipped = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.loop_ms = 0.0 # collecting time since the last take_loop_pause()
+        self.peak_alloc = 0 # sampled at the idle points, so only a lower bound
+        self.after_collect = gc.mem_alloc()
+        if hasattr(gc, 'threshold'):
+            gc.threshold(2 * self.alloc_budget)
+
+    def allocated(self):
+        alloc = gc.mem_alloc()
+        if alloc < self.after_collect:
+            self.after_collect = alloc # the VM collected on its own (gc.threshold, or a failed allocation)
+        return alloc - self.after_collect
+
+    def idle(self, eink_busy=False):
+        '''an idle point in the loop: collect if it's due'''
+        alloc = self.allocated()
+        self.peak_alloc = max(self.peak_alloc, gc.mem_alloc())
+        if (alloc >= self.alloc_budget or (eink_busy and alloc >= self.alloc_budget // 4) or
+                gc.mem_free() < setting_mem_low_water):
+            self.collect()
+        else:
+            self.skipped += 1
+
+    def collect(self):
+        if hasattr(time, 'monotonic_ns'):
+            t = time.monotonic_ns()
+            gc.collect()
+            ms = (time.monotonic_ns() - t) / 1000000
+        else:
+            t = time.monotonic()
+            gc.collect()
+            ms = (time.monotonic() - t) * 1000
+        self.after_collect = gc.mem_alloc()
+        self.collections += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.last_ms = ms
+        self.loop_ms += ms
+
+    def take_loop_pause(self):
+        '''seconds spent collecting since the last call'''
+        ms = self.loop_ms
+        self.loop_ms = 0.0
+        return ms / 1000
+
+    def stats_text(self):
+        avg = self.total_ms / self.collections if self.collections else 0
+        return 'gc: {} collections ({} skipped), pause avg {:.1f}ms max {:.1f}ms last {:.1f}ms, peak heap at idle points {}k, {}k since last'.format(
+            self.collections, self.skipped, avg, self.max_ms, self.last_ms,
+            self.peak_alloc // 1024, self.allocated() // 1024)
+print('////1067///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 ##
 ##################################################################
 
@@ -649,13 +1693,245 @@ print('////1105///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 #         self._rssi = entry.rssi
 #         return self
 
+class ScanCapture:
+    '''
+    Records what the radio saw, for replaying on a computer (tools/scan_trace.py).
+    Two files take turns, like DoubleLager, within setting_scan_capture_bytes.
+    Each file starts with b'SCN1' and a '<I' sequence number, then records:
+        'B' '<I' ms    boot: monotonic ms, a new session starts here
+        'T' '<I' ms    absolute time, at the start of each file and after long gaps
+        'S' '<HB'      a scan: 10 ms units since the last record, number of results
+          then per result '<6sBbB': address, type, rssi, payload length,
+          and the payload: the advertisement's AD structures, or (length | 0x80)
+          the fnv1a32 of its thumbprint as '<I'
+    Records are buffered and written a few hundred bytes at a time.
+    '''
+    MAGIC = b'SCN1'
+    HASHED = 0x80
+
+    def __init__(self):
+        self.filenames = ['/data_scan0.bin', '/data_scan1.bin']
+        self.file_max_size = setting_scan_capture_bytes // 2
+        self.buf = bytearray()
+        self.paused = False
+        self.seq = -1
+        self.index = 0
+        for i in range(2):
+            try:
+                with open(self.filenames[i], 'rb') as f:
+                    head = f.read(8)
+                if head[:4] == self.MAGIC and struct.unpack('<I', head[4:])[0] > self.seq:
+                    self.seq = struct.unpack('<I', head[4:])[0]
+                    self.index = i
+            except Exception:
+                pass
+        if self.seq < 0:
+            self.start_file(0)
+        self.last_ms = self.base_ms = self.now_ms()
+        self.last_flush_ms = self.last_ms
+        self.buf += struct.pack('<BI', ord('B'), self.last_ms)
+
+    def now_ms(self):
+        return int(time.monotonic() * 1000) & 0xffffffff
+
+    def start_file(self, index):
+        '''begin the next file; its first record gives the time the buffered records count from'''
+        self.seq += 1
+        self.index = index
+        with open(self.filenames[index], 'wb') as f:
+            f.write(self.MAGIC + struct.pack('<I', self.seq))
+            if self.seq:
+                f.write(struct.pack('<BI', ord('T'), self.base_ms))
+
+    def add_scan(self, items):
+        if self.paused:
+            return
+        t = self.now_ms()
+        dt = ((t - self.last_ms) & 0xffffffff) // 10
+        if dt > 0xffff:
+            self.buf += struct.pack('<BI', ord('T'), t)
+            dt = 0
+        self.last_ms = t
+        n = min(255, len(items))
+        self.buf += struct.pack('<BHB', ord('S'), dt, n)
+        for i in range(n):
+            nc = items[i]
+            if setting_scan_capture_raw:
+                payload = b''.join(bytes([len(v) + 1, k]) + v for k, v in nc.data_dict.items())[:127]
+                size = len(payload)
+            else:
+                payload = struct.pack('<I', fnv1a32(make_thumbprint(nc)))
+                size = self.HASHED | 4
+            self.buf += struct.pack('<6sBbB', nc.address.address_bytes, nc.address.type,
+                                    max(-128, min(127, nc.rssi)), size) + payload
+        if len(self.buf) >= 512 or t - self.last_flush_ms > 30000:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        try:
+            if get_file_size(self.filenames[self.index]) + len(self.buf) > self.file_max_size:
+                self.start_file((self.index + 1) & 1)
+            with open(self.filenames[self.index], 'ab') as f:
+                f.write(self.buf)
+        except Exception as ex:
+            btprint('failed to write scan capture: {}'.format(ex))
+        self.buf = bytearray()
+        self.base_ms = self.last_flush_ms = self.last_ms
+
+
+class FrameExporter:
+    '''
+    Sends a stream (encounters, log, bloom, history) over the UART as binary
+    frames, so a host can pull a badge's state at close to link speed:
+        header '<BBHHIH': magic 0xA5, stream id, request id, generation, offset, payload length
+        payload, then fnv1a32 of header + payload as '<I'
+    A frame with no payload, at offset = stream length, ends the stream.
+    Requested with "143.get <stream> <request id> <offset> [generation]";
+    after a dropped connection the host asks again from the last offset it
+    got, with the generation of the frames it got. Offsets only mean
+    something within one generation: a new snapshot of encounters, bloom or
+    history, or a log rotation, starts a new one. A resume whose generation
+    is gone is sent again from offset 0 with the new generation, so the host
+    starts over instead of splicing bytes from two different streams.
+    Frame magic is never valid ASCII, so the text lines sharing the UART
+    don't get mistaken for frames.
+    Status frames (see send_status) use the same layout with stream id 4.
+    The bloom stream is a copy of the bits of whichever "seen before" filter
+    is in use, taken when its generation starts.
+    '''
+    MAGIC = 0xA5
+    HEADER = '<BBHHIH'
+    HEADER_SIZE = 12
+    STREAMS = ('encounters', 'log', 'bloom', 'history')
+    ENCOUNTER = '<6sBIII' # address, flags, seconds since first seen, since last seen, contact seconds
+    STATUS_STREAM = 4
+    # unique count, sample seconds, scan number, free memory, encounters, 5min, 30min, 2hour dials, loop ms
+    STATUS = '<IIIIHHHHH'
+
+    def __init__(self, uart):
+        self.uart = uart
+        self.stream_id = None
+        self.req_id = 0
+        self.offset = 0
+        self.data = None # snapshot of the stream being sent, unless it's read from files
+        self.data_stream = None # which stream data is a snapshot of, kept for resumes
+        self.generation = 0
+        self.snapshots = 0
+        try:
+            self.boot_id = struct.unpack('<H', os.urandom(2))[0] # so generations don't repeat across reboots
+        except Exception:
+            self.boot_id = int(time.monotonic() * 1000) & 0xffff
+        self.lager = None
+        self.header = bytearray(self.HEADER_SIZE)
+        self.paused = False # no new transfers while memory is short
+
+    def is_busy(self):
+        return self.stream_id is not None
+
+    def start(self, cc, text):
+        '''"143.get <stream> <request id> <offset> [generation]": replaces any transfer in progress'''
+        if self.paused:
+            btprint('memory is short, try 143.get again later')
+            return
+        try:
+            words = text.split()
+            name = words[1]
+            req_id = int(words[2]) & 0xffff
+            offset = int(words[3]) if len(words) > 3 else 0
+            generation = int(words[4]) if len(words) > 4 else None
+            stream_id = self.STREAMS.index(name)
+        except Exception as ex:
+            btprint('bad 143.get ({}), streams: {}'.format(ex, ' '.join(self.STREAMS)))
+            return
+        fresh = False
+        if name == 'log':
+            self.data = None # the log is read from flash as it goes
+            self.data_stream = None
+            self.lager = cc.lager
+            self.generation = (self.boot_id + cc.lager.rotations) & 0xffff
+        elif not (offset and self.data is not None and self.data_stream == stream_id and
+                  generation == self.generation):
+            self.data = None
+            if name == 'encounters':
+                self.data = self.encounter_records(cc)
+            elif name == 'bloom':
+                self.data = bytes(cc.seen_filter.bits) # a copy: the filter keeps changing under a transfer
+            else:
+                hb = cc.history_bar
+                si = hb.start_index
+                self.data = bytes(hb.data[si:]) + bytes(hb.data[:si]) # oldest first, like the file
+            self.data_stream = stream_id
+            self.snapshots += 1
+            self.generation = (self.boot_id + self.snapshots) & 0xffff
+            fresh = True
+        # without a generation, a log offset is taken on trust (fleet_collector
+        # checks the bytes before it); a snapshot is never new at offset > 0
+        if offset and (generation != self.generation if generation is not None else fresh):
+            btprint('143.get {}: generation {} is gone, sending generation {} from 0'.format(
+                name, generation, self.generation))
+            offset = 0
+        self.stream_id = stream_id
+        self.req_id = req_id
+        self.offset = offset
+
+    def encounter_records(self, cc):
+        t = time.monotonic()
+        out = bytearray()
+        for addr, enc in cc.current_encounters.items():
+            flags = int(enc.is_new_device) | (int(enc.is_home_device) << 1) | (int(bool(enc.thumbprint)) << 2)
+            out += struct.pack(self.ENCOUNTER, addr, flags, int(t - enc.first_seen),
+                               int(t - enc.last_seen), int(enc.contact_duration))
+        return out
+
+    def read(self, offset, n):
+        '''up to n bytes of the stream at offset; empty at the end'''
+        if self.data is not None:
+            return bytes(self.data[offset:offset + n])
+        return self.lager.read_logs(offset, n)
+
+    def pump(self):
+        '''send a few frames; returns False once the stream has ended'''
+        if self.stream_id is None:
+            return False
+        chunk = setting_uart_mtu - self.HEADER_SIZE - 4
+        for i in range(setting_uart_frames_per_loop):
+            payload = self.read(self.offset, chunk)
+            self.send(self.stream_id, self.req_id, self.offset, payload)
+            if not payload:
+                self.stream_id = None
+                self.data = None
+                self.data_stream = None
+                return False
+            self.offset += len(payload)
+        return True
+
+    def send_status(self, seq, cc, loop_ms):
+        '''one status frame: request id is a sequence number, offset the badge's uptime'''
+        pd = cc.persistent_data
+        payload = struct.pack(self.STATUS, pd['unique_counts'], int(pd['sample_seconds']),
+                              cc.scan_serial_number, gc.mem_free(), len(cc.current_encounters),
+                              pd['5min'], pd['30min'], pd['2hour'], min(loop_ms, 0xffff))
+        self.send(self.STATUS_STREAM, seq & 0xffff, int(time.monotonic()), payload, 0)
+
+    def send(self, stream_id, req_id, offset, payload, generation=None):
+        if generation is None:
+            generation = self.generation
+        struct.pack_into(self.HEADER, self.header, 0, self.MAGIC, stream_id,
+                         req_id, generation, offset, len(payload))
+        check = fnv1a32(payload, fnv1a32(self.header))
+        self.uart.write(self.header + payload + struct.pack('<I', check))
+
+
 class BluetoothModule:
     def __init__(self):
         global radio
         radio = self.radio = adafruit_ble.BLERadio()
 
         # set up Bluefruit Connect
-        self.uart_server = UARTService()
+        self.init_uart(UARTService())
+        self.capture = ScanCapture() if setting_scan_capture else None
         self.advertisement = ProvideServicesAdvertisement(self.uart_server)
         self.was_connected = False
         self.radio.start_advertising(self.advertisement)
@@ -665,13 +1941,37 @@ class BluetoothModule:
             self.small_led = digitalio.DigitalInOut(board.D13)
         self.small_led.direction = digitalio.Direction.OUTPUT
 
+    def init_uart(self, uart):
+        '''the UART side on its own, so host tools can drive it without a radio'''
+        global uart_server
+        uart_server = self.uart_server = uart # btprint() writes here too
+        self.exporter = FrameExporter(uart)
+        self.text_status = False # '143.text 1' brings back the text status line every loop
+        self.gc_policy = None # main() hands over its GcPolicy for '143.gc'
+        self.status_period = 60 # seconds between status frames when nothing changes, 0 = only on change
+        self.status_seq = 0
+        self.last_status = None
+        self.next_status_time = 0
+        self.last_loop_time = time.monotonic()
+        self.loop_ms = 0
+
     def periodic_update(self, cc, buttons):
+        t = time.monotonic()
+        self.loop_ms = int((t - self.last_loop_time) * 1000)
+        self.last_loop_time = t
         self.small_led.value = False
         #t1 = time.monotonic()
+        min_rssi = setting_bt_rssi
+        if self.capture:
+            min_rssi = min(min_rssi, setting_scan_capture_rssi)
         scan_result = self.radio.start_scan(timeout=setting_bt_timeout,
-                                            minimum_rssi=setting_bt_rssi)
+                                            minimum_rssi=min_rssi)
         #t2 = time.monotonic()
         items = list(scan_result)
+        if self.capture:
+            self.capture.add_scan(items)
+            if min_rssi < setting_bt_rssi:
+                items = [nc for nc in items if nc.rssi >= setting_bt_rssi]
         #t3 = time.monotonic()
         #print(t2-t1, t3-t2, len(items))
         cc.update_contacts(list(items))
@@ -680,37 +1980,104 @@ class BluetoothModule:
         # update Bluefruit Connect
         if self.radio.connected:
             self.was_connected = True
-            # packet = Packet.from_stream(self.uart_server)
-            # if isinstance(packet, ColorPacket):
-            #     print(packet.color)
-            # INCOMING (RX) check for incoming text
-            if self.uart_server.in_waiting:
-                raw_bytes = self.uart_server.read(self.uart_server.in_waiting)
-                text = raw_bytes.decode().strip()
-                # print("raw bytes =", raw_bytes)
-                btprint("RX: {}".format(text))
-                if '143.all' in text:
-                    t = time.monotonic()
-                    order = sorted([(c.first_seen, addr) for addr,c in cc.current_encounters.items()])
-                    for i,o in enumerate(order):
-                        addr = o[1]
-                        enc = cc.current_encounters[addr]
-                        first = int((t - enc.first_seen) / 60)
-                        last = int((t - enc.last_seen) / 60)
-                        text = '{}: {} {}m {}m\n'.format(i, addrs_to_hex([addr]), first, last)
-                        self.uart_server.write(text.encode())
-                elif '143.log' in text:
-                    cc.lager.log_dump(self)
-
-            # OUTGOING (TX) periodically send text
+            self.uart_update(cc)
+        elif self.was_connected:
+            self.was_connected = False
+            self.last_status = None # a new connection gets a status frame straight away
+            self.exporter.stream_id = None # the host resumes from its last offset
+            self.radio.start_advertising(self.advertisement)
+
+    def uart_update(self, cc):
+        '''handle commands from the connected host and send whatever is due'''
+        # packet = Packet.from_stream(self.uart_server)
+        # if isinstance(packet, ColorPacket):
+        #     print(packet.color)
+        # INCOMING (RX) check for incoming text
+        if self.uart_server.in_waiting:
+            raw_bytes = self.uart_server.read(self.uart_server.in_waiting)
+            text = raw_bytes.decode().strip()
+            # print("raw bytes =", raw_bytes)
+            btprint("RX: {}".format(text))
+            if '143.all' in text:
+                t = time.monotonic()
+                order = sorted([(c.first_seen, addr) for addr,c in cc.current_encounters.items()])
+                for i,o in enumerate(order):
+                    addr = o[1]
+                    enc = cc.current_encounters[addr]
+                    first = int((t - enc.first_seen) / 60)
+                    last = int((t - enc.last_seen) / 60)
+                    text = '{}: {} {}m {}m\n'.format(i, addrs_to_hex([addr]), first, last)
+                    self.uart_server.write(text.encode())
+            elif '143.log' in text:
+                cc.lager.log_dump(self)
+            elif '143.get' in text:
+                self.exporter.start(cc, text[text.index('143.get'):])
+            elif '143.status' in text:
+                self.set_status_mode(text[text.index('143.status'):])
+            elif '143.text' in text:
+                self.set_status_mode(text[text.index('143.text'):])
+            elif '143.forget' in text:
+                self.forget(cc, text[text.index('143.forget'):])
+            elif '143.hist' in text:
+                cc.histogram.report()
+            elif '143.gc' in text:
+                btprint(self.gc_policy.stats_text() if self.gc_policy else 'no gc policy')
+        self.exporter.pump()
+
+        # OUTGOING (TX) status, when it changes or every status_period
+        self.send_status(cc)
+        if self.text_status:
             text = cc.current_debug_out
-            #text = '\n{},{}\n'.format(val1, val2)
             #print("TX:", text.strip())
             self.uart_server.write((text+'\n').encode())
 
-        elif self.was_connected:
-            self.was_connected = False
-            self.radio.start_advertising(self.advertisement)
+    def set_status_mode(self, text):
+        '''"143.status <seconds>" sets the status frame period, "143.text <0|1>" the text line'''
+        try:
+            words = text.split()
+            if words[0] == '143.status':
+                self.status_period = float(words[1])
+                self.last_status = None
+            else:
+                self.text_status = words[1] != '0'
+            btprint('status every {}s, text {}'.format(self.status_period, int(self.text_status)))
+        except Exception as ex:
+            btprint('bad status command ({}): 143.status <seconds>, 143.text <0|1>'.format(ex))
+
+    def forget(self, cc, text):
+        '''
+        "143.forget <address> <public|static>": the address counts as new the
+        next time it's seen. The type has to be given: the filter keys on it,
+        and removing the other type's fingerprint could take out a different
+        device that happens to share it.
+        '''
+        try:
+            words = text.split()
+            hex_addr = words[1]
+            addr = bytes(reversed([int(x, 16) for x in hex_addr.split(':')]))
+            assert len(addr) == 6, 'need 6 bytes'
+            addr_type = {'public': _bleio.Address.PUBLIC, 'static': _bleio.Address.RANDOM_STATIC}[words[2]]
+        except Exception as ex:
+            btprint('bad 143.forget ({}): 143.forget aa:bb:cc:dd:ee:ff public|static'.format(ex))
+            return
+        if not cc.seen_filter.CAN_FORGET:
+            btprint('the bloom filter can\'t forget; use setting_seen_filter = \'cuckoo\'')
+        elif cc.forget(addr, addr_type):
+            cc.homies.discard(addr)
+            btprint('forgot {}'.format(hex_addr))
+        else:
+            btprint('{} was not in the filter'.format(hex_addr))
+
+    def send_status(self, cc):
+        pd = cc.persistent_data
+        status = (pd['unique_counts'], len(cc.current_encounters), pd['5min'], pd['30min'], pd['2hour'])
+        t = time.monotonic()
+        if status == self.last_status and (self.status_period <= 0 or t < self.next_status_time):
+            return
+        self.last_status = status
+        self.next_status_time = t + self.status_period
+        self.status_seq += 1
+        self.exporter.send_status(self.status_seq, cc, self.loop_ms)
 
 
 
@@ -866,6 +2233,218 @@ font_motor = {'width':24,
 }
 print('////1400///// MEMCHECK: {}k'.format(int(gc.mem_free() // 1024)))
 
+def read_plane_into(f, dst, shared, scratch=bytearray(32)):
+    '''
+    read len(dst) bytes of f into dst. When the plane shares its buffer with
+    one already read (the SSD1675 is monochrome) we AND it in instead, so red
+    ink comes out black rather than wiping the black plane.
+    '''
+    if not shared:
+        f.readinto(dst)
+        return
+    done = 0
+    while done < len(dst):
+        k = min(len(scratch), len(dst) - done)
+        f.readinto(memoryview(scratch)[:k])
+        for j in range(k):
+            dst[done + j] &= scratch[j]
+        done += k
+
+def copy_plane_rect(f, offset, w, h, planes, r, dst_stride):
+    '''read rect r of a raw w x h two-plane image at offset in file f into planes'''
+    x,y,rw,rh = r
+    src_stride = w >> 3
+    bx = max(0, x >> 3)
+    nbytes = min(src_stride, dst_stride, (x + rw + 7) >> 3) - bx
+    if nbytes <= 0:
+        return
+    plane_bytes = src_stride * h
+    for i, plane in enumerate(planes):
+        dst = memoryview(plane)
+        shared = i > 0 and plane is planes[0]
+        for row in range(max(0, y), min(h, y + rh)):
+            f.seek(offset + i * plane_bytes + row * src_stride + bx)
+            a = row * dst_stride + bx
+            read_plane_into(f, dst[a:a + nbytes], shared)
+
+class TsuAtlas:
+    '''
+    The atlas packs all of the .tsu images into one file (see images/convert-images.py).
+    We keep the file open and read images straight into caller-owned buffers.
+    '''
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        magic, count, _ = struct.unpack('<4sHH', self.f.read(8))
+        assert magic == b'TSA1', 'bad atlas magic {}'.format(magic)
+        self.index = {}
+        scratch_size = 0
+        for i in range(count):
+            name, w, h, offset, size, enc = struct.unpack('<12sHHIIB3x', self.f.read(28))
+            self.index[name.rstrip(b'\0').decode()] = (w, h, offset, size, enc)
+            if enc:
+                scratch_size = max(scratch_size, size)
+        self.scratch = bytearray(scratch_size) # holds one packed image while we unpack it
+        btprint('Loaded image atlas ok: {} images'.format(count))
+
+    def read_planes(self, name, planes):
+        '''read the black and red planes of an image into planes[0] and planes[1]'''
+        w, h, offset, size, enc = self.index[name]
+        plane_bytes = (w >> 3) * h
+        self.f.seek(offset)
+        if enc == 0:
+            for i, plane in enumerate(planes):
+                read_plane_into(self.f, memoryview(plane)[:plane_bytes], i > 0 and plane is planes[0])
+        else:
+            self.f.readinto(memoryview(self.scratch)[:size])
+            self.unpack(self.scratch, size, planes, plane_bytes)
+
+    def read_rect(self, name, planes, r, dst_stride):
+        '''
+        re-read just the byte columns and rows under r into the same spot in planes.
+        Only works for raw images; returns False for RLE ones.
+        '''
+        w, h, offset, size, enc = self.index[name]
+        if enc != 0:
+            return False
+        copy_plane_rect(self.f, offset, w, h, planes, r, dst_stride)
+        return True
+
+    def unpack(self, src, size, planes, plane_bytes):
+        # RLE: c < 128 copies c+1 literal bytes, c >= 128 repeats one byte c-126 times
+        # a plane sharing planes[0]'s buffer is ANDed in (see read_plane_into)
+        src_mv = memoryview(src)
+        plane_index = 0
+        dst = planes[0]
+        shared = False
+        si = 0
+        di = 0
+        while si < size:
+            c = src[si]
+            si += 1
+            if c < 128:
+                n = c + 1
+                if shared:
+                    for i in range(n):
+                        dst[di + i] &= src[si + i]
+                else:
+                    dst[di:di + n] = src_mv[si:si + n]
+                si += n
+            else:
+                n = c - 126
+                val = src[si]
+                si += 1
+                for i in range(di, di + n):
+                    dst[i] = dst[i] & val if shared else val
+            di += n
+            if di >= plane_bytes:
+                di = 0
+                plane_index += 1
+                if plane_index >= len(planes):
+                    break
+                dst = planes[plane_index]
+                shared = dst is planes[0]
+
+class DirtyRegions:
+    '''
+    The screen window waiting for a partial refresh.
+    Rects are snapped to the IL0373's 8-pixel x granularity and always
+    merged into one bounding window: a refresh costs the same waveform time
+    whatever the window size (about 15 s on the IL0373, 0.3 s on the
+    SSD1675), and even the whole frame is only ~60 ms of SPI at 1 MHz, so
+    two windows are never cheaper than one.
+    '''
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.rects = []
+
+    def __len__(self):
+        return len(self.rects)
+
+    def clear(self):
+        self.rects = []
+
+    def add(self, r):
+        x,y,w,h = r
+        x0 = max(0, x & ~7)
+        y0 = max(0, y)
+        x1 = min(self.width, (x + w + 7) & ~7)
+        y1 = min(self.height, y + h)
+        if x1 > x0 and y1 > y0:
+            if self.rects:
+                a = self.rects[0]
+                x0 = min(x0, a[0])
+                y0 = min(y0, a[1])
+                x1 = max(x1, a[0] + a[2])
+                y1 = max(y1, a[1] + a[3])
+            self.rects = [(x0, y0, x1 - x0, y1 - y0)]
+
+    def pop(self):
+        return self.rects.pop(0)
+
+class RefreshScheduler:
+    '''
+    Decides when the panel refreshes.
+    Each screen region has a priority and a maximum staleness (seconds).
+    A refresh goes out once some region's oldest pending change reaches its
+    staleness limit, and everything else pending rides along with it.
+    A token bucket caps refreshes per hour, keeping a few tokens in reserve
+    for the urgent regions, to save battery and panel life.
+    '''
+    urgent_priority = 3
+    urgent_reserve = 4      # budget tokens only urgent regions may spend
+
+    def __init__(self, regions, refreshes_per_hour, min_gap):
+        self.regions = regions  # name -> (priority, max staleness)
+        self.pending = {}       # name -> [time first marked, bounding rect]
+        self.set_budget(refreshes_per_hour, min_gap)
+        self.tokens = refreshes_per_hour
+        self.last_refill = time.monotonic()
+        self.last_refresh = self.last_refill - min_gap
+
+    def set_budget(self, refreshes_per_hour, min_gap):
+        self.refreshes_per_hour = refreshes_per_hour
+        self.min_gap = min_gap
+
+    def mark(self, region, r):
+        p = self.pending.get(region)
+        if p is None:
+            self.pending[region] = [time.monotonic(), r]
+        else:
+            x0 = min(p[1][0], r[0])
+            y0 = min(p[1][1], r[1])
+            x1 = max(p[1][0] + p[1][2], r[0] + r[2])
+            y1 = max(p[1][1] + p[1][3], r[1] + r[3])
+            p[1] = (x0, y0, x1 - x0, y1 - y0)
+
+    def refill(self, now):
+        self.tokens = min(self.refreshes_per_hour,
+                          self.tokens + (now - self.last_refill) * self.refreshes_per_hour / 3600)
+        self.last_refill = now
+
+    def due(self):
+        '''the most urgent region that is due for a refresh right now, or None'''
+        if not self.pending:
+            return None
+        now = time.monotonic()
+        self.refill(now)
+        if now - self.last_refresh < self.min_gap or self.tokens < 1:
+            return None
+        best = None
+        for name, p in self.pending.items():
+            priority, max_staleness = self.regions[name]
+            if now - p[0] >= max_staleness:
+                if priority < self.urgent_priority and self.tokens < self.urgent_reserve + 1:
+                    continue
+                if best is None or priority > self.regions[best][0]:
+                    best = name
+        return best
+
+    def sent(self):
+        self.pending.clear()
+        self.tokens = max(0, self.tokens - 1)
+        self.last_refresh = time.monotonic()
+
 class EInkModule:
     def __init__(self, cc):
         if is_feather:
@@ -874,14 +2453,29 @@ class EInkModule:
         else:
             self.width = 152
             self.height = 152
-        self.dirty_rects = [(0, 0, self.width, self.height)]
+        self.cc = cc
+        self.dirty_rects = DirtyRegions(self.width, self.height)
         self.dials_displayed = [0,0,0]
         self.dials_src = ('5min', '30min', '2hour')
         self.dials_pos = ((0,85),(52,104),(104,85))
-        self.next_dirty_update_time = time.monotonic()
-        self.min_update_time = 15.0
+        # region: (priority, max seconds a change may wait before it's shown)
+        self.scheduler = RefreshScheduler({'number':  (3, 0),
+                                           'warning': (3, 0),
+                                           'full':    (3, 0),
+                                           'dials':   (2, 60),
+                                           'other':   (1, 10 * 60),
+                                           'history': (1, 15 * 60)},
+                                          refreshes_per_hour=40, min_gap=15.0)
+        self.next_sweep_time = time.monotonic()
+        self.sweep_period = 10 * 60 # look for changes nobody reported this often
         self.displayed_unique_contacts = -1
+        self.big_number_rect = None
         self.displaying_low_batt_warning = False
+        self.drawn_texts = {} # (x, y): tiny text message showing there
+        self.histogram_version = -1
+        self.duration_pos = (52, 92) # between the top dials: the typical encounter length
+        self.state_filename = '/data_eink_state.bin'
+        self.saved_digest = None
         self.spi = busio.SPI(board.SCL, MOSI=board.SDA)
         self.cs_pin     = digitalio.DigitalInOut(board.RX)
         self.dc_pin     = digitalio.DigitalInOut(board.TX)
@@ -889,7 +2483,7 @@ class EInkModule:
         self.rst_pin    = digitalio.DigitalInOut(board.A3)
         self.busy_pin   = None
         if is_feather:
-            self.display = Adafruit_SSD1675(self.width, self.height, self.spi,
+            self.display = SSD1675Override(self.width, self.height, self.spi,
                                         cs_pin=self.cs_pin, dc_pin=self.dc_pin,
                                         sramcs_pin=self.sramcs_pin,
                                         rst_pin=self.rst_pin, busy_pin=self.busy_pin)
@@ -899,21 +2493,42 @@ class EInkModule:
                                         sramcs_pin=self.sramcs_pin,
                                         rst_pin=self.rst_pin, busy_pin=self.busy_pin)
         self.framebuf = [self.display._buffer1, self.display._buffer2]
+        # What the panel is showing, as of the last RAM write. Costs one more copy
+        # of both planes (2 x 19 x 152 = 5776 bytes on the 152x152 panel), and
+        # lets us refresh only where the pixels really changed.
+        self.shadow = [bytearray(len(self.framebuf[0])), bytearray(len(self.framebuf[1]))]
+        self.stride = len(self.framebuf[0]) // self.height
+        self.display.ram_written_callback = self.mark_sent
+        self.display.refresh_done_callback = self.save_state
+        self.dial_img = [bytearray(6 * 48), bytearray(6 * 48)] # one 48x48 tic image
+        try:
+            self.atlas = TsuAtlas('images/atlas.tsa')
+        except Exception as ex:
+            btprint('Unable to load image atlas, using .tsu files: {}'.format(ex))
+            self.atlas = None
         self.draw_everything(cc)
 
     def periodic_update(self, cc, buttons):
-        if not is_feather:
+        if self.refreshing():
+            self.display.refresh_step()
+        elif not is_feather:
             self.check_low_battery_warning(cc)
         self.draw_dials(cc, force=False)
         num_unique = cc.get_total_unique()
         if num_unique != self.displayed_unique_contacts:
-            if num_unique < self.displayed_unique_contacts:
-                self.draw_everything(cc)
-            else:
-                self.draw_big_number(num_unique, do_clear=True)
-                self.draw_big_number(num_unique, do_clear=False)
+            self.draw_big_number(num_unique)
+        self.draw_duration(cc)
         self.update_dirty_rects()
 
+    def draw_duration(self, cc):
+        hist = cc.histogram
+        if hist is None or hist.version == self.histogram_version:
+            return
+        self.histogram_version = hist.version
+        message = '{:<8}'.format(hist.summary_text())
+        if message.strip() != self.drawn_texts.get(self.duration_pos, '').strip():
+            self.draw_tiny_text(self.duration_pos + (message,), 'history') # no hurry, unlike a warning
+
     def check_low_battery_warning(self, cc):
         low_batt = self.display.check_low_battery_warning()
         if low_batt:
@@ -922,60 +2537,72 @@ class EInkModule:
             self.displaying_low_batt_warning = low_batt
             message = 'LOW BATTERY' if low_batt else '           '
             self.draw_tiny_text((24, 24, message))
-            if low_batt:
-                time.sleep(15)
 
     def set_low_power(self, low_power):
+        # the panel powers itself down after every refresh, so there's nothing to wait for here
         if low_power:
-            self.min_update_time = 60 * 5
-            self.display.busy_wait()
-            time.sleep(0.2)
-            self.display.power_down()
+            self.scheduler.set_budget(refreshes_per_hour=6, min_gap=60 * 5)
         else:
-            self.min_update_time = 15.0
+            self.scheduler.set_budget(refreshes_per_hour=40, min_gap=15.0)
         # Show the icon
         message = 'BATT SAVER MODE' if low_power else '               '
         self.draw_tiny_text((24, 36, message))
-        time.sleep(5)
 
-    def draw_tiny_text(self, ttxt):
+    def draw_tiny_text(self, ttxt, region='warning'):
         x,y,message = ttxt
         w = len(message) * 6
         h = 8
         d = self.display
         d.fill_rect(x, y, w, h, Adafruit_EPD.WHITE)
         d.text(message, x, y, Adafruit_EPD.BLACK)
-        if not is_feather:
-            d.set_window((x,y,w,h))
-        d.display()
+        if message.strip():
+            self.drawn_texts[(x, y)] = message
+        else:
+            self.drawn_texts.pop((x, y), None)
+        self.add_dirty_rect((x,y,w,h), region)
 
     def draw_backdrop(self):
+        if self.atlas:
+            self.atlas.read_planes('backdrop2', self.framebuf)
+            return
         with open('images/backdrop2.tsu', 'rb') as f:
             num_bytes = (self.width >> 3) * self.height
-            f.readinto(self.framebuf[0], num_bytes)
-            f.readinto(self.framebuf[1], num_bytes)
+            for i, plane in enumerate(self.framebuf):
+                read_plane_into(f, memoryview(plane)[:num_bytes], i > 0 and plane is self.framebuf[0])
+
+    def restore_backdrop(self, r):
+        '''put the backdrop back under r, so a smaller value can be drawn there'''
+        if self.atlas and self.atlas.read_rect('backdrop2', self.framebuf, r, self.stride):
+            return
+        # same layout draw_backdrop reads the .tsu with: panel-sized planes
+        with open('images/backdrop2.tsu', 'rb') as f:
+            copy_plane_rect(f, 0, self.width, self.height, self.framebuf, r, self.stride)
 
     def draw_dial(self, x, y, num_tics):
+        w = h = 48
+        self.restore_backdrop((x, y, w, h))
+        self.add_dirty_rect((x, y, w, h), 'dials')
         if num_tics > 0:
             if num_tics > 12:
                 num_tics = 12
-            filename = 'images/tics_a{}.tsu'.format(num_tics)
-            w = h = 48
-            self.add_dirty_rect((x, y, w, h))
-            img = [0,0]
+            img = self.dial_img
             shift = x & 7
-            with open(filename, 'rb') as f:
-                num_bytes = (w >> 3) * h
-                img = [f.read(num_bytes), f.read(num_bytes)]
+            if self.atlas:
+                self.atlas.read_planes('tics_a{}'.format(num_tics), img)
+            else:
+                with open('images/tics_a{}.tsu'.format(num_tics), 'rb') as f:
+                    num_bytes = (w >> 3) * h
+                    f.readinto(memoryview(img[0])[:num_bytes])
+                    f.readinto(memoryview(img[1])[:num_bytes])
             src_rowbytes = w >> 3
-            dst_rowbytes = self.width >> 3
+            dst_rowbytes = self.stride
             for i in range(2):
                 src = img[i]
                 dst = self.framebuf[i]
                 src_row = 0
                 dst_row = (x >> 3) + dst_rowbytes * y
                 tail = 0xff
-                for ry in range(h):
+                for ry in range(min(h, self.height - y)): # the Feather's panel cuts off the bottom dial
                     if shift:
                         for rx in range(src_rowbytes):
                             sp = ~src[src_row + rx]
@@ -1006,25 +2633,136 @@ class EInkModule:
         num_unique = cc.get_total_unique()
         self.draw_big_number(num_unique, do_clear=False)
         self.draw_dials(cc, force=True)
-        self.dirty_rects = []
-        d = self.display
-        d.set_window((0, 0, self.width, self.height))
-        d.display()
+        self.histogram_version = -1
+        self.draw_duration(cc)
+        self.dirty_rects.clear()
+        if self.load_state() == self.state_digest(cc):
+            # e-ink keeps its image without power: after a reset the panel most
+            # likely already shows exactly this, so just believe it
+            print('panel already up to date')
+            for fb, sh in zip(self.framebuf, self.shadow):
+                sh[:] = fb
+            self.scheduler.pending.clear()
+        else:
+            self.start_refresh((0, 0, self.width, self.height))
         print('draw done')
 
-    def add_dirty_rect(self, r):
-        if not r in self.dirty_rects:
-            self.dirty_rects.append(r)
+    def state_digest(self, cc):
+        '''fnv1a32 of everything drawn: the big number, dials, history bar and tiny texts'''
+        h = fnv1a32(struct.pack('<i3I', self.displayed_unique_contacts, *self.dials_displayed))
+        if cc.history_bar:
+            h = fnv1a32(struct.pack('<I', cc.history_bar.drawn_digest), h)
+        for pos in sorted(self.drawn_texts):
+            h = fnv1a32(struct.pack('<2H', *pos), h)
+            h = fnv1a32(self.drawn_texts[pos].encode(), h)
+        return h
+
+    def load_state(self):
+        try:
+            with open(self.state_filename, 'rb') as f:
+                self.saved_digest = struct.unpack('<I', f.read(4))[0]
+        except Exception as ex:
+            btprint('No saved eink state: {}'.format(ex))
+        return self.saved_digest
+
+    def save_state(self):
+        '''after a refresh: if the panel now shows the whole framebuffer, remember its digest'''
+        if self.framebuf[0] != self.shadow[0] or self.framebuf[1] != self.shadow[1]:
+            return
+        digest = self.state_digest(self.cc)
+        if digest == self.saved_digest:
+            return
+        try:
+            with open(self.state_filename, 'wb') as f:
+                f.write(struct.pack('<I', digest))
+            self.saved_digest = digest
+        except Exception as ex:
+            btprint('Unable to save eink state: {}'.format(ex))
+
+    def add_dirty_rect(self, r, region='other'):
+        self.scheduler.mark(region, r)
 
     def update_dirty_rects(self):
-        if self.dirty_rects:
-            now_time = time.monotonic()
-            if now_time >= self.next_dirty_update_time:
-                self.next_dirty_update_time = now_time + self.min_update_time
-                d = self.display
-                if not is_feather:
-                    d.set_window(self.dirty_rects.pop(0))
-                d.display()
+        # the drawing code's dirty rects are only hints for the scheduler: the
+        # windows we send come from diffing the framebuffer against the panel
+        if self.refreshing():
+            return
+        now_time = time.monotonic()
+        if now_time >= self.next_sweep_time:
+            self.next_sweep_time = now_time + self.sweep_period
+            self.scheduler.mark('other', (0, 0, self.width, self.height))
+        if self.scheduler.due() is None:
+            return
+        self.dirty_rects.clear()
+        for r in self.find_changes():
+            self.dirty_rects.add(r)
+        if not self.dirty_rects:
+            self.scheduler.pending.clear() # nothing actually changed
+            return
+        # one bounding window covers every change (see DirtyRegions)
+        self.start_refresh(self.dirty_rects.pop())
+
+    def find_changes(self):
+        '''rects covering every pixel that differs from the shadow, one per run of changed rows'''
+        rects = []
+        if self.framebuf[0] == self.shadow[0] and self.framebuf[1] == self.shadow[1]:
+            return rects
+        stride = self.stride
+        band_start = None
+        # memoryview slices compare without copying the rows
+        planes = [(memoryview(fb), memoryview(sh)) for fb, sh in zip(self.framebuf, self.shadow)]
+        for y in range(self.height + 1):
+            lo = stride
+            hi = -1
+            if y < self.height:
+                a = y * stride
+                b = a + stride
+                for fb, sh in planes:
+                    if fb[a:b] != sh[a:b]:
+                        for i in range(stride):
+                            if fb[a + i] != sh[a + i]:
+                                lo = min(lo, i)
+                                break
+                        for i in range(stride - 1, -1, -1):
+                            if fb[a + i] != sh[a + i]:
+                                hi = max(hi, i)
+                                break
+            if hi >= 0:
+                if band_start is None:
+                    band_start = y
+                    band_lo = lo
+                    band_hi = hi
+                else:
+                    band_lo = min(band_lo, lo)
+                    band_hi = max(band_hi, hi)
+            elif band_start is not None:
+                rects.append((band_lo << 3, band_start, (band_hi - band_lo + 1) << 3, y - band_start))
+                band_start = None
+        return rects
+
+    def mark_sent(self, wrect):
+        '''the window is in panel RAM now, so copy it into the shadow'''
+        x,y,w,h = wrect
+        stride = self.stride
+        bx = x >> 3
+        nbytes = min(stride, (x + w + 7) >> 3) - bx
+        for fb, sh in zip(self.framebuf, self.shadow):
+            fbv = memoryview(fb)
+            for row in range(y, min(self.height, y + h)):
+                a = row * stride + bx
+                sh[a:a + nbytes] = fbv[a:a + nbytes]
+
+    def refreshing(self):
+        return self.display.is_refreshing()
+
+    def start_refresh(self, wrect):
+        if self.refreshing():
+            self.add_dirty_rect(wrect, 'full') # it'll go out after this one
+            return
+        self.scheduler.sent()
+        d = self.display
+        d.set_window(wrect)
+        d.begin_refresh(wrect)
 
     def draw_big_number(self, val, do_clear=False):
         self.displayed_unique_contacts = val
@@ -1038,7 +2776,14 @@ class EInkModule:
         x -= total_width >> 1 # center it
         y -= y_size >> 1 # center it
 
-        self.add_dirty_rect((x, y, total_width, y_size))
+        # glyphs are wider than the step and some are a row taller than y_size
+        r = (x, y, total_width + font['width'] - x_step, y_size + 1)
+        old_r = self.big_number_rect or r
+        self.big_number_rect = r
+        x0 = min(r[0], old_r[0])
+        x1 = max(r[0] + r[2], old_r[0] + old_r[2])
+        self.restore_backdrop((x0, y, x1 - x0, r[3]))
+        self.add_dirty_rect((x0, y, x1 - x0, r[3]), 'number')
 
         for c in text:
             offset = font['offsets'][c]
@@ -1107,11 +2852,136 @@ _IL0373_PARTIAL_OUT = const(0x92)
 
 _IL0373_LOW_POWER_DETECT = const(0x51)
 
-class EInkOverride(eink_type):
+class RefreshPipeline:
+    '''
+    Runs a panel refresh as a chain of short steps instead of one blocking call,
+    so the main loop keeps scanning while the panel does its slow part:
+      reset -> power on -> configure -> RAM write -> refresh -> wait busy -> power down
+    begin_refresh() starts it, refresh_step() advances it from the main loop.
+    Once the RAM write is done the framebuffer is free to draw the next frame.
+    The panel class supplies power_on_commands(), configure_commands(),
+    write_ram_window(), refresh_commands(), refresh_done_commands(),
+    power_down() and panel_busy(); write_window() is shared by both panels.
+    '''
+    REFRESH_IDLE = 0
+    REFRESH_RESET = 1
+    REFRESH_POWER_ON = 2
+    REFRESH_CONFIGURE = 3
+    REFRESH_WRITE_RAM = 4
+    REFRESH_WAIT_BUSY = 5
+    REFRESH_POWER_DOWN = 6
+    refresh_seconds = 15.0   # how long the panel takes, used when there's no busy pin
+
+    def init_pipeline(self):
+        self.refresh_state = self.REFRESH_IDLE
+        self.refresh_deadline = 0
+        self.refresh_window = None
+        self.ram_written_callback = None # called with the window once it's in panel RAM
+        self.refresh_done_callback = None # called once the panel has finished and powered down
+
+    def is_refreshing(self):
+        return self.refresh_state != self.REFRESH_IDLE
+
+    def begin_refresh(self, wrect):
+        if self.is_refreshing():
+            return False
+        self.refresh_window = wrect
+        if self._rst:
+            self._rst.value = False
+        self.wait_then(self.REFRESH_RESET, 0.1)
+        return True
+
+    def wait_then(self, state, seconds):
+        self.refresh_state = state
+        self.refresh_deadline = time.monotonic() + seconds
+
+    def refresh_step(self):
+        '''advance the refresh by at most one step; returns True while it's still going'''
+        state = self.refresh_state
+        if state == self.REFRESH_IDLE:
+            return False
+        if time.monotonic() < self.refresh_deadline or self.panel_busy():
+            return True
+        if state == self.REFRESH_RESET:
+            if self._rst:
+                self._rst.value = True
+            self.wait_then(self.REFRESH_POWER_ON, 0.1)
+        elif state == self.REFRESH_POWER_ON:
+            self.power_on_commands()
+            self.wait_then(self.REFRESH_CONFIGURE, 0.2)
+        elif state == self.REFRESH_CONFIGURE:
+            self.configure_commands()
+            self.wait_then(self.REFRESH_WRITE_RAM, 0.05)
+        elif state == self.REFRESH_WRITE_RAM:
+            self.write_ram_window(self.refresh_window)
+            if self.ram_written_callback:
+                self.ram_written_callback(self.refresh_window)
+            self.refresh_commands(self.refresh_window)
+            self.wait_then(self.REFRESH_WAIT_BUSY, self.refresh_seconds if self._busy is None else 0.01)
+        elif state == self.REFRESH_WAIT_BUSY:
+            self.refresh_done_commands()
+            self.wait_then(self.REFRESH_POWER_DOWN, 0)
+        elif state == self.REFRESH_POWER_DOWN:
+            self.power_down()
+            self.refresh_state = self.REFRESH_IDLE
+            if self.refresh_done_callback:
+                self.refresh_done_callback()
+        return self.is_refreshing()
+
+    def write_window(self, index, wrect, buffer_index=None):
+        """
+        Send the part of buffer <buffer_index> (default: <index>) inside wrect
+        to panel RAM <index>.
+        Full-width windows go out in one write, others one row slice at a time.
+        With external SRAM, each row is read into RAM first (EPD deselected),
+        then written to the panel.
+        """
+        x,y,w,h = wrect
+        stride = self._buffer1_size // self._height
+        bx = x >> 3
+        nbytes = min(stride, ((x + w + 7) >> 3)) - bx
+        start = y * stride + bx
+        self.write_ram(index)
+        if buffer_index is None:
+            buffer_index = index
+
+        while not self.spi_device.try_lock():
+            time.sleep(0.01)
+        self._dc.value = True
+        if self.sram:
+            base = 0 if buffer_index == 0 else self._buffer1_size
+            for row in range(h):
+                self._cs.value = True
+                self.spi_device.unlock()
+                data = self.sram.read(base + start + row * stride, nbytes)
+                while not self.spi_device.try_lock():
+                    time.sleep(0.01)
+                self._dc.value = True
+                self._cs.value = False
+                self.spi_device.write(data)
+        else:
+            buf = memoryview(self._buffer1 if buffer_index == 0 else self._buffer2)
+            if nbytes == stride:
+                self.spi_device.write(buf[start:start + h * stride])
+            else:
+                for row in range(h):
+                    self.spi_device.write(buf[start:start + nbytes])
+                    start += stride
+        self._cs.value = True
+        self.spi_device.unlock()
+
+    def display(self):
+        '''blocking refresh of the current window, for callers that want to wait'''
+        if self.window_rect is not None and self.begin_refresh(self.window_rect):
+            while self.refresh_step():
+                time.sleep(0.01)
+
+class EInkOverride(RefreshPipeline, eink_type):
     def __init__(self, width, height, spi, cs_pin, dc_pin,
                  sramcs_pin, rst_pin, busy_pin):
         self.window_rect = None
         self.ecs = cs_pin
+        self.init_pipeline()
         super(EInkOverride, self).__init__(width, height, spi,
             cs_pin=cs_pin, dc_pin=dc_pin, sramcs_pin=sramcs_pin,
             rst_pin=rst_pin, busy_pin=busy_pin)
@@ -1149,90 +3019,28 @@ class EInkOverride(eink_type):
             print('update()...')
             self.command(_IL0373_DISPLAY_REFRESH)
 
-    def display(self):
+    def panel_busy(self):
+        # the IL0373 busy line is low while it's working
+        return self._busy is not None and not self._busy.value
+
+    def write_ram_window(self, wrect):
         """
-        COPY and OVERRIDE the Adafruit_IL0373 code, for the following reasons:
-        1. Allow a partial-screen refresh
+        Partial-screen version of the Adafruit_IL0373 RAM write:
+        in partial mode the panel only takes RAM data for the window,
+        so only the window's rows and byte columns are sent.
         """
-        if self.window_rect is None:
-            return
-
         print('display()...')
-
-        self.power_up()
-
-        self.set_ram_address(0, 0)
-
-        if self.sram:
-            while not self.spi_device.try_lock():
-                time.sleep(0.01)
-            self.sram.cs_pin.value = False
-            # send read command
-            self._buf[0] = mcp_sram.Adafruit_MCP_SRAM.SRAM_READ
-            # send start address
-            self._buf[1] = 0
-            self._buf[2] = 0
-            self.spi_device.write(self._buf, end=3)
-            self.spi_device.unlock()
-
-        # first data byte from SRAM will be transfered in at the
-        # same time as the EPD command is transferred out
-        databyte = self.write_ram(0)
-
-        while not self.spi_device.try_lock():
-            time.sleep(0.01)
-        self._dc.value = True
-
-        if self.sram:
-            for _ in range(self._buffer1_size):
-                databyte = self._spi_transfer(databyte)
-            self.sram.cs_pin.value = True
-        else:
-            for databyte in self._buffer1:
-                self._spi_transfer(databyte)
-
-        self._cs.value = True
-        self.spi_device.unlock()
-        time.sleep(0.002)
-
-        if self.sram:
-            while not self.spi_device.try_lock():
-                time.sleep(0.01)
-            self.sram.cs_pin.value = False
-            # send read command
-            self._buf[0] = mcp_sram.Adafruit_MCP_SRAM.SRAM_READ
-            # send start address
-            self._buf[1] = (self._buffer1_size >> 8) & 0xFF
-            self._buf[2] = self._buffer1_size & 0xFF
-            self.spi_device.write(self._buf, end=3)
-            self.spi_device.unlock()
-
+        self.start_partial_window(wrect)
+        self.write_window(0, wrect)
         if self._buffer2_size != 0:
-            # first data byte from SRAM will be transfered in at the
-            # same time as the EPD command is transferred out
-            databyte = self.write_ram(1)
-
-            while not self.spi_device.try_lock():
-                time.sleep(0.01)
-            self._dc.value = True
+            self.write_window(1, wrect)
 
-            if self.sram:
-                for _ in range(self._buffer2_size):
-                    databyte = self._spi_transfer(databyte)
-                self.sram.cs_pin.value = True
-            else:
-                for databyte in self._buffer2:
-                    self._spi_transfer(databyte)
-
-            self._cs.value = True
-            self.spi_device.unlock()
-        else:
-            if self.sram:
-                self.sram.cs_pin.value = True
-
-        self.start_partial_window(self.window_rect)
+    def refresh_commands(self, wrect):
         self.update()
 
+    def refresh_done_commands(self):
+        self.command(_IL0373_PARTIAL_OUT)
+
     def power_up(self):
         """
         COPY and OVERRIDE the Adafruit_IL0373 code, for the following reasons:
@@ -1240,14 +3048,18 @@ class EInkOverride(eink_type):
         """
         self.hardware_reset()
         self.busy_wait()
+        self.power_on_commands()
+        self.busy_wait()
+        time.sleep(0.2)
+        self.configure_commands()
+        time.sleep(0.05)
 
+    def power_on_commands(self):
         self.command(_IL0373_POWER_SETTING, bytearray([0x03, 0x00, 0x2B, 0x2B, 0x09]))
         self.command(_IL0373_BOOSTER_SOFT_START, bytearray([0x17, 0x17, 0x17]))
         self.command(_IL0373_POWER_ON)
 
-        self.busy_wait()
-        time.sleep(0.2)
-
+    def configure_commands(self):
         self.command(_IL0373_PANEL_SETTING, bytearray([0xCF]))
         self.command(_IL0373_CDI, bytearray([0x37]))
         self.command(_IL0373_PLL, bytearray([0x29]))
@@ -1256,7 +3068,130 @@ class EInkOverride(eink_type):
         _b3 = self._height & 0xFF
         self.command(_IL0373_RESOLUTION, bytearray([_b1, _b2, _b3]))
         self.command(_IL0373_VCM_DC_SETTING, bytearray([0x0A]))
-        time.sleep(0.05)
+
+_SSD1675_DRIVER_CONTROL = const(0x01)
+_SSD1675_GATE_VOLTAGE = const(0x03)
+_SSD1675_SOURCE_VOLTAGE = const(0x04)
+_SSD1675_DATA_MODE = const(0x11)
+_SSD1675_SW_RESET = const(0x12)
+_SSD1675_MASTER_ACTIVATE = const(0x20)
+_SSD1675_DISP_CTRL2 = const(0x22)
+_SSD1675_WRITE_VCOM = const(0x2C)
+_SSD1675_WRITE_LUT = const(0x32)
+_SSD1675_WRITE_DUMMY = const(0x3A)
+_SSD1675_WRITE_GATELINE = const(0x3B)
+_SSD1675_WRITE_BORDER = const(0x3C)
+_SSD1675_SET_RAMXPOS = const(0x44)
+_SSD1675_SET_RAMYPOS = const(0x45)
+_SSD1675_SET_RAMXCOUNT = const(0x4E)
+_SSD1675_SET_RAMYCOUNT = const(0x4F)
+_SSD1675_SET_ANALOGBLOCK = const(0x74)
+_SSD1675_SET_DIGITALBLOCK = const(0x7E)
+
+# partial-update waveform: only black<->white transitions get driven, once
+_SSD1675_PARTIAL_LUT = bytes([
+    0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x80, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x40, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x0A, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00])
+_SSD1675_VOLTAGES = bytes([0x15, 0x41, 0xA8, 0x32, 0x30, 0x0A]) # gate, source x3, dummy, gate line
+
+class SSD1675Override(RefreshPipeline, eink_type):
+    '''
+    Partial-window refresh for the Feather's SSD1675, parallel to EInkOverride.
+    (eink_type is Adafruit_SSD1675 on the Feather; this class is only used there.)
+    The panel is set up the way the stock driver sets it up: RAM_GATES gate
+    lines of RAM_LINE_BYTES bytes, which its display() fills with the
+    framebuffer's bytes in order. So a framebuffer row is 2 gate lines, and
+    the only RAM windows that hold a framebuffer rectangle are whole rows:
+    every window is widened to full rows and sent as a band of gate lines.
+    Full-screen windows use the panel's own (OTP) full waveform; anything
+    smaller uses a short partial LUT, and afterwards the window is also
+    written to RAM2, which the panel uses as the previous image for the
+    next partial update.
+    '''
+    refresh_seconds = 3.0
+    RAM_GATES = 250
+    RAM_LINE_BYTES = 16 # RAM X runs 0..15: 128 source bits per gate line
+
+    def __init__(self, width, height, spi, cs_pin, dc_pin,
+                 sramcs_pin, rst_pin, busy_pin):
+        self.window_rect = None
+        self.init_pipeline()
+        super(SSD1675Override, self).__init__(width, height, spi,
+            cs_pin=cs_pin, dc_pin=dc_pin, sramcs_pin=sramcs_pin,
+            rst_pin=rst_pin, busy_pin=busy_pin)
+        self.ram_stride = self._buffer1_size // self._height
+
+    def set_window(self, wrect):
+        if wrect is None:
+            self.window_rect = None
+        else:
+            self.window_rect = [x for x in wrect]
+
+    def begin_refresh(self, wrect):
+        x,y,w,h = wrect
+        return super(SSD1675Override, self).begin_refresh((0, y, self._width, h))
+
+    def is_full_window(self, wrect):
+        x,y,w,h = wrect
+        return x <= 0 and y <= 0 and ((x + w + 7) >> 3) >= self.ram_stride and y + h >= self._height
+
+    def panel_busy(self):
+        # the SSD1675 busy line is high while it's working
+        return self._busy is not None and self._busy.value
+
+    def power_on_commands(self):
+        self.command(_SSD1675_SW_RESET)
+
+    def configure_commands(self):
+        gates = self.RAM_GATES - 1
+        self.command(_SSD1675_SET_ANALOGBLOCK, bytearray([0x54]))
+        self.command(_SSD1675_SET_DIGITALBLOCK, bytearray([0x3B]))
+        self.command(_SSD1675_DRIVER_CONTROL, bytearray([gates & 0xFF, gates >> 8, 0x00]))
+        self.command(_SSD1675_DATA_MODE, bytearray([0x03])) # x then y, both increasing
+        self.command(_SSD1675_WRITE_BORDER, bytearray([0x03]))
+        self.command(_SSD1675_WRITE_VCOM, bytearray([0x70]))
+        self.command(_SSD1675_GATE_VOLTAGE, _SSD1675_VOLTAGES[0:1])
+        self.command(_SSD1675_SOURCE_VOLTAGE, _SSD1675_VOLTAGES[1:4])
+        self.command(_SSD1675_WRITE_DUMMY, _SSD1675_VOLTAGES[4:5])
+        self.command(_SSD1675_WRITE_GATELINE, _SSD1675_VOLTAGES[5:6])
+
+    def set_ram_window(self, wrect):
+        # the gate lines holding framebuffer rows y .. y+h-1 (begin_refresh made them whole rows)
+        x,y,w,h = wrect
+        g0 = y * self.ram_stride // self.RAM_LINE_BYTES
+        g1 = (min(self._height, y + h) * self.ram_stride - 1) // self.RAM_LINE_BYTES
+        self.command(_SSD1675_SET_RAMXPOS, bytearray([0, self.RAM_LINE_BYTES - 1]))
+        self.command(_SSD1675_SET_RAMYPOS, bytearray([g0 & 0xFF, g0 >> 8, g1 & 0xFF, g1 >> 8]))
+        self.command(_SSD1675_SET_RAMXCOUNT, bytearray([0]))
+        self.command(_SSD1675_SET_RAMYCOUNT, bytearray([g0 & 0xFF, g0 >> 8]))
+
+    def write_ram_window(self, wrect):
+        if not self.is_full_window(wrect):
+            self.command(_SSD1675_WRITE_LUT, _SSD1675_PARTIAL_LUT)
+        self.set_ram_window(wrect)
+        self.write_window(0, wrect)
+
+    def refresh_commands(self, wrect):
+        if self.is_full_window(wrect):
+            self.command(_SSD1675_DISP_CTRL2, bytearray([0xF7])) # load the OTP waveform, full update
+        else:
+            self.command(_SSD1675_DISP_CTRL2, bytearray([0x0C])) # registered LUT, partial update
+        self.command(_SSD1675_MASTER_ACTIVATE)
+
+    def refresh_done_commands(self):
+        # the panel compares RAM1 with RAM2 on the next partial update
+        self.set_ram_window(self.refresh_window)
+        self.write_window(1, self.refresh_window, buffer_index=0)
 
 ## (end of EInk section)
 ##################################################################
@@ -1,22 +1,137 @@
 # This is just a quick utility to process my eink images
 
 from PIL import Image
+import argparse
+import concurrent.futures
+import hashlib
 import io
+import json
+import os
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # fall back to the pixel-by-pixel loops
+
+HASH_FILE = '.tsu-hashes.json' # png content hashes for --check
+
+# Atlas file layout (all little-endian):
+#   header:  '4sHH'        magic b'TSA1', entry count, reserved
+#   index:   '12sHHIIB3x'  name, width, height, data offset, data size, encoding
+#   data:    black plane then red plane for each image
+# encoding 0 is raw planes, encoding 1 is RLE, where each plane is packed
+# separately so a run never crosses from black into red:
+#   control byte c < 128:  copy the next c+1 bytes as-is
+#   control byte c >= 128: repeat the next byte c-126 times (2..129)
+ATLAS_MAGIC = b'TSA1'
+ATLAS_HEADER = '<4sHH'
+ATLAS_ENTRY = '<12sHHIIB3x'
+ATLAS_RAW = 0
+ATLAS_RLE = 1
 
 def main():
-    convert_pic('backdrop2')
-    for i in range(1,13):
-        convert_pic('tics_a{}'.format(i))
+    parser = argparse.ArgumentParser(description='Convert eink pngs to .tsu files and an atlas')
+    parser.add_argument('names', nargs='*', help='images to convert, without .png (default: the device images)')
+    parser.add_argument('--all', action='store_true', help='convert every png in this directory')
+    parser.add_argument('--atlas', default='atlas.tsa', help='atlas file to write (empty to skip)')
+    parser.add_argument('--rle', action='store_true', help='RLE-compress atlas entries when it saves space')
+    parser.add_argument('--keep-raw', nargs='*', default=['backdrop2'],
+                        help='images left uncompressed so the device can re-read parts of them by offset')
+    parser.add_argument('--check', action='store_true', help='only rebuild pngs whose content hash changed')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: one per cpu)')
+    parser.add_argument('--show', action='store_true', help='print each converted image as text')
+    args = parser.parse_args()
+
+    names = args.names
+    if args.all:
+        names = sorted(fn[:-4] for fn in os.listdir('.') if fn.endswith('.png'))
+    elif not names:
+        names = ['backdrop2'] + ['tics_a{}'.format(i) for i in range(1,13)]
+
+    t = time.perf_counter()
+    entries = convert_all(names, jobs=args.jobs, check=args.check, show=args.show)
+    print('converted {} images in {:.1f} ms ({})'.format(len(entries), (time.perf_counter() - t) * 1000,
+                                                        'numpy' if np is not None else 'pure python'))
+    if args.atlas:
+        save_atlas(entries, args.atlas, rle=args.rle, keep_raw=args.keep_raw)
+
+def convert_all(names, jobs=None, check=False, show=False):
+    """Convert a batch of pngs in a process pool, skipping unchanged ones in check mode."""
+    hashes = load_hashes() if check else {}
+    todo = []
+    entries = {}
+    for name in names:
+        digest = file_hash(name + '.png')
+        if check and hashes.get(name) == digest and os.path.exists(name + '.tsu'):
+            entries[name] = load_tsu(name)
+            print(name, 'unchanged')
+        else:
+            todo.append(name)
+        hashes[name] = digest
+    if len(todo) > 1 and jobs != 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            for entry in pool.map(convert_pic, todo, [show] * len(todo)):
+                entries[entry[0]] = entry
+    else:
+        for name in todo:
+            entries[name] = convert_pic(name, show)
+    save_hashes(hashes)
+    return [entries[name] for name in names]
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_hashes():
+    try:
+        with open(HASH_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_hashes(hashes):
+    with open(HASH_FILE, 'w') as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
 
-def convert_pic(name):
+def load_tsu(name):
+    """Read back an existing .tsu; its size comes from the png header, which is cheap."""
+    w, h = Image.open(name + '.png').size
+    with open(name + '.tsu', 'rb') as f:
+        data = f.read()
+    plane_bytes = (w >> 3) * h
+    return (name, w, h, bytearray(data[:plane_bytes]), bytearray(data[plane_bytes:]))
+
+def convert_pic(name, show=True):
     im = Image.open(name+'.png')
     print(im.format, im.size, im.mode)
     w,h = im.size
-    pix = im.tobytes()
-    print(name, 'rgb pixel bytes:',len(pix),'expected:',w * h * 3)
-    save_tsu(pix, w, h, name+'.tsu')
+    if np is not None:
+        black, red = threshold_planes(np.asarray(im.convert('RGB')), w, h)
+        with open(name+'.tsu', 'wb') as f:
+            f.write(black)
+            f.write(red)
+        if show:
+            print_pixels(black, red, w, h)
+    else:
+        pix = im.convert('RGB').tobytes()
+        print(name, 'rgb pixel bytes:',len(pix),'expected:',w * h * 3)
+        black, red = save_tsu(pix, w, h, name+'.tsu', show)
+    return (name, w, h, black, red)
 
-def save_tsu(pix, w, h, filename):
+def threshold_planes(rgb, w, h):
+    """Same thresholds as save_tsu, done in bulk: a 0 bit means the pixel is inked."""
+    r = rgb[:, :(w >> 3) << 3, 0]
+    b_cutoff = 255 // 3
+    r_cutoff = 2 * b_cutoff
+    is_black = r < b_cutoff
+    is_red = (r < r_cutoff) & ~is_black
+    black = np.packbits(~is_black, axis=1)
+    red = np.packbits(~is_red, axis=1)
+    return bytearray(black.tobytes()), bytearray(red.tobytes())
+
+def save_tsu(pix, w, h, filename, show=True):
     wb = w >> 3
     bw_bytes = wb * h
     black = bytearray(bw_bytes)
@@ -57,7 +172,57 @@ def save_tsu(pix, w, h, filename):
     with open(filename, 'wb') as f:
         f.write(black)
         f.write(red)
-    print_pixels(black, red, w, h)
+    if show:
+        print_pixels(black, red, w, h)
+    return black, red
+
+def rle_pack(plane):
+    out = bytearray()
+    i = 0
+    n = len(plane)
+    literal_start = 0
+    while i < n:
+        run = 1
+        while i + run < n and run < 129 and plane[i + run] == plane[i]:
+            run += 1
+        if run >= 2:
+            flush_literals(out, plane, literal_start, i)
+            out.append(run + 126)
+            out.append(plane[i])
+            i += run
+            literal_start = i
+        else:
+            i += 1
+    flush_literals(out, plane, literal_start, n)
+    return out
+
+def flush_literals(out, plane, start, end):
+    while start < end:
+        count = min(128, end - start)
+        out.append(count - 1)
+        out += plane[start:start + count]
+        start += count
+
+def save_atlas(entries, filename, rle=False, keep_raw=()):
+    index_size = struct.calcsize(ATLAS_HEADER) + len(entries) * struct.calcsize(ATLAS_ENTRY)
+    index = bytearray(struct.pack(ATLAS_HEADER, ATLAS_MAGIC, len(entries), 0))
+    data = bytearray()
+    for name, w, h, black, red in entries:
+        payload = black + red
+        encoding = ATLAS_RAW
+        if rle and name not in keep_raw:
+            packed = rle_pack(black) + rle_pack(red)
+            if len(packed) < len(payload):
+                payload = packed
+                encoding = ATLAS_RLE
+        index += struct.pack(ATLAS_ENTRY, name.encode(), w, h,
+                             index_size + len(data), len(payload), encoding)
+        print('atlas:', name, w, h, 'raw' if encoding == ATLAS_RAW else 'rle', len(payload))
+        data += payload
+    with open(filename, 'wb') as f:
+        f.write(index)
+        f.write(data)
+    print('atlas:', filename, len(index) + len(data), 'bytes')
 
 def print_pixels(black, red, w, h):
     print('\n\n')
@@ -93,5 +258,5 @@ def print_pixels(black, red, w, h):
             out_index += 1
         print(line)
 
-main()
-
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Expected false positives for the badge's Bloom filter.
+
+A false positive means a device we've never seen looks "seen before" and
+isn't counted, so the expected undercount after N devices is the sum of
+the false positive rate as the filter fills up.
+
+    python3 tools/bloom_calc.py                          # code.py's settings
+    python3 tools/bloom_calc.py --bytes 8192 16384 --hashes 3 5 7 --population 2000 20000
+    python3 tools/bloom_calc.py --target 0.001           # bytes needed for 0.1% at each population
+"""
+import argparse
+import math
+import sys
+
+import devicecode
+
+
+def false_positive_rate(m, k, n):
+    """chance that an address never added looks present, after n distinct adds"""
+    return (1.0 - math.exp(-k * n / m)) ** k
+
+
+def expected_undercount(m, k, n):
+    """devices missed while adding n distinct ones (sum of the rate as it fills)"""
+    if n <= 2000:
+        return sum(false_positive_rate(m, k, i) for i in range(n))
+    step = n / 2000.0
+    return sum(false_positive_rate(m, k, (i + 0.5) * step) for i in range(2000)) * step
+
+
+def legacy_rate(n):
+    """the old filter (three 64k-bit tables, raw address bytes), for perfectly random addresses"""
+    return (1.0 - math.exp(-n / 65536.0)) ** 3
+
+
+def best_k(m, n):
+    return max(1, round(m / n * math.log(2)))
+
+
+def bytes_for(target, n, k=None):
+    """smallest filter (bytes) that keeps the rate at n under target"""
+    if k is None:
+        bits = -n * math.log(target) / (math.log(2) ** 2)
+    else:
+        bits = -k * n / math.log(1.0 - target ** (1.0 / k))
+    return int(math.ceil(bits / 8))
+
+
+def main():
+    dev = devicecode.load()
+    parser = argparse.ArgumentParser(description='False positive rate and undercount for the Bloom filter')
+    parser.add_argument('--bytes', type=int, nargs='+', default=[dev.setting_bloom_bytes])
+    parser.add_argument('--hashes', type=int, nargs='+', default=[dev.setting_bloom_hashes])
+    parser.add_argument('--population', type=int, nargs='+', default=[1000, 5000, 10000, 20000, 50000, 100000])
+    parser.add_argument('--target', type=float, help='print the bytes needed to stay under this rate')
+    args = parser.parse_args()
+
+    print('{:>8} {:>3} {:>9} {:>12} {:>12} {:>8} {:>12}'.format(
+        'bytes', 'k', 'devices', 'false pos', 'undercount', 'best k', 'old filter'))
+    for nbytes in args.bytes:
+        m = nbytes * 8
+        for k in args.hashes:
+            for n in args.population:
+                print('{:>8} {:>3} {:>9} {:>11.4%} {:>12.1f} {:>8} {:>11.4%}'.format(
+                    nbytes, k, n, false_positive_rate(m, k, n), expected_undercount(m, k, n),
+                    best_k(m, n), legacy_rate(n)))
+    print('(old filter: three fixed tables on raw address bytes; with shared vendor prefixes it does much worse)')
+    if args.target:
+        print()
+        print('bytes for a {:.4%} false positive rate:'.format(args.target))
+        print('{:>9} {:>10} '.format('devices', 'best k') + ' '.join('{:>9}'.format('k={}'.format(k)) for k in args.hashes))
+        for n in args.population:
+            print('{:>9} {:>10} '.format(n, bytes_for(args.target, n)) +
+                  ' '.join('{:>9}'.format(bytes_for(args.target, n, k)) for k in args.hashes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
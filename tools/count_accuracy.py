@@ -0,0 +1,174 @@
+"""
+How wrong is the badge's unique count after N distinct devices?
+
+Streams synthetic sightings of static addresses (a few vendors' public
+addresses, most of them from the big vendors, plus random static ones, and
+a share of repeat sightings) through code.py's Bloom and CuckooFilter at
+several memory budgets, next to an exact set, and records the count each
+would show against the true one as the population grows.  A Bloom filter
+can only undercount; a full cuckoo filter stops remembering, so repeats
+start counting again and it overcounts.
+
+Every (filter, budget) runs in its own process.  Results go to a CSV, and
+to a plot if matplotlib is installed, in a temp directory unless named.
+
+    python3 tools/count_accuracy.py                       # 1M devices, 8k/24k/64k
+    python3 tools/count_accuracy.py --devices 3000000 --bytes 24576 98304 --plot accuracy.png
+"""
+import argparse
+import concurrent.futures
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+import devicecode
+from filter_bench import make_filter
+
+
+def sightings(seed, devices, random_share=0.3, revisit=0.5, vendors=40, recent=5000):
+    """
+    (address, is_new) for a day out: each sighting is a repeat of one of the
+    last `recent` devices with chance `revisit`, otherwise a new device,
+    random static with chance `random_share`, else public from a vendor
+    picked with 1/rank weights, numbered in loose blocks.
+    """
+    rng = random.Random(seed)
+    ouis = [rng.getrandbits(24).to_bytes(3, 'little') for _ in range(vendors)]
+    weights = [1.0 / (rank + 1) for rank in range(vendors)]
+    next_nic = [rng.getrandbits(24) for _ in range(vendors)]
+    ring = []
+    new = 0
+    while new < devices:
+        if ring and rng.random() < revisit:
+            yield ring[rng.randrange(len(ring))], False
+            continue
+        if rng.random() < random_share:
+            addr = (rng.getrandbits(48) | (0xc0 << 40)).to_bytes(6, 'little')
+        else:
+            v = rng.choices(range(vendors), weights)[0]
+            nic = next_nic[v]
+            next_nic[v] = (nic + rng.randrange(1, 24)) & 0xffffff
+            addr = nic.to_bytes(3, 'little') + ouis[v]
+        new += 1
+        if len(ring) < recent:
+            ring.append(addr)
+        else:
+            ring[rng.randrange(recent)] = addr
+        yield addr, True
+
+
+def checkpoints(devices):
+    """1, 2, 5 steps from 1000 up to devices"""
+    points = []
+    scale = 1000
+    while scale <= devices:
+        points += [p for p in (scale, 2 * scale, 5 * scale) if p <= devices]
+        scale *= 10
+    if not points or points[-1] != devices:
+        points.append(devices)
+    return points
+
+
+def run(job):
+    kind, nbytes, args = job
+    dev = devicecode.load(root=tempfile.mkdtemp(prefix='count-accuracy-'))
+    dev.btprint = lambda text: None
+    f, written = make_filter(dev, kind, nbytes, args.hashes or dev.setting_bloom_hashes)
+    exact = set()
+    counted = 0
+    points = checkpoints(args.devices)
+    rows = []
+    adds = 0
+    elapsed = 0.0
+    for addr, _ in sightings(args.seed, args.devices, args.random_share, args.revisit):
+        t = time.perf_counter()
+        is_new = f.add(addr)
+        elapsed += time.perf_counter() - t
+        adds += 1
+        counted += is_new
+        exact.add(addr)
+        if len(exact) == points[len(rows)]:
+            n = len(exact)
+            rows.append({'filter': kind, 'bytes': nbytes, 'devices': n, 'counted': counted,
+                         'error': counted - n, 'error_pct': 100.0 * (counted - n) / n,
+                         'us_per_add': elapsed / adds * 1e6, 'flash_bytes_per_add': written[0] / adds})
+            if len(rows) == len(points):
+                break
+    return rows
+
+
+def plot(rows, filename):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed; the numbers are in the CSV')
+        return
+    fig, ax = plt.subplots(figsize=(8, 5))
+    configs = sorted({(r['filter'], r['bytes']) for r in rows})
+    for kind, nbytes in configs:
+        mine = [r for r in rows if r['filter'] == kind and r['bytes'] == nbytes]
+        ax.plot([r['devices'] for r in mine], [r['error_pct'] for r in mine],
+                '-' if kind == 'bloom' else '--', marker='.', label='{} {}k'.format(kind, nbytes // 1024))
+    ax.set_xscale('log')
+    ax.set_yscale('symlog', linthresh=0.1)
+    ax.axhline(0, color='gray', linewidth=0.5)
+    ax.set_xlabel('distinct devices')
+    ax.set_ylabel('count error (% of true count)')
+    ax.set_title('Unique count vs exact set')
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(filename, dpi=120)
+    print('wrote', filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Unique count error against an exact set, by population and memory')
+    parser.add_argument('--devices', type=int, default=1000000, help='distinct devices to stream')
+    parser.add_argument('--bytes', type=int, nargs='+', default=[8 * 1024, 24 * 1024, 64 * 1024])
+    parser.add_argument('--filters', nargs='+', default=['bloom', 'cuckoo'], choices=['bloom', 'cuckoo'])
+    parser.add_argument('--hashes', type=int, default=None, help='bloom hashes (default: setting_bloom_hashes)')
+    parser.add_argument('--random-share', type=float, default=0.3, help='share of new devices with random static addresses')
+    parser.add_argument('--revisit', type=float, default=0.5, help='share of sightings that are repeats')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--csv', help='default: count_accuracy.csv in a new temp directory')
+    parser.add_argument('--plot', help='default: count_accuracy.png next to the CSV')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    args = parser.parse_args()
+    if not args.csv:
+        args.csv = os.path.join(tempfile.mkdtemp(prefix='count-accuracy-'), 'count_accuracy.csv')
+    if not args.plot:
+        args.plot = os.path.join(os.path.dirname(args.csv), 'count_accuracy.png')
+
+    jobs = [(kind, nbytes, args) for kind in args.filters for nbytes in args.bytes]
+    t = time.perf_counter()
+    rows = []
+    print('{:>7} {:>7} {:>9} {:>9} {:>9} {:>8} {:>7} {:>8}'.format(
+        'filter', 'bytes', 'devices', 'counted', 'error', 'error %', 'us/add', 'flash/add'))
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        for result in pool.map(run, jobs):
+            for r in result:
+                print('{filter:>7} {bytes:>7} {devices:>9} {counted:>9} {error:>9} {error_pct:>8.2f} '
+                      '{us_per_add:>7.1f} {flash_bytes_per_add:>8.2f}'.format(**r))
+            rows += result
+    with open(args.csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print('wrote', args.csv)
+    print('within 1% of the true count up to (checkpoints):')
+    for kind, nbytes, _ in jobs:
+        ok = [r['devices'] for r in rows if r['filter'] == kind and r['bytes'] == nbytes and abs(r['error_pct']) < 1.0]
+        print('  {} {}: {}'.format(kind, nbytes, max(ok) if ok else 'none'))
+    if args.plot:
+        plot(rows, args.plot)
+    print('{:.1f}s'.format(time.perf_counter() - t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Load the classes and functions from code.py on a regular computer.
+
+code.py is written for CircuitPython and calls main() as soon as it's
+imported, so instead of importing it we parse it and run only the
+definitions (classes, functions, constants and settings) in a namespace
+that supplies host stand-ins for the board-level modules.  The imports,
+MEMCHECK prints and the call to main() are skipped.
+
+    dev = devicecode.load()
+    cc = dev.ContactCounts()
+"""
+import ast
+import array
+import os
+import struct
+import tempfile
+import time
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE_PY = os.path.join(REPO, 'code.py')
+
+
+class Pin:
+    """digitalio.DigitalInOut stand-in"""
+    def __init__(self, pin=None):
+        self.pin = pin
+        self.value = False
+        self.direction = None
+
+    def switch_to_input(self, pull=None):
+        pass
+
+    def switch_to_output(self, value=False):
+        self.value = value
+
+
+class HostClock:
+    """time stand-in; real time by default, or a virtual clock that only moves when told to"""
+    def __init__(self, start=None):
+        self.t = start
+
+    def monotonic(self):
+        return time.monotonic() if self.t is None else self.t
+
+    def monotonic_ns(self):
+        return time.monotonic_ns() if self.t is None else int(self.t * 1000000000)
+
+    def sleep(self, seconds):
+        if self.t is None:
+            time.sleep(seconds)
+        else:
+            self.t += seconds
+
+    def advance(self, seconds):
+        self.t += seconds
+
+
+class HostGc:
+    """gc stand-in with a pretend ~140k heap"""
+    def __init__(self, heap_size=140 * 1024):
+        self.heap_size = heap_size
+        self.allocated = 20 * 1024
+        self.collections = 0
+
+    def collect(self):
+        self.collections += 1
+
+    def mem_free(self):
+        return self.heap_size - self.allocated
+
+    def mem_alloc(self):
+        return self.allocated
+
+
+class HostFS:
+    """
+    Maps the device's flash onto a host directory.
+    images/ is read from the repo; everything else lands in <root>.
+    """
+    def __init__(self, root=None):
+        self.root = root or tempfile.mkdtemp(prefix='sp421-')
+
+    def path(self, filename):
+        filename = filename.lstrip('/')
+        if filename.startswith('images/'):
+            return os.path.join(REPO, filename)
+        return os.path.join(self.root, filename)
+
+    def open(self, filename, mode='r'):
+        return open(self.path(filename), mode)
+
+    def stat(self, filename):
+        return os.stat(self.path(filename))
+
+    def remove(self, filename):
+        os.remove(self.path(filename))
+
+    def rename(self, old, new):
+        os.rename(self.path(old), self.path(new))
+
+    def listdir(self, dirname='/'):
+        return os.listdir(self.path(dirname))
+
+
+class DeviceCode:
+    """Attribute access onto the namespace code.py's definitions run in"""
+    def __init__(self, ns):
+        object.__setattr__(self, 'ns', ns)
+
+    def __getattr__(self, name):
+        try:
+            return self.ns[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.ns[name] = value
+
+
+def address_type_constants():
+    return types.SimpleNamespace(PUBLIC=0, RANDOM_STATIC=1,
+                                 RANDOM_PRIVATE_RESOLVABLE=2,
+                                 RANDOM_PRIVATE_NON_RESOLVABLE=3)
+
+
+def load(root=None, clock=None, eink_base=object, feather=False, settings=None):
+    """
+    Run code.py's definitions and return them as a DeviceCode.
+    root:      host directory standing in for the flash (default: a new temp dir)
+    clock:     a HostClock; pass HostClock(0.0) for virtual time
+    eink_base: the class EInkOverride derives from (Adafruit_IL0373 on the device)
+    settings:  dict of module globals (setting_bt_rssi etc) to override
+    """
+    with open(CODE_PY) as f:
+        tree = ast.parse(f.read(), CODE_PY)
+    keep = [node for node in tree.body
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.Assign))]
+
+    clock = clock or HostClock()
+    fs = HostFS(root)
+    board = types.SimpleNamespace(SCL='SCL', SDA='SDA', RX='RX', TX='TX', A3='A3',
+                                  D3='D3', D5='D5', D7='D7', D13='D13', NEOPIXEL='NEOPIXEL')
+    if not feather:
+        board.D4 = 'D4'
+    ns = {
+        '__name__': 'devicecode',
+        'const': lambda x: x,
+        'board': board,
+        'time': types.SimpleNamespace(monotonic=clock.monotonic, monotonic_ns=clock.monotonic_ns, sleep=clock.sleep),
+        'gc': HostGc(),
+        'os': types.SimpleNamespace(stat=fs.stat, remove=fs.remove, rename=fs.rename,
+                                    listdir=fs.listdir),
+        'open': fs.open,
+        'struct': struct,
+        'array': array.array,
+        '_bleio': types.SimpleNamespace(Address=address_type_constants()),
+        'digitalio': types.SimpleNamespace(DigitalInOut=Pin,
+                                           Direction=types.SimpleNamespace(INPUT=0, OUTPUT=1),
+                                           Pull=types.SimpleNamespace(UP=1, DOWN=2)),
+        'eink_type': eink_base,
+        'uart_server': None,
+    }
+    exec(compile(ast.Module(body=keep, type_ignores=[]), CODE_PY, 'exec'), ns)
+    ns.update(settings or {})
+    dev = DeviceCode(ns)
+    dev.host_clock = clock
+    dev.host_fs = fs
+    return dev
@@ -0,0 +1,620 @@
+"""
+Host e-ink emulator: stands in for Adafruit_IL0373 / Adafruit_SSD1675 under
+code.py's EInkOverride / SSD1675Override and EInkModule.
+
+Every command and data byte goes through a stand-in SPI bus into a panel
+model that keeps the controller's RAM and the image actually on the glass,
+follows partial windows, and adds up modeled refresh time. The panel image
+can be dumped to PNG and compared with golden PNGs in tools/golden.
+
+    python3 tools/eink_emu.py                  # benchmarks + golden compare
+    python3 tools/eink_emu.py --update-golden  # accept the current images
+    python3 tools/eink_emu.py --png-dir out    # also dump every scenario image
+
+Modeled times are rough: SPI bytes at the driver's 1 MHz plus a per-refresh
+waveform time (tri-color IL0373 ~15 s whatever the window, since all gates
+scan; SSD1675 ~2 s full and ~0.3 s partial).
+"""
+import argparse
+import contextlib
+import io
+import os
+import struct
+import sys
+import tempfile
+import time
+import types
+import zlib
+
+import devicecode
+
+SPI_HZ = 1000000      # adafruit_epd configures the bus for 1 MHz
+CALL_SECONDS = 20e-6  # rough CircuitPython overhead per spi.write() call
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+FONT_FILE = os.path.join(devicecode.REPO, 'font5x8.bin')
+
+BLACK = 0
+WHITE = 1
+INVERSE = 2
+RED = 3
+
+
+class StandInSPI:
+    """busio.SPI stand-in: keeps transfer stats and feeds a panel model, if one is attached"""
+    def __init__(self, *args, dc_pin=None, **kwargs):
+        self.dc_pin = dc_pin
+        self.panel = None
+        self.locked = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.bytes = 0
+        self.data_bytes = 0
+        self.calls = 0
+        self.data = bytearray()
+        self.commands = []  # [command byte, bytearray of its data]
+
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def unlock(self):
+        self.locked = False
+
+    def configure(self, **kwargs):
+        pass
+
+    def write(self, buf, start=0, end=None):
+        chunk = bytes(buf[start:end])
+        self.calls += 1
+        self.bytes += len(chunk)
+        if self.dc_pin is not None and self.dc_pin.value:
+            self.data_bytes += len(chunk)
+            self.data += chunk
+            if self.commands:
+                self.commands[-1][1] += chunk
+            if self.panel:
+                self.panel.data(chunk)
+        else:
+            for b in chunk:
+                self.commands.append([b, bytearray()])
+                if self.panel:
+                    self.panel.command(b)
+
+    def write_readinto(self, out_buf, in_buf):
+        self.write(out_buf)
+
+    def modeled_seconds(self):
+        return self.bytes * 8 / SPI_HZ + self.calls * CALL_SECONDS
+
+
+class StandInSRAM:
+    """mcp_sram.Adafruit_MCP_SRAM stand-in holding both planes"""
+    def __init__(self, size, spi):
+        self.mem = bytearray(size)
+        self.spi = spi
+        self.cs_pin = devicecode.Pin()
+
+    def read(self, addr, length):
+        self.spi.calls += 1
+        self.spi.bytes += 3 + length
+        return bytearray(self.mem[addr:addr + length])
+
+
+class PanelModel:
+    """Controller RAM and the image on the glass, both as black/red planes (0 bit = ink)"""
+    full_refresh_seconds = 15.0
+    partial_refresh_seconds = 15.0
+
+    def __init__(self, stride, rows, planes=2):
+        self.stride = stride
+        self.rows = rows
+        self.ram = [bytearray(b'\xff' * stride * rows) for i in range(planes)]
+        self.image = [bytearray(b'\xff' * stride * rows) for i in range(planes)]
+        self.cmd = None
+        self.args = bytearray()
+        self.refreshes = 0
+        self.partial_refreshes = 0
+        self.refresh_seconds = 0.0
+        self.set_window(0, self.stride - 1, 0, self.rows - 1)
+
+    def set_window(self, bx0, bx1, y0, y1):
+        self.window = (bx0, bx1, y0, y1)
+        self.bx = bx0
+        self.y = y0
+
+    def command(self, cmd):
+        self.end_command()
+        self.cmd = cmd
+        self.args = bytearray()
+        self.start_command(cmd)
+
+    def data(self, chunk):
+        if self.ram_target() is not None:
+            for b in chunk:
+                self.put_ram_byte(b)
+        else:
+            self.args += chunk
+
+    def put_ram_byte(self, b):
+        bx0, bx1, y0, y1 = self.window
+        if self.y <= y1 and self.bx < self.stride and self.y < self.rows:
+            self.ram[self.ram_target()][self.y * self.stride + self.bx] = b
+        self.bx += 1
+        if self.bx > bx1:
+            self.bx = bx0
+            self.y += 1
+
+    def ram_target(self):
+        return None
+
+    def start_command(self, cmd):
+        pass
+
+    def end_command(self):
+        pass
+
+    def show(self, window=None):
+        """copy RAM to the glass, for the window (byte columns, rows) or everything"""
+        bx0, bx1, y0, y1 = window or (0, self.stride - 1, 0, self.rows - 1)
+        for ram, image in zip(self.ram, self.image):
+            for row in range(y0, min(self.rows - 1, y1) + 1):
+                a = row * self.stride + bx0
+                b = row * self.stride + min(self.stride - 1, bx1) + 1
+                image[a:b] = ram[a:b]
+        self.refreshes += 1
+        if window is None:
+            self.refresh_seconds += self.full_refresh_seconds
+        else:
+            self.partial_refreshes += 1
+            self.refresh_seconds += self.partial_refresh_seconds
+
+
+class IL0373Model(PanelModel):
+    DTM1 = 0x10
+    DTM2 = 0x13
+    DISPLAY_REFRESH = 0x12
+    PARTIAL_WINDOW = 0x90
+    PARTIAL_IN = 0x91
+    PARTIAL_OUT = 0x92
+
+    def __init__(self, stride, rows):
+        super().__init__(stride, rows)
+        self.partial = False
+
+    def ram_target(self):
+        return {self.DTM1: 0, self.DTM2: 1}.get(self.cmd)
+
+    def start_command(self, cmd):
+        if cmd in (self.DTM1, self.DTM2):
+            # RAM writes start at the top-left of the partial window, or of the panel
+            bx0, bx1, y0, y1 = self.window if self.partial else (0, self.stride - 1, 0, self.rows - 1)
+            self.set_window(bx0, bx1, y0, y1)
+            if not self.partial:
+                self.window = (0, self.stride - 1, 0, self.rows - 1)
+        elif cmd == self.PARTIAL_IN:
+            self.partial = True
+        elif cmd == self.PARTIAL_OUT:
+            self.partial = False
+        elif cmd == self.DISPLAY_REFRESH:
+            self.show(self.window if self.partial else None)
+
+    def end_command(self):
+        if self.cmd == self.PARTIAL_WINDOW and len(self.args) >= 6:
+            a = self.args
+            self.set_window(a[0] >> 3, a[1] >> 3, (a[2] << 8) | a[3], (a[4] << 8) | a[5])
+
+
+class SSD1675Model(PanelModel):
+    full_refresh_seconds = 2.0
+    partial_refresh_seconds = 0.3
+    WRITE_RAM1 = 0x24
+    WRITE_RAM2 = 0x26
+    MASTER_ACTIVATE = 0x20
+    DISP_CTRL2 = 0x22
+    SET_RAMXPOS = 0x44
+    SET_RAMYPOS = 0x45
+    SET_RAMXCOUNT = 0x4E
+    SET_RAMYCOUNT = 0x4F
+
+    def __init__(self, stride, rows):
+        super().__init__(stride, rows)
+        self.update_mode = 0xF7
+
+    def ram_target(self):
+        return {self.WRITE_RAM1: 0, self.WRITE_RAM2: 1}.get(self.cmd)
+
+    def start_command(self, cmd):
+        if cmd == self.MASTER_ACTIVATE:
+            # differential partial update: only pixels that differ between RAM1 and
+            # RAM2 get driven, but the result is RAM1 either way; RAM2 isn't shown
+            ram2 = self.ram[1]
+            self.ram[1] = self.image[1]
+            self.show(None if self.update_mode == 0xF7 else self.window)
+            self.ram[1] = ram2
+
+    def end_command(self):
+        a = self.args
+        if self.cmd == self.SET_RAMXPOS and len(a) >= 2:
+            self.window = (a[0], a[1], self.window[2], self.window[3])
+        elif self.cmd == self.SET_RAMYPOS and len(a) >= 4:
+            self.window = (self.window[0], self.window[1], a[0] | (a[1] << 8), a[2] | (a[3] << 8))
+        elif self.cmd == self.SET_RAMXCOUNT and len(a) >= 1:
+            self.bx = a[0]
+        elif self.cmd == self.SET_RAMYCOUNT and len(a) >= 2:
+            self.y = a[0] | (a[1] << 8)
+        elif self.cmd == self.DISP_CTRL2 and len(a) >= 1:
+            self.update_mode = a[0]
+
+
+class EmulatedEPD:
+    """
+    Adafruit_EPD stand-in: the framebuffer drawing calls code.py uses
+    (pixel, fill, fill_rect, text) plus the SPI plumbing the overrides call.
+    Planes are MHMSB with 1 = white, like the driver with inverted buffers.
+    """
+    BLACK = BLACK
+    WHITE = WHITE
+    INVERSE = INVERSE
+    RED = RED
+    model_class = PanelModel
+
+    def __init__(self, width, height, spi, *, cs_pin, dc_pin, sramcs_pin, rst_pin, busy_pin):
+        self._width = width
+        self._height = height
+        self.spi_device = spi
+        self._cs = cs_pin
+        self._dc = dc_pin
+        self._rst = rst_pin
+        self._busy = busy_pin
+        self._spibuf = bytearray(1)
+        stride = (width + 7) >> 3
+        self._buffer1_size = self._buffer2_size = stride * height
+        self.sram = None
+        if sramcs_pin:
+            self.sram = StandInSRAM(self._buffer1_size * 2, spi)
+            self._buffer1 = self._buffer2 = None
+        else:
+            self._buffer1 = bytearray(b'\xff' * self._buffer1_size)
+            self._buffer2 = self.make_buffer2()
+        self.panel = self.make_panel(stride, height)
+        spi.dc_pin = dc_pin
+        spi.panel = self.panel
+        with open(FONT_FILE, 'rb') as f:
+            self.font = f.read()
+
+    def make_panel(self, stride, height):
+        return self.model_class(stride, height)
+
+    def make_buffer2(self):
+        return bytearray(b'\xff' * self._buffer2_size)
+
+    # SPI plumbing, as in adafruit_epd.epd
+    def command(self, cmd, data=None, end=True):
+        self._cs.value = True
+        self._dc.value = False
+        self._cs.value = False
+        while not self.spi_device.try_lock():
+            pass
+        ret = self._spi_transfer(cmd)
+        if data is not None:
+            self._dc.value = True
+            for b in data:
+                self._spi_transfer(b)
+        if end:
+            self._cs.value = True
+        self.spi_device.unlock()
+        return ret
+
+    def _spi_transfer(self, databyte):
+        self._spibuf[0] = databyte
+        self.spi_device.write(self._spibuf)
+        return 0
+
+    def hardware_reset(self):
+        pass
+
+    def busy_wait(self):
+        pass
+
+    # drawing
+    def _planes_for(self, color):
+        """(black ink, red ink) for a color"""
+        return color == BLACK, color == RED
+
+    def pixel(self, x, y, color):
+        if not (0 <= x < self._width and 0 <= y < self._height):
+            return
+        i = y * (self._buffer1_size // self._height) + (x >> 3)
+        mask = 0x80 >> (x & 7)
+        planes = zip((self._buffer1, self._buffer2), self._planes_for(color))
+        if self._buffer2 is self._buffer1:
+            planes = [next(planes)] # monochrome: one plane, as the driver's _color_dup does
+        for buf, ink in planes:
+            if ink:
+                buf[i] &= ~mask
+            else:
+                buf[i] |= mask
+
+    def fill_rect(self, x, y, w, h, color):
+        for yy in range(max(0, y), min(self._height, y + h)):
+            for xx in range(max(0, x), min(self._width, x + w)):
+                self.pixel(xx, yy, color)
+
+    def fill(self, color):
+        self.fill_rect(0, 0, self._width, self._height, color)
+
+    def text(self, string, x, y, color, *, font_name='font5x8.bin', size=1):
+        fw, fh = self.font[0], self.font[1]
+        for i, ch in enumerate(string):
+            cx = x + i * (fw + 1)
+            for col in range(fw):
+                line = self.font[2 + ord(ch) * fw + col]
+                for row in range(fh):
+                    if (line >> row) & 1:
+                        self.pixel(cx + col, y + row, color)
+
+
+class EmulatedIL0373(EmulatedEPD):
+    model_class = IL0373Model
+
+    def write_ram(self, index):
+        return self.command(0x10 if index == 0 else 0x13, end=False)
+
+    def power_down(self):
+        self.command(0x50, bytearray([0x17]))
+        self.command(0x82, bytearray([0x00]))
+        self.command(0x02)
+
+
+class EmulatedSSD1675(EmulatedEPD):
+    model_class = SSD1675Model
+
+    def make_panel(self, stride, height):
+        # RAM as the driver sets it up: 250 gate lines of 16 bytes, filled
+        # with the framebuffer's bytes in order
+        return self.model_class(16, 250)
+
+    def make_buffer2(self):
+        # the driver has one plane: _buffer2 is _buffer1
+        return self._buffer1
+
+    def _planes_for(self, color):
+        # monochrome: anything that isn't white is black
+        return color != WHITE, False
+
+    def write_ram(self, index):
+        return self.command(0x24 if index == 0 else 0x26, end=False)
+
+    def power_down(self):
+        self.command(0x10, bytearray([0x01]))
+
+
+########################################################################
+# PNG in and out, without PIL: 8-bit RGB, filter 0 (what write_png makes)
+
+def planes_to_rgb(black, red, stride, width, height):
+    rows = []
+    for y in range(height):
+        row = bytearray()
+        for x in range(width):
+            i = y * stride + (x >> 3)
+            mask = 0x80 >> (x & 7)
+            if not black[i] & mask:
+                row += b'\x00\x00\x00'
+            elif red is not None and not red[i] & mask:
+                row += b'\xff\x00\x00'
+            else:
+                row += b'\xff\xff\xff'
+        rows.append(bytes(row))
+    return rows
+
+
+def write_png(filename, rows, width, height):
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    raw = b''.join(b'\x00' + row for row in rows)
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 9)))
+        f.write(chunk(b'IEND', b''))
+
+
+def read_png(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n', 'not a png'
+    pos = 8
+    idat = b''
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if kind == b'IHDR':
+            width, height, depth, ctype = struct.unpack('>IIBB', body[:10])
+            assert (depth, ctype) == (8, 2), 'only 8-bit RGB pngs'
+        elif kind == b'IDAT':
+            idat += body
+        pos += 12 + length
+    raw = zlib.decompress(idat)
+    rows = []
+    for y in range(height):
+        line = raw[y * (width * 3 + 1):(y + 1) * (width * 3 + 1)]
+        assert line[0] == 0, 'only unfiltered pngs'
+        rows.append(bytes(line[1:]))
+    return rows, width, height
+
+
+def panel_rows(display, width, height):
+    p = display.panel
+    red = p.image[1] if isinstance(p, IL0373Model) else None
+    # the panel RAM holds the framebuffer's bytes in order, whatever its line length
+    return planes_to_rgb(p.image[0], red, display._buffer1_size // height, width, height)
+
+
+########################################################################
+# driving EInkModule on the host
+
+class Buttons:
+    def left(self):
+        return False
+
+    def right(self):
+        return False
+
+    def switch(self):
+        return False
+
+
+def load_device(feather=False, root=None):
+    clock = devicecode.HostClock(1000.0)
+    base = EmulatedSSD1675 if feather else EmulatedIL0373
+    dev = devicecode.load(root=root, clock=clock, eink_base=base, feather=feather)
+    dev.busio = types.SimpleNamespace(SPI=StandInSPI)
+    dev.Adafruit_EPD = EmulatedEPD
+    dev.btprint = lambda text: None
+    return dev
+
+
+def settle(dev, eink, cc, max_seconds=600):
+    """run EInkModule until nothing is refreshing or pending; returns virtual seconds taken"""
+    start = dev.host_clock.t
+    buttons = Buttons()
+    while dev.host_clock.t - start < max_seconds:
+        eink.periodic_update(cc, buttons)
+        if not eink.refreshing() and not eink.scheduler.pending:
+            break
+        dev.host_clock.advance(0.25)
+    return dev.host_clock.t - start
+
+
+class Counter:
+    """SPI + panel totals between two points"""
+    def __init__(self, eink):
+        self.eink = eink
+        self.spi = eink.display.spi_device
+        self.panel = eink.display.panel
+        self.start = (self.spi.bytes, self.spi.calls, self.panel.refreshes, self.panel.refresh_seconds)
+        self.t = time.perf_counter()
+
+    def result(self):
+        host_ms = (time.perf_counter() - self.t) * 1000
+        spi_bytes = self.spi.bytes - self.start[0]
+        calls = self.spi.calls - self.start[1]
+        refreshes = self.panel.refreshes - self.start[2]
+        panel_s = self.panel.refresh_seconds - self.start[3]
+        model_s = spi_bytes * 8 / SPI_HZ + calls * CALL_SECONDS + panel_s
+        return spi_bytes, refreshes, model_s, host_ms
+
+
+def scenarios(feather=False):
+    """runs a typical session; returns (step, stats, panel rows) after each step"""
+    dev = load_device(feather)
+    results = []
+
+    def step(name, change, max_seconds=600):
+        c = Counter(eink)
+        change()
+        settle(dev, eink, cc, max_seconds)
+        results.append((name, c.result(), panel_rows(eink.display, eink.width, eink.height)))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cc = dev.ContactCounts()
+        cc.persistent_data.update({'unique_counts': 1234, '5min': 3, '30min': 5, '2hour': 7})
+        for i in range(cc.history_bar.num_columns):
+            cc.history_bar.set_value(i, (i * 37) % 23)
+        t = time.perf_counter()
+        eink = dev.EInkModule.__new__(dev.EInkModule)
+        dev.EInkModule.__init__(eink, cc)
+        settle(dev, eink, cc)
+        spi, panel = eink.display.spi_device, eink.display.panel
+        model_s = spi.bytes * 8 / SPI_HZ + spi.calls * CALL_SECONDS + panel.refresh_seconds
+        results.append(('draw_everything', (spi.bytes, panel.refreshes, model_s, (time.perf_counter() - t) * 1000),
+                        panel_rows(eink.display, eink.width, eink.height)))
+        step('dial up', lambda: cc.persistent_data.update({'5min': 4}))
+        step('dial down', lambda: cc.persistent_data.update({'30min': 2}))
+        step('number down', lambda: cc.persistent_data.update({'unique_counts': 987}))
+
+        def history():
+            cc.history_bar.set_value(0, 40)
+            cc.history_bar.draw(eink)
+        step('history bar', history, max_seconds=20 * 60)
+
+        def durations():
+            for seconds in (40, 200, 330, 900, 4000):
+                cc.histogram.add(seconds)
+        step('encounter length', durations, max_seconds=20 * 60)
+    return eink.width, eink.height, results
+
+
+def reload_check(feather=False):
+    """
+    save the history bar with the ring part way round, boot again from the
+    saved file and check the bar's digest comes out the same, so the e-ink
+    state saved before the reboot still matches
+    """
+    root = tempfile.mkdtemp()
+    digests = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for boot in range(2):
+            dev = load_device(feather, root)
+            cc = dev.ContactCounts()
+            hb = cc.history_bar
+            if boot == 0:
+                for i in range(hb.num_columns):
+                    hb.set_value(i, (i * 37) % 23)
+                hb.start_index = 45
+                hb.save()
+            eink = dev.EInkModule.__new__(dev.EInkModule)
+            dev.EInkModule.__init__(eink, cc)
+            digests.append(hb.drawn_digest)
+    return digests[0] == digests[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render code.py through an emulated e-ink panel')
+    parser.add_argument('--feather', action='store_true', help='emulate the Feather SSD1675 instead of the IL0373')
+    parser.add_argument('--update-golden', action='store_true', help='write the current images as the new goldens')
+    parser.add_argument('--png-dir', help='also write every scenario image here')
+    args = parser.parse_args()
+
+    panel_name = 'ssd1675' if args.feather else 'il0373'
+    failures = 0
+    print('{:<16} {:>9} {:>9} {:>10} {:>9}  {}'.format(
+        'step', 'spi bytes', 'refreshes', 'model s', 'host ms', 'golden'))
+    width, height, results = scenarios(args.feather)
+    for name, (spi_bytes, refreshes, model_s, host_ms), rows in results:
+        png_name = '{}-{}.png'.format(panel_name, name.replace(' ', '_'))
+        golden = os.path.join(GOLDEN_DIR, png_name)
+        if args.png_dir:
+            os.makedirs(args.png_dir, exist_ok=True)
+            write_png(os.path.join(args.png_dir, png_name), rows, width, height)
+        if args.update_golden:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            write_png(golden, rows, width, height)
+            verdict = 'updated'
+        elif not os.path.exists(golden):
+            verdict = 'no golden'
+        else:
+            expected, gw, gh = read_png(golden)
+            bad = sum(1 for a, b in zip(rows, expected) for i in range(0, len(a), 3) if a[i:i+3] != b[i:i+3])
+            if (gw, gh) != (width, height) or bad:
+                failures += 1
+                verdict = 'MISMATCH ({} pixels)'.format(bad)
+            else:
+                verdict = 'ok'
+        print('{:<16} {:>9} {:>9} {:>10.1f} {:>9.1f}  {}'.format(
+            name, spi_bytes, refreshes, model_s, host_ms, verdict))
+    if reload_check(args.feather):
+        print('history digest after reload: ok')
+    else:
+        failures += 1
+        print('history digest after reload: MISMATCH')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+Compare code.py's "seen before" filters (Bloom and CuckooFilter) on the same
+address streams, using the device classes themselves.
+
+For each stream and filter it prints, at a few population sizes:
+  - missed:   new addresses the filter said it had seen (the unique count
+              comes out this much low)
+  - fp rate:  false "seen before" on fresh addresses, measured at that size
+  - flash B/add: bytes written back to flash per address added
+  - us/add:   host time per add(), flash writes left out
+and then checks forgetting: remove half, the removed ones must read as new
+and every kept one as seen.
+
+    python3 tools/filter_bench.py
+    python3 tools/filter_bench.py --bytes 8192 --population 1000 3000 6000
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+
+import devicecode
+
+
+def random_stream(rng, n):
+    """random static addresses (the top two bits of a random static address are set)"""
+    for _ in range(n):
+        a = bytearray(rng.getrandbits(8) for _ in range(6))
+        a[5] |= 0xc0
+        yield bytes(a)
+
+
+def oui_stream(rng, n, vendors=12):
+    """public addresses from a few vendors, handed out in blocks (the worst case for the old filter)"""
+    ouis = [bytes(rng.getrandbits(8) for _ in range(3)) for _ in range(vendors)]
+    next_nic = [rng.getrandbits(16) << 8 for _ in ouis]
+    for _ in range(n):
+        v = rng.randrange(vendors)
+        nic = next_nic[v]
+        next_nic[v] = (nic + rng.randrange(1, 40)) & 0xffffff
+        yield nic.to_bytes(3, 'little') + ouis[v]
+
+
+def mixed_stream(rng, n):
+    rand = random_stream(rng, n)
+    oui = oui_stream(rng, n)
+    for _ in range(n):
+        yield next(oui) if rng.random() < 0.6 else next(rand)
+
+
+STREAMS = {'random': random_stream, 'oui': oui_stream, 'mixed': mixed_stream}
+
+
+def make_filter(dev, kind, nbytes, hashes):
+    if kind == 'bloom':
+        f = dev.Bloom('/data_bloom.bin', m_bits=nbytes * 8, k=hashes)
+        unit = 1
+    else:
+        f = dev.CuckooFilter('/data_cuckoo.bin', num_bytes=nbytes)
+        unit = f.BUCKET_BYTES
+    written = [0]
+
+    def save(changed=None):
+        written[0] += len(f.bits) if changed is None else unit * len(changed)
+    f.save = save
+    return f, written
+
+
+def run(dev, kind, stream_name, args):
+    rng = random.Random(args.seed)
+    addrs = list(STREAMS[stream_name](rng, max(args.population)))
+    probes = list(random_stream(random.Random(args.seed + 1), args.probes))
+    f, written = make_filter(dev, kind, args.bytes, args.hashes)
+    rows = []
+    missed = 0
+    elapsed = 0.0
+    done = 0
+    for n in sorted(args.population):
+        t = time.perf_counter()
+        for addr in addrs[done:n]:
+            if not f.add(addr):
+                missed += 1
+        elapsed += time.perf_counter() - t
+        done = n
+        fp = sum(1 for a in probes if f.contains(a)) / len(probes)
+        rows.append((n, missed, fp, written[0] / n, elapsed / n * 1e6))
+    forget = None
+    if f.CAN_FORGET:
+        n = min(args.population)
+        f.clear()
+        kept = addrs[:n:2]
+        gone = addrs[1:n:2]
+        for a in addrs[:n]:
+            f.add(a)
+        removed = sum(1 for a in gone if f.remove(a))
+        forget = (removed, len(gone), sum(1 for a in gone if f.contains(a)),
+                  sum(1 for a in kept if not f.contains(a)))
+    return rows, forget
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bloom vs cuckoo filter on the same address streams')
+    parser.add_argument('--bytes', type=int, default=24 * 1024, help='memory for each filter')
+    parser.add_argument('--hashes', type=int, default=None, help='bloom hashes (default: setting_bloom_hashes)')
+    parser.add_argument('--population', type=int, nargs='+', default=[1000, 5000, 10000, 11500])
+    parser.add_argument('--probes', type=int, default=20000, help='fresh addresses for the fp rate')
+    parser.add_argument('--streams', nargs='+', default=list(STREAMS), choices=list(STREAMS))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    dev = devicecode.load(root=tempfile.mkdtemp(prefix='filter-bench-'))
+    dev.btprint = lambda text: None
+    args.hashes = args.hashes or dev.setting_bloom_hashes
+    print('{} bytes each; bloom k={}, cuckoo {} slots/bucket, 16 bit fingerprints'.format(
+        args.bytes, args.hashes, dev.CuckooFilter.SLOTS))
+    print('{:>8} {:>7} {:>9} {:>8} {:>10} {:>12} {:>8}'.format(
+        'stream', 'filter', 'devices', 'missed', 'fp rate', 'flash B/add', 'us/add'))
+    for stream in args.streams:
+        for kind in ('bloom', 'cuckoo'):
+            rows, forget = run(dev, kind, stream, args)
+            for n, missed, fp, wpa, us in rows:
+                print('{:>8} {:>7} {:>9} {:>8} {:>9.4%} {:>12.2f} {:>8.1f}'.format(
+                    stream, kind, n, missed, fp, wpa, us))
+            if forget:
+                removed, total, still_seen, lost = forget
+                print('{:>8} {:>7}   forgot {}/{}; forgotten still seen: {}, kept but lost: {}'.format(
+                    stream, kind, removed, total, still_seen, lost))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
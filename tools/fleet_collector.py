@@ -0,0 +1,469 @@
+"""
+Pull data from many badges at once into one SQLite store.
+
+Each badge is reached through a transport (anything that can send bytes and
+receive bytes): "tcp:HOST:PORT" for a socket, or "pty:/dev/pts/N" / a path
+for a serial device such as a BLE UART bridge or an rfcomm port.  A BLE
+transport only needs the same open/write/read/close methods.
+
+The collector speaks the badge's UART commands: 143.get (framed, resumable,
+see uart_frames.py) and, for badges without it, 143.all / 143.log as text.
+The store keeps a cursor per badge and stream, so each pull asks only for
+log bytes it hasn't got yet.  Encounters are kept one row each, updated
+while the badge still reports them; history and (with --bloom) the bloom
+filter are snapshots, stored when they change.
+
+    python3 tools/fleet_collector.py --db fleet.db tcp:10.0.0.5:8143 pty:/dev/pts/4
+    python3 tools/fleet_collector.py --demo 16   # fake badges running code.py on localhost
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tty
+import types
+
+import uart_frames
+
+SCHEMA = '''
+create table if not exists badges (badge text primary key, last_pull real, status text, legacy integer default 0);
+create table if not exists cursors (badge text, stream text, offset integer, tail blob, primary key (badge, stream));
+create table if not exists log_lines (badge text, pulled real, line text);
+create table if not exists encounters (badge text, pulled real, address text, is_new integer, is_home integer,
+                                       is_hopper integer, first_ago integer, last_ago integer, duration integer);
+create table if not exists snapshots (badge text, stream text, pulled real, digest integer, data blob);
+'''
+TAIL = 64  # bytes before the cursor kept to notice when the badge's log has rotated under us
+
+
+class TcpTransport:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self.reader = self.writer = None
+
+    def __str__(self):
+        return 'tcp:{}:{}'.format(self.host, self.port)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read(self):
+        data = await self.reader.read(4096)
+        if not data:
+            raise ConnectionError('closed by badge')
+        return data
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            with contextlib.suppress(Exception):
+                await self.writer.wait_closed()
+
+
+class PtyTransport:
+    """a pty or serial device file, read through the event loop"""
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.queue = None
+
+    def __str__(self):
+        return 'pty:{}'.format(self.path)
+
+    async def open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        if os.isatty(self.fd):
+            tty.setraw(self.fd)  # binary frames, no echo or newline translation
+        self.queue = asyncio.Queue()
+        asyncio.get_running_loop().add_reader(self.fd, self._readable)
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as ex:
+            data = ex
+        self.queue.put_nowait(data or ConnectionError('closed'))
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                await asyncio.sleep(0.01)
+
+    async def read(self):
+        data = await self.queue.get()
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    async def close(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+def make_transport(spec):
+    if spec.startswith('tcp:'):
+        host, port = spec[4:].rsplit(':', 1)
+        return TcpTransport(host, port)
+    return PtyTransport(spec[4:] if spec.startswith('pty:') else spec)
+
+
+class Store:
+    """one SQLite file for the whole fleet"""
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def cursor(self, badge, stream):
+        row = self.db.execute('select offset, tail from cursors where badge=? and stream=?',
+                              (badge, stream)).fetchone()
+        return row if row else (0, b'')
+
+    def add_log(self, badge, offset, data, pulled):
+        """data is the log from offset on; keeps whole lines, the rest waits for next time"""
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].decode(errors='replace').splitlines()
+        self.db.executemany('insert into log_lines values (?, ?, ?)',
+                            [(badge, pulled, line) for line in lines if line.strip()])
+        old_offset, old_tail = self.cursor(badge, 'log')
+        tail = (old_tail + data[:end])[-TAIL:]
+        self.db.execute('insert or replace into cursors values (?, ?, ?, ?)', (badge, 'log', offset + end, tail))
+        return len(lines)
+
+    def reset_log(self, badge):
+        self.db.execute('delete from cursors where badge=? and stream=?', (badge, 'log'))
+
+    def add_encounters(self, badge, encounters, pulled):
+        """
+        update the rows of encounters still going since the badge's last pull,
+        add the rest; returns how many were new. A record continues one from
+        the last pull with the same address that it has lasted at least as long
+        as (ages are on the badge's clock, so they can't be compared with pulled).
+        """
+        last = {}
+        row = self.db.execute('select max(pulled) from encounters where badge=?', (badge,)).fetchone()
+        if row[0] is not None:
+            for rowid, address, first_ago in self.db.execute(
+                    'select rowid, address, first_ago from encounters where badge=? and pulled=?', (badge, row[0])):
+                last[address] = (rowid, first_ago)
+        new = 0
+        for e in encounters:
+            values = (pulled, e.is_new, e.is_home, e.is_hopper, e.first_ago, e.last_ago, e.duration)
+            prev = last.pop(e.address, None)
+            if prev and e.first_ago >= prev[1]:
+                self.db.execute('update encounters set pulled=?, is_new=?, is_home=?, is_hopper=?, first_ago=?, '
+                                'last_ago=?, duration=? where rowid=?', values + (prev[0],))
+            else:
+                self.db.execute('insert into encounters values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (badge, pulled, e.address) + values[1:])
+                new += 1
+        return new
+
+    def add_snapshot(self, badge, stream, data, pulled):
+        """store the stream if it changed since the last snapshot; True if it did"""
+        digest = uart_frames.fnv1a32(data)
+        row = self.db.execute('select digest from snapshots where badge=? and stream=? order by pulled desc limit 1',
+                              (badge, stream)).fetchone()
+        if row and row[0] == digest:
+            return False
+        self.db.execute('insert into snapshots values (?, ?, ?, ?, ?)', (badge, stream, pulled, digest, bytes(data)))
+        return True
+
+    def set_badge(self, badge, pulled, status=None, legacy=False):
+        self.db.execute('insert or replace into badges values (?, ?, ?, ?)',
+                        (badge, pulled, repr(status) if status else None, int(legacy)))
+
+    def commit(self):
+        self.db.commit()
+
+
+class BadgeSession:
+    """one badge: connect, pull each stream, reconnect and resume when the link drops"""
+    def __init__(self, transport, store, timeout=10.0, retries=5, bloom=False):
+        self.transport = transport
+        self.bloom = bloom  # the bloom is 24k and rarely interesting, so it's only pulled on request
+        self.badge = str(transport)
+        self.store = store
+        self.timeout = timeout
+        self.retries = retries
+        self.parser = None
+        self.status = None
+        self.texts = []
+        self.stats = {'bytes': 0, 'reconnects': 0, 'log lines': 0, 'encounters': 0, 'snapshots': 0}
+
+    async def connect(self):
+        await self.transport.open()
+        self.parser = uart_frames.FrameParser()
+
+    async def receive(self, done, transfer=None, timeout=None):
+        """
+        feed received bytes to the parser until done() is true; frames go to
+        transfer. Times out when nothing useful arrives for timeout seconds.
+        """
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout
+        while not done():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise asyncio.TimeoutError()
+            data = await asyncio.wait_for(self.transport.read(), left)
+            self.stats['bytes'] += len(data)
+            for kind, item in self.parser.feed(data):
+                if kind == 'text':
+                    self.texts.append(item)
+                elif item.stream == uart_frames.STATUS_STREAM:
+                    self.status = uart_frames.decode_status(item)
+                elif transfer and transfer.add(item):
+                    deadline = time.monotonic() + timeout
+
+    async def pull_stream(self, stream, req_id, offset=0):
+        """the stream from offset to its end, reconnecting and resuming as needed"""
+        transfer = uart_frames.Transfer(stream, req_id, offset)
+        for attempt in range(self.retries + 1):
+            try:
+                await self.transport.write(transfer.command())
+                await self.receive(lambda: transfer.done, transfer)
+                return transfer
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                self.stats['reconnects'] += 1
+                await self.transport.close()
+                await asyncio.sleep(0.2 * (attempt + 1))
+                await self.connect()
+        return transfer
+
+    async def pull(self):
+        pulled = time.time()
+        await self.connect()
+        try:
+            offset, tail = self.store.cursor(self.badge, 'log')
+            try:
+                await self.receive(lambda: self.status is not None, timeout=3.0)
+            except asyncio.TimeoutError:
+                pass
+            if self.status is None:
+                return await self.pull_legacy(pulled)
+            if tail:
+                # re-read the tail first: if it moved, the logs rotated and we start over
+                start = max(0, offset - len(tail))
+                check = await self.pull_stream('log', 1, start)
+                if check.start != start or not bytes(check.data).startswith(tail):
+                    self.store.reset_log(self.badge)
+                    offset = 0
+                else:
+                    self.store_log(offset, bytes(check.data)[len(tail):], pulled)
+                    offset = None
+            if offset is not None:
+                transfer = await self.pull_stream('log', 2, offset)
+                if transfer.start != offset:
+                    # the log rotated during a resume and the badge sent it all from 0
+                    self.store.reset_log(self.badge)
+                self.store_log(transfer.start, bytes(transfer.data), pulled)
+            transfer = await self.pull_stream('encounters', 3)
+            self.stats['encounters'] += self.store.add_encounters(
+                self.badge, uart_frames.decode_encounters(transfer.data), pulled)
+            for req_id, stream in ((4, 'history'), (5, 'bloom')):
+                if stream == 'bloom' and not self.bloom:
+                    continue
+                transfer = await self.pull_stream(stream, req_id)
+                self.stats['snapshots'] += self.store.add_snapshot(self.badge, stream, transfer.data, pulled)
+            self.store.set_badge(self.badge, pulled, self.status)
+            self.store.commit()
+        finally:
+            await self.transport.close()
+        return self.stats
+
+    def store_log(self, offset, data, pulled):
+        self.stats['log lines'] += self.store.add_log(self.badge, offset, data, pulled)
+
+    async def pull_legacy(self, pulled):
+        """badges that only know 143.all and 143.log: read their text, keep what's new"""
+        self.texts = []
+        await self.transport.write(b'143.log\n')
+        with contextlib.suppress(asyncio.TimeoutError):
+            await self.receive(lambda: False, timeout=2.0)
+        lines = [t for t in self.texts if t.count(',') >= 2 and not t.startswith('RX:')]
+        data = ''.join(line + '\n' for line in lines).encode()
+        offset, tail = self.store.cursor(self.badge, 'log')
+        start = data.find(tail) + len(tail) if tail and tail in data else 0
+        self.store.reset_log(self.badge)
+        self.store_log(start, data[start:], pulled)
+        self.store.set_badge(self.badge, pulled, legacy=True)
+        self.store.commit()
+        return self.stats
+
+
+async def collect(specs, store, concurrency=8, bloom=False):
+    """pull every badge, at most concurrency at a time; returns {badge: stats or exception}"""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(spec):
+        async with limit:
+            session = BadgeSession(make_transport(spec), store, bloom=bloom)
+            try:
+                return session.badge, await session.pull()
+            except Exception as ex:
+                return session.badge, ex
+
+    return dict(await asyncio.gather(*[one(spec) for spec in specs]))
+
+
+########################################################################
+# fake badges for testing: the real code.py UART handling behind a socket
+
+class FakeUart:
+    """UARTService stand-in between the device code and a socket"""
+    def __init__(self):
+        self.rx = bytearray()
+        self.tx = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def read(self, n):
+        data, self.rx = bytes(self.rx[:n]), self.rx[n:]
+        return data
+
+    def write(self, data):
+        self.tx += data
+
+
+class FakeBadge:
+    """
+    code.py's ContactCounts and BluetoothModule.uart_update() on the host,
+    listening on a local port. drop_after closes the first connection after
+    that many bytes, to exercise resuming.
+    """
+    def __init__(self, seed, drop_after=None, loop_seconds=0.01):
+        import devicecode
+        self.dev = devicecode.load(root=tempfile.mkdtemp(prefix='badge{}-'.format(seed)),
+                                   clock=devicecode.HostClock(1000.0))
+        self.seed = seed
+        self.drop_after = drop_after
+        self.loop_seconds = loop_seconds
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.cc = self.dev.ContactCounts()
+            self.bt = self.dev.BluetoothModule.__new__(self.dev.BluetoothModule)
+            self.bt.init_uart(FakeUart())
+            self.dev.radio = types.SimpleNamespace(connected=True) # so btprint() reaches the UART too
+            self.cc.current_debug_out = ''
+            self.add_activity(200)
+        self.server = None
+        self.port = None
+
+    def add_activity(self, n):
+        """n new log lines and a few encounters, as if the badge had been out for a while"""
+        for i in range(n):
+            addr = bytes([self.seed, i & 0xff, i >> 8, 3, 4, 5])
+            self.cc.lager.log_str('add,{},{},{},1,new static'.format(
+                int(self.dev.host_clock.t), i, self.dev.addr_to_hex(addr)))
+            if i % 20 == 0:
+                self.cc.current_encounters[addr] = self.dev.Encounter(True, None)
+            self.dev.host_clock.advance(1.0)
+        self.cc.persistent_data['unique_counts'] += n
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return 'tcp:127.0.0.1:{}'.format(self.port)
+
+    async def serve(self, reader, writer):
+        uart = self.bt.uart_server
+        uart.rx.clear()
+        uart.tx.clear()
+        self.bt.last_status = None
+        sent = 0
+        try:
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    data = await asyncio.wait_for(reader.read(256), self.loop_seconds)
+                    if not data:
+                        break
+                    uart.rx += data
+                with contextlib.redirect_stdout(io.StringIO()):
+                    self.bt.uart_update(self.cc)
+                if uart.tx:
+                    out, uart.tx = bytes(uart.tx), bytearray()
+                    if self.drop_after is not None and sent + len(out) > self.drop_after:
+                        writer.write(out[:self.drop_after - sent])
+                        self.drop_after = None
+                        break
+                    writer.write(out)
+                    sent += len(out)
+                    await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass  # the collector hung up, or the demo is over
+        finally:
+            self.bt.exporter.stream_id = None
+            writer.close()
+
+
+async def demo(count, db):
+    badges = [FakeBadge(i, drop_after=9000 if i % 3 == 0 else None) for i in range(count)]
+    specs = [await b.start() for b in badges]
+    store = Store(db)
+    for round_number in range(2):
+        t = time.perf_counter()
+        results = await collect(specs, store)
+        seconds = time.perf_counter() - t
+        total = sum(r['bytes'] for r in results.values() if isinstance(r, dict))
+        lines = sum(r['log lines'] for r in results.values() if isinstance(r, dict))
+        encounters = sum(r['encounters'] for r in results.values() if isinstance(r, dict))
+        reconnects = sum(r['reconnects'] for r in results.values() if isinstance(r, dict))
+        failed = [b for b, r in results.items() if not isinstance(r, dict)]
+        print('pull {}: {} badges, {} bytes, {} new log lines, {} new encounters, {} reconnects, {:.2f}s{}'.format(
+            round_number + 1, count, total, lines, encounters, reconnects, seconds,
+            ', failed: {}'.format(failed) if failed else ''))
+        for b in badges:
+            b.add_activity(25)
+    rows = store.db.execute('select count(*), count(distinct badge) from log_lines').fetchone()
+    rows += store.db.execute('select count(*) from encounters').fetchone()
+    print('store: {} log lines from {} badges, {} encounters'.format(*rows))
+    for b in badges:
+        b.server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pull data from many badges at once')
+    parser.add_argument('badges', nargs='*', help='tcp:HOST:PORT, pty:/dev/pts/N or a device path')
+    parser.add_argument('--db', default='fleet.db', help='SQLite file to add to')
+    parser.add_argument('--concurrency', type=int, default=8, help='badges pulled at the same time')
+    parser.add_argument('--bloom', action='store_true', help='also pull each badge\'s 24k bloom filter')
+    parser.add_argument('--demo', type=int, metavar='N', help='pull twice from N fake badges on localhost')
+    args = parser.parse_args()
+    if args.demo:
+        db = os.path.join(tempfile.mkdtemp(prefix='fleet-'), 'fleet.db') if args.db == 'fleet.db' else args.db
+        asyncio.run(demo(args.demo, db))
+        return 0
+    if not args.badges:
+        parser.error('name some badges, or use --demo')
+    store = Store(args.db)
+    results = asyncio.run(collect(args.badges, store, args.concurrency, args.bloom))
+    failures = 0
+    for badge, result in results.items():
+        if isinstance(result, dict):
+            print('{}: {}'.format(badge, ', '.join('{} {}'.format(v, k) for k, v in result.items())))
+        else:
+            failures += 1
+            print('{}: failed: {!r}'.format(badge, result))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+Replay recorded scans through code.py's real ContactCounts, under a virtual
+clock, for a grid of settings at once.
+
+Input is a day (or more) of what a badge saw, either
+  - DoubleLager logs (data_log0.txt / data_log1.txt, oldest first): each
+    add..del becomes an address that was in range the whole time, seen
+    every --scan-period seconds.  Logs have no rssi, so every sighting gets
+    --log-rssi, and hopper chains are rebuilt from 'migrated hopper' adds.
+  - scan traces from the badge's capture mode, read with scan_trace.py.
+
+Every combination of the --set values runs in its own process, each with
+its own in-memory copy of the flash, and prints one row per combination.
+
+    python3 tools/replay.py data_log1.txt data_log0.txt \\
+        --set setting_bt_rssi=-90,-80,-70 \\
+        --set setting_end_encounter_time=120,300,600 \\
+        --set setting_home_count_minutes=0,2,10
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import devicecode
+
+Advert = collections.namedtuple('Advert', 'addr type rssi data_dict')
+Scan = collections.namedtuple('Scan', 't adverts')
+# start: the badge's monotonic time at boot; scans: [Scan] in time order
+Session = collections.namedtuple('Session', 'start scans')
+
+PUBLIC = 0
+RANDOM_PRIVATE_RESOLVABLE = 2
+QUIET_SCAN_PERIOD = 30.0  # with nobody around there's nothing to see, so scan less often
+
+METRICS = ('unique', '5min', '30min', '2hour', 'encounters', 'new hoppers', 'migrated', 'home devices')
+
+
+def hex_to_addr(text):
+    """inverse of code.py's addr_to_hex()"""
+    return bytes(reversed(bytes.fromhex(text.replace(':', ''))))
+
+
+def chain_data_dict(chain):
+    """
+    An advertisement payload whose thumbprint is the same for every address of
+    one hopper chain and different between chains.  make_thumbprint() only
+    looks at which keys there are and their sizes, so the chain goes there.
+    """
+    return {0x01: bytes(1 + chain % 31), 0xff: bytes(1 + (chain // 31) % 31)}
+
+
+def read_log_events(filenames):
+    """the add/del lines' fields, as one list per session (a startup line starts one)"""
+    sessions = []
+    events = []
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                fields = line.strip().split(',')
+                if fields[0] == 'startup':
+                    if events:
+                        sessions.append(events)
+                    events = [fields]
+                elif fields[0] in ('add', 'del'):
+                    events.append(fields)
+    if events:
+        sessions.append(events)
+    return sessions
+
+
+def session_from_log(events, scan_period, rssi):
+    """rebuild who was in range when from one session's add/del lines"""
+    start = int(events[0][1])
+    end = max(int(e[1]) for e in events)
+    intervals = []  # [addr, type, first, last, chain]
+    open_by_addr = {}
+    chains = 0
+    active_hoppers = []  # intervals of hoppers whose chain is still going, latest last
+    for e in events:
+        t = int(e[1])
+        if e[0] == 'add':
+            addr = hex_to_addr(e[3])
+            hop_type = e[5] if len(e) > 5 else 'new static'
+            if 'hopper' in hop_type:
+                if hop_type == 'migrated hopper' and active_hoppers:
+                    # the log doesn't say which hopper moved; take the most recent one
+                    prev = active_hoppers.pop()
+                    prev[3] = t
+                    chain = prev[4]
+                else:
+                    chain = chains
+                    chains += 1
+                iv = [addr, RANDOM_PRIVATE_RESOLVABLE, t, None, chain]
+                active_hoppers.append(iv)
+            else:
+                iv = [addr, PUBLIC, t, None, None]
+            intervals.append(iv)
+            open_by_addr[addr] = iv
+        elif e[0] == 'del':
+            addr = hex_to_addr(e[3])
+            iv = open_by_addr.pop(addr, None)
+            if iv is not None:
+                iv[3] = int(e[6]) if len(e) > 6 else t
+                if iv in active_hoppers:
+                    active_hoppers.remove(iv)
+    for iv in intervals:
+        if iv[3] is None:
+            iv[3] = end
+        # one Advert per interval, shared by all its scans
+        iv.append(Advert(iv[0], iv[1], rssi, chain_data_dict(iv[4]) if iv[4] is not None else {}))
+    scans = []
+    t = float(start)
+    intervals.sort(key=lambda iv: iv[2])
+    live = []
+    i = 0
+    while t <= end:
+        while i < len(intervals) and intervals[i][2] <= t:
+            live.append(intervals[i])
+            i += 1
+        live = [iv for iv in live if iv[3] >= t]
+        adverts = [iv[5] for iv in live]
+        scans.append(Scan(t, adverts))
+        if adverts:
+            t += scan_period
+        else:
+            next_start = intervals[i][2] if i < len(intervals) else end + 1
+            t += max(scan_period, min(QUIET_SCAN_PERIOD, next_start - t))
+    return Session(start, scans)
+
+
+def load_trace(filenames, scan_period=1.5, log_rssi=-60):
+    """[Session] from log files or scan trace files"""
+    if all(name.endswith('.txt') for name in filenames):
+        return [session_from_log(events, scan_period, log_rssi) for events in read_log_events(filenames)]
+    import scan_trace
+    return scan_trace.read_sessions(filenames)
+
+
+class CountingLager:
+    """DoubleLager stand-in that counts events instead of writing them"""
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def log_add_contact(self, big_number, addr, contact, hop_type):
+        self.counts[hop_type] += 1
+
+    def log_hop_contact(self, big_number, old_addr, new_addr, contact):
+        self.counts['hop'] += 1
+
+    def log_del_contact(self, big_number, addr, contact):
+        self.counts['del'] += 1
+
+    def log_startup(self, big_number):
+        self.counts['startup'] += 1
+
+    def log_str(self, line):
+        pass
+
+
+def scan_entry(advert):
+    """what radio.start_scan() yields, as far as ContactCounts looks"""
+    return types.SimpleNamespace(address=types.SimpleNamespace(address_bytes=advert.addr, type=advert.type),
+                                 rssi=advert.rssi, data_dict=advert.data_dict)
+
+
+class Buttons:
+    def left(self):
+        return False
+
+    def right(self):
+        return False
+
+    def switch(self):
+        return False
+
+
+def replay(sessions, settings):
+    """run the sessions through ContactCounts with these settings; returns the metrics"""
+    root = tempfile.mkdtemp(prefix='replay-')
+    try:
+        clock = devicecode.HostClock(0.0)
+        dev = devicecode.load(root=root, clock=clock, settings=settings)
+        dev.btprint = lambda text: None
+        min_rssi = dev.setting_bt_rssi
+        lager = CountingLager()
+        buttons = Buttons()
+        homies = set()
+        encounters = 0
+        entries = {}  # id(advert): its scan entry, built once
+        with contextlib.redirect_stdout(io.StringIO()):
+            for session in sessions:
+                # a reboot: a fresh ContactCounts on the same flash. Sessions
+                # are power cycles, so no encounter snapshot carries over
+                with contextlib.suppress(OSError):
+                    os.remove(dev.host_fs.path('/data_encounters.bin'))
+                clock.t = float(session.start)
+                cc = dev.ContactCounts()
+                cc.history_bar = None
+                cc.lager = lager
+                for scan in session.scans:
+                    clock.t = scan.t
+                    seen = []
+                    for a in scan.adverts:
+                        if a.rssi >= min_rssi:
+                            entry = entries.get(id(a))
+                            if entry is None:
+                                entry = entries[id(a)] = scan_entry(a)
+                            seen.append(entry)
+                    cc.update_contacts(seen)
+                    cc.periodic_update(buttons)
+                    encounters = max(encounters, len(cc.current_encounters))
+                homies.update(cc.homies)
+        pd = cc.persistent_data
+        return {'unique': pd['unique_counts'], '5min': pd['5min'], '30min': pd['30min'], '2hour': pd['2hour'],
+                'encounters': encounters, 'new hoppers': lager.counts['new hopper'],
+                'migrated': lager.counts['migrated hopper'], 'home devices': len(homies)}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+_sessions = None
+
+
+def _worker_init(filenames, scan_period, log_rssi):
+    global _sessions
+    _sessions = load_trace(filenames, scan_period, log_rssi)
+
+
+def _worker_run(settings):
+    return settings, replay(_sessions, settings)
+
+
+def parse_grid(assignments):
+    """['setting_bt_rssi=-90,-80', ...] -> list of settings dicts, one per combination"""
+    names = []
+    values = []
+    for a in assignments:
+        name, _, vals = a.partition('=')
+        names.append(name.strip())
+        values.append([float(v) if '.' in v else int(v) for v in vals.split(',')])
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded scans for a grid of settings')
+    parser.add_argument('traces', nargs='+', help='log files (.txt, oldest first) or scan trace files')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=V1,V2',
+                        help='a setting from code.py and the values to try')
+    parser.add_argument('--scan-period', type=float, default=1.5, help='seconds between rebuilt scans (logs only)')
+    parser.add_argument('--log-rssi', type=int, default=-60, help='rssi given to sightings rebuilt from logs')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    args = parser.parse_args()
+
+    grid = parse_grid(args.set) or [{}]
+    t = time.perf_counter()
+    sessions = load_trace(args.traces, args.scan_period, args.log_rssi)
+    scans = sum(len(s.scans) for s in sessions)
+    print('{} sessions, {} scans, {} runs'.format(len(sessions), scans, len(grid)))
+    names = list(grid[0])
+    print(' '.join('{:>14}'.format(n.replace('setting_', '')) for n in names) +
+          ' ' + ' '.join('{:>12}'.format(m) for m in METRICS))
+    with concurrent.futures.ProcessPoolExecutor(args.jobs, initializer=_worker_init,
+                                                initargs=(args.traces, args.scan_period, args.log_rssi)) as pool:
+        for settings, metrics in pool.map(_worker_run, grid):
+            print(' '.join('{:>14}'.format(settings[n]) for n in names) +
+                  ' ' + ' '.join('{:>12}'.format(metrics[m]) for m in METRICS))
+    print('{:.1f}s'.format(time.perf_counter() - t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Read the badge's scan capture files (ScanCapture in code.py) on a computer.
+
+Turn capture on with setting_scan_capture = True, wear the badge, then copy
+/data_scan0.bin and /data_scan1.bin off the CIRCUITPY drive.
+
+    python3 tools/scan_trace.py data_scan0.bin data_scan1.bin      # summary
+    python3 tools/scan_trace.py --dump data_scan0.bin | head        # every result
+    python3 tools/replay.py data_scan0.bin data_scan1.bin --set setting_bt_rssi=-90,-80,-70
+
+Results stored as a thumbprint hash get a made-up data_dict with the same
+hash-derived keys and sizes, so two results match in replay exactly when
+their thumbprints matched on the badge.  Raw results get their real
+advertisement fields back.
+"""
+import argparse
+import collections
+import struct
+import sys
+
+from replay import Advert, Scan, Session
+
+MAGIC = b'SCN1'
+HASHED = 0x80
+RESULT = '<6sBbB'
+RESULT_SIZE = struct.calcsize(RESULT)
+
+
+def hash_data_dict(h):
+    """a data_dict whose keys and sizes (all make_thumbprint() looks at) come from the hash"""
+    return {0x01: bytes(1 + h % 31), 0x02: bytes(1 + (h >> 5) % 31), 0xff: bytes(1 + (h >> 10) % 31)}
+
+
+def parse_ad(payload):
+    """AD structures (length, type, data...) back into a data_dict"""
+    out = {}
+    i = 0
+    end = len(payload)
+    # the badge cuts payloads at 127 bytes, so the last structure can be short
+    while i + 1 < end and payload[i]:
+        n = payload[i]
+        out[payload[i + 1]] = bytes(payload[i + 2:min(i + 1 + n, end)])
+        i += 1 + n
+    return out
+
+
+def read_file(filename):
+    """(sequence number, [('boot', ms) | ('scan', ms, [Advert])])"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != MAGIC:
+        raise ValueError('{}: not a scan capture file'.format(filename))
+    seq, = struct.unpack_from('<I', data, 4)
+    records = []
+    pos = 8
+    ms = None
+    while pos < len(data):
+        tag = data[pos]
+        if tag in (ord('B'), ord('T')):
+            ms, = struct.unpack_from('<I', data, pos + 1)
+            pos += 5
+            if tag == ord('B'):
+                records.append(('boot', ms))
+        elif tag == ord('S'):
+            dt, n = struct.unpack_from('<HB', data, pos + 1)
+            pos += 4
+            ms = (ms + dt * 10) & 0xffffffff
+            adverts = []
+            for i in range(n):
+                addr, addr_type, rssi, size = struct.unpack_from(RESULT, data, pos)
+                pos += RESULT_SIZE
+                if size & HASHED:
+                    h, = struct.unpack_from('<I', data, pos)
+                    data_dict = hash_data_dict(h)
+                    size &= ~HASHED
+                else:
+                    data_dict = parse_ad(data[pos:pos + size])
+                pos += size
+                adverts.append(Advert(addr, addr_type, rssi, data_dict))
+            records.append(('scan', ms, adverts))
+        else:
+            raise ValueError('{}: bad record {!r} at {}'.format(filename, tag, pos))
+    return seq, records
+
+
+def read_sessions(filenames):
+    """[Session] for replay.py, oldest first; a new one at every boot"""
+    files = sorted(read_file(name) for name in filenames)
+    sessions = []
+    for seq, records in files:
+        for record in records:
+            if record[0] == 'boot':
+                sessions.append(Session(record[1] / 1000, []))
+            else:
+                if not sessions:  # the file holding this session's boot was overwritten
+                    sessions.append(Session(record[1] / 1000, []))
+                sessions[-1].scans.append(Scan(record[1] / 1000, record[2]))
+    return [s for s in sessions if s.scans]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize or dump badge scan captures')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--dump', action='store_true', help='print every scan result')
+    args = parser.parse_args()
+    sessions = read_sessions(args.files)
+    for n, session in enumerate(sessions):
+        results = sum(len(scan.adverts) for scan in session.scans)
+        addrs = collections.Counter(a.addr for scan in session.scans for a in scan.adverts)
+        span = session.scans[-1].t - session.scans[0].t
+        print('session {}: {} scans over {:.0f}s, {} results, {} addresses'.format(
+            n, len(session.scans), span, results, len(addrs)))
+        if args.dump:
+            for scan in session.scans:
+                for a in scan.adverts:
+                    print('{:.2f} {} type {} rssi {} {}'.format(
+                        scan.t, ':'.join('{:02x}'.format(b) for b in reversed(a.addr)), a.type, a.rssi,
+                        ' '.join('{:02x}:{}'.format(k, v.hex()) for k, v in sorted(a.data_dict.items()))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
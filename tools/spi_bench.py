@@ -0,0 +1,150 @@
+"""
+Measure what EInkOverride.display() pushes over SPI, on the host.
+
+A stand-in SPI bus counts bytes and write() calls and models the time they
+take at the driver's 1 MHz clock.  Compares the old byte-at-a-time
+full-frame transfer with the window-limited bulk path, for a full frame,
+one 48x48 dial, the big number and the history bar.
+
+It also runs the Feather's SSD1675Override against the stand-in and checks
+the recorded command stream: the driver's gate count and RAM layout, windows
+addressed as the gate lines of whole framebuffer rows, which LUT and update
+mode each window uses, and that exactly those rows' bytes reach RAM.
+
+    python3 tools/spi_bench.py
+"""
+import contextlib
+import io
+import time
+
+import devicecode
+from eink_emu import StandInSPI, EmulatedIL0373, EmulatedSSD1675
+
+
+def legacy_full_frame(d):
+    """the old display(): every byte of both planes through _spi_transfer"""
+    d.write_ram(0)
+    d.spi_device.try_lock()
+    d._dc.value = True
+    for databyte in d._buffer1:
+        d._spi_transfer(databyte)
+    d._cs.value = True
+    d.spi_device.unlock()
+    d.write_ram(1)
+    d.spi_device.try_lock()
+    d._dc.value = True
+    for databyte in d._buffer2:
+        d._spi_transfer(databyte)
+    d._cs.value = True
+    d.spi_device.unlock()
+
+
+def make_display(dev, width=152, height=152, sram=False):
+    dc = devicecode.Pin()
+    spi = StandInSPI(dc_pin=dc)
+    d = dev.EInkOverride(width, height, spi, cs_pin=devicecode.Pin(), dc_pin=dc,
+                         sramcs_pin=devicecode.Pin() if sram else None,
+                         rst_pin=devicecode.Pin(), busy_pin=None)
+    planes = [bytes(((i * 7) ^ (i >> 5)) & 0xff for i in range(d._buffer1_size)),
+              bytes(((i * 13) + 5) & 0xff for i in range(d._buffer2_size))]
+    if sram:
+        d.sram.mem[:] = planes[0] + planes[1]
+    else:
+        d._buffer1[:] = planes[0]
+        d._buffer2[:] = planes[1]
+    return d, planes
+
+
+def expected_window_bytes(planes, width, wrect):
+    x, y, w, h = wrect
+    stride = width >> 3
+    bx = x >> 3
+    nbytes = ((x + w + 7) >> 3) - bx
+    out = bytearray()
+    for plane in planes:
+        for row in range(y, y + h):
+            out += plane[row * stride + bx:row * stride + bx + nbytes]
+    return out
+
+
+def find_commands(spi, cmd):
+    return [bytes(data) for c, data in spi.commands if c == cmd]
+
+
+def check_ssd1675():
+    """run SSD1675Override on the stand-in and check the command stream and window math"""
+    dev = devicecode.load(clock=devicecode.HostClock(0.0), eink_base=EmulatedSSD1675, feather=True)
+    width, height = 250, 122
+    stride = 32
+    print()
+    print('{:<12} {:>8} {:>8} {:>8}  {}'.format('SSD1675', 'bytes', 'data', 'writes', 'window check'))
+    for label, wrect in [('full frame', (0, 0, width, height)),
+                         ('dial', (8, 40, 48, 48)),
+                         ('odd edges', (13, 7, 30, 5))]:
+        dc = devicecode.Pin()
+        spi = StandInSPI(dc_pin=dc)
+        d = dev.SSD1675Override(width, height, spi, cs_pin=devicecode.Pin(), dc_pin=dc,
+                                sramcs_pin=None, rst_pin=devicecode.Pin(), busy_pin=None)
+        d._buffer1[:] = bytes(((i * 7) ^ (i >> 5)) & 0xff for i in range(d._buffer1_size))
+        spi.reset_stats()
+        d.set_window(wrect)
+        d.display()
+        # the driver's RAM: 250 gate lines of 16 bytes holding the framebuffer
+        # in order, so a window goes out as the gate lines of its whole rows
+        x, y, w, h = wrect
+        y1 = min(height, y + h) - 1
+        g0 = y * stride // 16
+        g1 = ((y1 + 1) * stride - 1) // 16
+        full = label == 'full frame'
+        assert find_commands(spi, 0x01) == [bytes([0xF9, 0x00, 0x00])], 'the driver\'s 250 gates'
+        assert find_commands(spi, 0x44)[-1] == bytes([0, 15]), label
+        assert find_commands(spi, 0x45)[-1] == bytes([g0 & 0xff, g0 >> 8, g1 & 0xff, g1 >> 8]), label
+        assert find_commands(spi, 0x4E)[-1] == bytes([0]), label
+        assert find_commands(spi, 0x4F)[-1] == bytes([g0 & 0xff, g0 >> 8]), label
+        assert bool(find_commands(spi, 0x32)) != full, 'partial LUT only for partial windows'
+        assert find_commands(spi, 0x22) == [bytes([0xF7 if full else 0x0C])], label
+        expected = expected_window_bytes([d._buffer1], stride * 8, (0, y, width, h))
+        assert len(expected) == (g1 - g0 + 1) * 16, 'whole gate lines'
+        assert find_commands(spi, 0x24) == [bytes(expected)], 'RAM1 gets exactly the rows'
+        assert find_commands(spi, 0x26) == [bytes(expected)], 'RAM2 gets the same rows afterwards'
+        print('{:<12} {:>8} {:>8} {:>8}  ok (gate lines {}-{})'.format(
+            label, spi.bytes, spi.data_bytes, spi.calls, g0, g1))
+
+
+def main():
+    dev = devicecode.load(clock=devicecode.HostClock(0.0), eink_base=EmulatedIL0373)
+    windows = [('full frame', (0, 0, 152, 152)),
+               ('one dial', (0, 85, 48, 48)),
+               ('big number', (56, 64, 40, 20)),
+               ('history bar', (8, 16, 136, 41))]
+    print('{:<12} {:<11} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+        'window', 'path', 'bytes', 'data', 'writes', 'model ms', 'host ms'))
+    for label, wrect in windows:
+        d, planes = make_display(dev)
+        d.spi_device.reset_stats()
+        t = time.perf_counter()
+        legacy_full_frame(d)
+        host_ms = (time.perf_counter() - t) * 1000
+        spi = d.spi_device
+        print('{:<12} {:<11} {:>8} {:>8} {:>8} {:>10.1f} {:>10.2f}'.format(
+            label, 'old bytes', spi.bytes, spi.data_bytes, spi.calls, spi.modeled_seconds() * 1000, host_ms))
+        for sram in (False, True):
+            d, planes = make_display(dev, sram=sram)
+            d.set_window(wrect)
+            d.spi_device.reset_stats()
+            t = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                d.display()
+            host_ms = (time.perf_counter() - t) * 1000
+            spi = d.spi_device
+            expected = expected_window_bytes(planes, 152, wrect)
+            sent = find_commands(spi, 0x10)[-1] + find_commands(spi, 0x13)[-1]
+            assert sent == expected, 'window bytes mismatch for {}'.format(label)
+            print('{:<12} {:<11} {:>8} {:>8} {:>8} {:>10.1f} {:>10.2f}'.format(
+                label, 'sram rows' if sram else 'bulk', spi.bytes, spi.data_bytes, spi.calls,
+                spi.modeled_seconds() * 1000, host_ms))
+    check_ssd1675()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+Host side of the badge's framed UART export (FrameExporter in code.py).
+
+    import uart_frames
+    parser = uart_frames.FrameParser()
+    transfer = uart_frames.Transfer('log', req_id=7)
+    send(transfer.command())                # b'143.get log 7 0\n', then with the generation
+    for kind, item in parser.feed(received_bytes):
+        if kind == 'text':
+            print(item)                     # a text line from the badge
+        elif item.stream == uart_frames.STATUS_STREAM:
+            print(uart_frames.decode_status(item))
+        else:
+            transfer.add(item)
+    # dropped connection: reconnect, send(transfer.command()) resumes; if the
+    # badge's stream changed meanwhile, it starts over (transfer.restarts)
+
+Run it directly to push every stream through the real FrameExporter on
+the host (with devicecode.py), dropping the link halfway through each one,
+resume across a log rotation, and check when status frames are sent.
+
+    python3 tools/uart_frames.py
+"""
+import collections
+import struct
+
+MAGIC = 0xA5
+HEADER = '<BBHHIH'
+HEADER_SIZE = struct.calcsize(HEADER)
+STREAMS = ('encounters', 'log', 'bloom', 'history')
+ENCOUNTER = '<6sBIII'
+ENCOUNTER_SIZE = struct.calcsize(ENCOUNTER)
+STATUS_STREAM = 4
+STATUS = '<IIIIHHHHH'
+MAX_PAYLOAD = 512  # the badge sends at most setting_uart_mtu - 16 per frame
+
+Frame = collections.namedtuple('Frame', 'stream req_id generation offset payload')
+Encounter = collections.namedtuple('Encounter', 'address is_new is_home is_hopper first_ago last_ago duration')
+Status = collections.namedtuple('Status', 'seq uptime unique_counts sample_seconds scan mem_free '
+                                          'encounters dial_5min dial_30min dial_2hour loop_ms')
+
+
+def fnv1a32(data, h=0x811c9dc5):
+    for b in data:
+        h = ((h ^ b) * 0x01000193) & 0xffffffff
+    return h
+
+
+class FrameParser:
+    """Splits the badge's UART byte stream into text lines and checked frames"""
+    def __init__(self):
+        self.buf = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        """returns a list of ('text', str) and ('frame', Frame)"""
+        self.buf += data
+        out = []
+        while self.buf:
+            if self.buf[0] != MAGIC:
+                end = self.buf.find(b'\n')
+                magic = self.buf.find(bytes([MAGIC]))
+                if end < 0 or (0 <= magic < end):
+                    if magic < 0:
+                        break  # a partial text line
+                    text, self.buf = self.buf[:magic], self.buf[magic:]
+                    if text.strip():
+                        out.append(('text', text.decode(errors='replace').strip()))
+                    continue
+                text, self.buf = self.buf[:end], self.buf[end + 1:]
+                out.append(('text', text.decode(errors='replace').strip()))
+                continue
+            if len(self.buf) < HEADER_SIZE:
+                break
+            magic, stream, req_id, generation, offset, length = struct.unpack_from(HEADER, self.buf)
+            if stream > STATUS_STREAM or length > MAX_PAYLOAD:
+                # a stray 0xA5 (in a damaged frame), not a frame header
+                self.bad_frames += 1
+                del self.buf[0]
+                continue
+            size = HEADER_SIZE + length + 4
+            if len(self.buf) < size:
+                break
+            body = bytes(self.buf[:HEADER_SIZE + length])
+            check, = struct.unpack_from('<I', self.buf, HEADER_SIZE + length)
+            if fnv1a32(body) != check:
+                self.bad_frames += 1
+                del self.buf[0]
+                continue
+            del self.buf[:size]
+            out.append(('frame', Frame(stream, req_id, generation, offset, body[HEADER_SIZE:])))
+        return out
+
+
+class Transfer:
+    """Collects one stream from its frames; resumable from wherever it got to"""
+    def __init__(self, stream, req_id, offset=0):
+        self.stream = stream
+        self.stream_id = STREAMS.index(stream)
+        self.req_id = req_id
+        self.data = bytearray()
+        self.start = offset
+        self.generation = None  # from the first frame; a resume asks for the same one
+        self.restarts = 0
+        self.done = False
+
+    @property
+    def offset(self):
+        return self.start + len(self.data)
+
+    def command(self):
+        if self.generation is None:
+            return '143.get {} {} {}\n'.format(self.stream, self.req_id, self.offset).encode()
+        return '143.get {} {} {} {}\n'.format(self.stream, self.req_id, self.offset, self.generation).encode()
+
+    def add(self, frame):
+        """
+        take a frame if it's ours and continues the data; True if it was used.
+        A new generation from offset 0 means the badge's stream changed under
+        a resume (new snapshot, log rotation): what we have is dropped and the
+        transfer starts over, with start = 0.
+        """
+        if frame.stream != self.stream_id or frame.req_id != self.req_id:
+            return False
+        if frame.offset != self.offset or (self.generation is not None and frame.generation != self.generation):
+            if frame.offset != 0 or frame.generation == self.generation:
+                return False
+            if self.offset:
+                self.restarts += 1
+            self.data = bytearray()
+            self.start = 0
+        self.generation = frame.generation
+        if frame.payload:
+            self.data += frame.payload
+        else:
+            self.done = True
+        return True
+
+
+def decode_status(frame):
+    """a Status from a status frame (frame.stream == STATUS_STREAM)"""
+    return Status(frame.req_id, frame.offset, *struct.unpack(STATUS, frame.payload))
+
+
+def decode_encounters(data):
+    out = []
+    for i in range(0, len(data) - ENCOUNTER_SIZE + 1, ENCOUNTER_SIZE):
+        addr, flags, first, last, duration = struct.unpack_from(ENCOUNTER, data, i)
+        out.append(Encounter(':'.join('{:02x}'.format(b) for b in reversed(addr)),
+                             bool(flags & 1), bool(flags & 2), bool(flags & 4), first, last, duration))
+    return out
+
+
+def main():
+    import contextlib
+    import io
+    import os
+    import types
+
+    import devicecode
+
+    class Wire:
+        def __init__(self):
+            self.bytes = bytearray()
+
+        def write(self, data):
+            self.bytes += data
+
+    dev = devicecode.load(clock=devicecode.HostClock(1000.0))
+    with contextlib.redirect_stdout(io.StringIO()):
+        cc = dev.ContactCounts()
+        for i in range(40):
+            enc = dev.Encounter(i % 3 == 0, b'x' if i % 5 == 0 else None)
+            enc.contact_duration = i * 10.0
+            cc.current_encounters[bytes([i, 1, 2, 3, 4, 5])] = enc
+        for i in range(500):
+            cc.lager.log_str('add,{},{},00:11:22:33:44:{:02x},1,new static'.format(i, i, i & 0xff))
+        for i in range(cc.history_bar.num_columns):
+            cc.history_bar.set_value(i, i * 3)
+        cc.seen_filter.bits[100] = 0x5a
+    logs = b''
+    for i in range(2):
+        name = cc.lager.filenames[(cc.lager.log_index + i + 1) & 1]
+        path = dev.host_fs.path(name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                logs += f.read()
+    hb = cc.history_bar
+    expected = {'encounters': None, 'log': logs, 'bloom': bytes(cc.seen_filter.bits),
+                'history': bytes(hb.data[hb.start_index:]) + bytes(hb.data[:hb.start_index])}
+
+    print('{:<11} {:>7} {:>7} {:>9} {:>7}'.format('stream', 'bytes', 'frames', 'wire', 'resumes'))
+    for req_id, stream in enumerate(STREAMS):
+        wire = Wire()
+        exporter = dev.FrameExporter(wire)
+        parser = FrameParser()
+        transfer = Transfer(stream, req_id)
+        frames = resumes = 0
+        wire_bytes = 0
+        dropped = False
+        exporter.start(cc, transfer.command().decode())
+        while not transfer.done:
+            exporter.pump()
+            data, wire.bytes = bytes(wire.bytes), bytearray()
+            if not dropped and transfer.offset > 0:
+                # lose the link part way through a frame, then resume
+                dropped = True
+                data = data[:len(data) // 2 + 3]
+                exporter.stream_id = None
+                for kind, item in parser.feed(data):
+                    if kind == 'frame' and transfer.add(item):
+                        frames += 1
+                parser = FrameParser()  # the half frame is gone with the old link
+                exporter.start(cc, transfer.command().decode())
+                resumes += 1
+                continue
+            wire_bytes += len(data)
+            for kind, item in parser.feed(data):
+                if kind == 'frame' and transfer.add(item):
+                    frames += 1
+        if stream == 'encounters':
+            got = decode_encounters(transfer.data)
+            assert len(got) == len(cc.current_encounters), 'encounter count'
+            assert got[3].is_new and got[5].is_hopper and got[4].duration == 40, 'encounter fields'
+        else:
+            assert bytes(transfer.data) == expected[stream], '{} mismatch'.format(stream)
+        assert parser.bad_frames == 0
+        print('{:<11} {:>7} {:>7} {:>9} {:>7}  ok'.format(stream, len(transfer.data), frames, wire_bytes, resumes))
+
+    # resumes: an encounter snapshot outlives a dropped link; a log rotation
+    # or a lost snapshot makes the badge start over with a new generation
+    frames_per_loop = dev.setting_uart_frames_per_loop
+    dev.setting_uart_frames_per_loop = 1  # so the link drops before the end
+
+    def resume(stream, req_id, change):
+        wire = Wire()
+        exporter = dev.FrameExporter(wire)
+        transfer = Transfer(stream, req_id)
+        exporter.start(cc, transfer.command().decode())
+        exporter.pump()
+        exporter.pump()
+        for kind, item in FrameParser().feed(bytes(wire.bytes[:len(wire.bytes) * 3 // 4])):
+            if kind == 'frame':
+                transfer.add(item)
+        assert transfer.offset > 0, 'nothing before the drop'
+        exporter.stream_id = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            change(exporter)
+            exporter.start(cc, transfer.command().decode())
+        parser = FrameParser()
+        while not transfer.done:
+            wire.bytes = bytearray()
+            exporter.pump()
+            for kind, item in parser.feed(bytes(wire.bytes)):
+                if kind == 'frame':
+                    transfer.add(item)
+        return transfer
+
+    def more_encounters(exporter):
+        for i in range(40, 50):
+            cc.current_encounters[bytes([i, 1, 2, 3, 4, 5])] = dev.Encounter(False, None)
+    transfer = resume('encounters', 20, more_encounters)
+    assert transfer.restarts == 0 and len(decode_encounters(transfer.data)) == 40, 'resumed snapshot'
+
+    def lost_snapshot(exporter):
+        exporter.data = None
+    transfer = resume('encounters', 21, lost_snapshot)
+    assert transfer.restarts == 1 and len(decode_encounters(transfer.data)) == 50, 'restarted snapshot'
+
+    def set_bits(exporter):
+        cc.seen_filter.bits[0] ^= 0xff
+        cc.seen_filter.bits[-1] ^= 0xff
+    transfer = resume('bloom', 23, set_bits)
+    assert transfer.restarts == 0 and bytes(transfer.data) == expected['bloom'], 'bloom snapshot'
+    cc.seen_filter.bits[0] ^= 0xff
+    cc.seen_filter.bits[-1] ^= 0xff
+
+    def rotate(exporter):
+        cc.lager.log_file_max_size = 0
+        cc.lager.log_str('add,9999,9999,00:11:22:33:44:55,1,new static')
+    transfer = resume('log', 22, rotate)
+    logs = b''
+    for i in range(2):
+        path = dev.host_fs.path(cc.lager.filenames[(cc.lager.log_index + i + 1) & 1])
+        with open(path, 'rb') as f:
+            logs += f.read()
+    assert transfer.restarts == 1 and transfer.start == 0 and bytes(transfer.data) == logs, 'log rotation'
+    dev.setting_uart_frames_per_loop = frames_per_loop
+    for i in range(40, 50):
+        del cc.current_encounters[bytes([i, 1, 2, 3, 4, 5])]
+    print('resume with a kept snapshot, a lost one, a changed bloom and a rotated log ok')
+
+    # text lines mixed in with frames, a corrupted frame, then a retry
+    wire = Wire()
+    exporter = dev.FrameExporter(wire)
+    exporter.start(cc, '143.get history 99 0')
+    exporter.pump()
+    corrupt = bytearray(b'scan 1: 3/7 contacts\n' + bytes(wire.bytes))
+    corrupt[40] ^= 0xff
+    parser = FrameParser()
+    transfer = Transfer('history', 99)
+    items = parser.feed(bytes(corrupt) + b'scan 2\n')
+    exporter.start(cc, transfer.command().decode())
+    exporter.pump()
+    items += parser.feed(bytes(wire.bytes) + b'scan 3\n')
+    for kind, item in items:
+        if kind == 'frame':
+            transfer.add(item)
+    assert items[0] == ('text', 'scan 1: 3/7 contacts') and items[-1] == ('text', 'scan 3')
+    assert parser.bad_frames > 0, 'corrupt frame accepted'
+    assert transfer.done and bytes(transfer.data) == expected['history'], 'retry after a bad frame'
+    print('text lines, checksum rejection and retry ok')
+
+    # status frames: only on change, or every status_period
+    with contextlib.redirect_stdout(io.StringIO()):
+        bt = dev.BluetoothModule.__new__(dev.BluetoothModule)
+        wire = Wire()
+        bt.uart_server = wire
+        bt.exporter = dev.FrameExporter(wire)
+        bt.status_period = 60
+        bt.status_seq = 0
+        bt.last_status = None
+        bt.next_status_time = 0
+        bt.loop_ms = 1250
+        sent = []
+        for step in range(240):  # a minute of loops
+            if step == 100:
+                cc.persistent_data['5min'] += 1
+            bt.send_status(cc)
+            sent += [item for kind, item in FrameParser().feed(bytes(wire.bytes)) if kind == 'frame']
+            wire.bytes = bytearray()
+            dev.host_clock.advance(0.25)
+    status = [decode_status(f) for f in sent]
+    assert [st.seq for st in status] == [1, 2], 'one frame at connect, one for the dial change'
+    assert status[1].dial_5min == status[0].dial_5min + 1 and status[0].encounters == 40
+    assert status[0].loop_ms == 1250
+    print('status frames ok ({} bytes each vs {} for the text line)'.format(
+        len(sent[0].payload) + HEADER_SIZE + 4, len('scan 1234: 40/1234 contacts t=0d 1h 2m 3s free-mem:81234\n')))
+
+
+if __name__ == '__main__':
+    main()